@@ -7,106 +7,146 @@ import sys
 import argparse
 import tempfile
 import time
+import shlex
 import libraries.parallel as parallel
-from shutil import rmtree
+import libraries.tracing as tracing
+import libraries.storage as storage
+from glob import glob
+from shutil import rmtree, copyfile
 from functools import partial
 from datetime import timedelta
-from libraries.imgtools import check_run, check_warps, sanitize_input, flip_lr, label_fusion_picsl_ants, label_fusion_picsl, ants_compose_a_to_b , ants_new_compose_a_to_b, ants_apply_only_warp, ants_WarpImageMultiTransform, ants_ApplyTransforms, crop_by_mask, label_fusion_majority
-from libraries.ants_nonlinear import ants_nonlinear_registration, ants_new_nonlinear_registration, ants_v0_nonlinear_registration, bias_correct, ants_linear_registration, ants_rigid_registration
-from THOMAS_constants import image_name, orig_template, template_93, mask_93, template_93b, mask_93b, this_path, prior_path, subjects, roi, roi_choices, optimal
+from libraries.imgtools import check_run, sanitize_input, flip_lr, reorient_native, label_fusion_picsl_ants, label_fusion_picsl, ants_compose_a_to_b , ants_new_compose_a_to_b, ants_new_compose_inverse, ants_apply_only_warp, ants_WarpImageMultiTransform, ants_ApplyTransforms, crop_by_mask_native, crop_sidecar
+from libraries.resample import warp_images, crop_images, crop_padding, crop_image, uncrop_image, save_like, grid_points, physical_to_index, resample
+from libraries.cache import Step, run_step
+from libraries.labels import unpack_labels, label_names
+from libraries.fusion import group_labels, partition_labels, label_fusion_native, label_fusion_grouped, label_fusion_majority_native
+from libraries.nuclei import finish_hemisphere
+from libraries.masks import conservative_mask, bounding_box, load_mask
+from libraries.ants_nonlinear import profiles, ants_nonlinear_registration, ants_new_nonlinear_registration, ants_v0_nonlinear_registration, bias_correct, ants_linear_registration, ants_rigid_registration
+from THOMAS_constants import image_name, packed_name, deformed_name, orig_template, template_93, mask_93, template_93b, mask_93b, this_path, prior_path, subjects, prepared, roi, roi_choices, optimal
 import nibabel
 import numpy as np
 
-def warp_atlas_subject(subject, path, labels, input_image, input_transform_prefix, output_path, exec_options={}):
+def warp_atlas_subject(subject, path, labels, input_image, input_transform_prefix, output_path, native=False, prepared=None, target_warp=None, crop=False, reference=None, image=True, exec_options={}):
     """
     Warp a training set subject's labels to input_image.
+    - native resamples in-process with the combined warp loaded once instead of one WarpImageMultiTransform per image
+    - a packed label volume in sanitized_rois (see pack_priors.py) is warped once instead of every label, its
+    warped copy is returned as 'packed' for fusion to use directly
+    - prepared is the subject's directory of labels and image already in the template grid, see prepare_atlas.py,
+    which are warped through target_warp from compose_target instead of composing the subject's own transforms
+    - crop only reads and resamples the region of every prior image that maps into input_image, see sampled_region
+    - reference is a sub-grid of input_image, see roi_crop, to resample into instead, the outputs go to a roi directory
+    and the combined warp on the input grid is shared with a warp to the full grid
+    - image=False only warps the labels
     """
     a_transform_prefix = os.path.join(path, subject + '/WMnMPRAGE')
+    rois = os.path.join(path, subject, 'sanitized_rois')
     output_path = os.path.join(output_path, subject)
     try:
         os.mkdir(output_path)
     except OSError:
         # Exists
         pass
-    combined_warp = os.path.join(output_path, 'Warp.nii.gz')
-    if not os.path.exists(combined_warp):
-        check_run(
-            combined_warp,
-            ants_new_compose_a_to_b,
-            a_transform_prefix,
-            b_path=input_image,
-            b_transform_prefix=input_transform_prefix,
-            output=combined_warp,
-            **exec_options
-        )
-    output_labels = {}
-    # OPT parallelize, or merge parallelism with subject level
-    for label in labels:
-        label_fname = os.path.join(path, subject, 'sanitized_rois', label + '.nii.gz')
-        warped_label = os.path.join(output_path, label + '.nii.gz')
-        switches = '--use-NN'
-        check_run(
-            warped_label,
-            ants_apply_only_warp,
-            template=input_image,
-            input_image=label_fname,
-            input_warp=combined_warp,
-            output_image=warped_label,
-            switches=switches,
-            **exec_options
-        )
-        output_labels[label] = warped_label
-    # Warp anatomical WMnMPRAGE_bias_corr too
-    # TODO merge this into previous for loop to be DRY?
-    output_labels['WMnMPRAGE_bias_corr'] = output_image = os.path.join(output_path, image_name)
-    if not os.path.exists(output_labels['WMnMPRAGE_bias_corr']):
-        print(output_labels['WMnMPRAGE_bias_corr'])
-        check_run(
-            output_image,
-            ants_apply_only_warp,
-            template=input_image,
-            input_image=os.path.join(path, subject, image_name),
-            input_warp=combined_warp,
-            output_image=output_image,
-            switches='--use-BSpline',
-            **exec_options
+    if prepared:
+        source = os.path.join(path, subject, prepared)
+        combined_warp = target_warp
+    else:
+        source = rois
+        combined_warp = storage.intermediate(os.path.join(output_path, 'Warp'))
+        run_step(
+            [combined_warp],
+            lambda stage: ants_new_compose_a_to_b(
+                a_transform_prefix,
+                b_path=input_image,
+                b_transform_prefix=input_transform_prefix,
+                output=stage(combined_warp),
+                **exec_options
+            ),
+            inputs=[a_transform_prefix + 'Affine.txt', a_transform_prefix + 'Warp.nii.gz', input_image,
+                    input_transform_prefix + '0GenericAffine.mat', input_transform_prefix + '1InverseWarp.nii.gz'],
+            parameters=(ants_new_compose_a_to_b,),
         )
+    if reference is None:
+        reference = input_image
+    else:
+        output_path = os.path.join(output_path, 'roi')
+        try:
+            os.mkdir(output_path)
+        except OSError:
+            # Exists
+            pass
+    output_labels = dict((label, storage.intermediate(os.path.join(output_path, label))) for label in labels)
+    # (input, output, interpolation order) for every image to warp
+    jobs = []
+    packed = os.path.join(source, packed_name)
+    # A single label is cheaper to warp from its own file when there is one
+    if os.path.exists(packed) and not (len(labels) == 1 and all(os.path.exists(os.path.join(source, label + '.nii.gz')) for label in labels)):
+        # All labels warp together as one bitfield volume and are split afterwards
+        output_labels['packed'] = warped_packed = storage.intermediate(os.path.join(output_path, packed_name))
+        jobs.append((packed, warped_packed, 0))
+    else:
+        jobs.extend((os.path.join(source, label + '.nii.gz'), output_labels[label], 0) for label in labels)
+    if image:
+        # Warp anatomical WMnMPRAGE_bias_corr too
+        output_labels['WMnMPRAGE_bias_corr'] = storage.intermediate(os.path.join(output_path, image_name))
+        jobs.append((os.path.join(source if prepared else os.path.join(path, subject), image_name), output_labels['WMnMPRAGE_bias_corr'], 3))
+    # Every warped image is its own step so a changed label list only warps what is new
+    parameters = (crop_padding,) if crop else ()
+    steps = [Step([output], [input_fname, combined_warp, reference], (warp_images if native else ants_apply_only_warp, order) + parameters)
+             for input_fname, output, order in jobs]
+    todo = []
+    for job, step in zip(jobs, steps):
+        if step.valid():
+            print('Skipped, using %s' % job[1])
+        else:
+            todo.append((job, step))
+    cropped = []
+    try:
+        if native and todo:
+            # Resample everything in one pass through the combined warp
+            warp_images(reference, combined_warp, *zip(*[(input_fname, step.stage(output), order) for (input_fname, output, order), step in todo]),
+                        padding=crop_padding if crop else None)
+        elif todo:
+            if crop:
+                # WarpImageMultiTransform then decompresses and prefilters the small boxes instead of the whole priors
+                inputs = [input_fname for (input_fname, output, order), step in todo]
+                cropped = [storage.intermediate(os.path.join(output_path, 'cropped_' + os.path.basename(output))) for (input_fname, output, order), step in todo]
+                crop_images(reference, combined_warp, inputs, cropped)
+                todo = [((fname, output, order), step) for fname, ((input_fname, output, order), step) in zip(cropped, todo)]
+            # OPT parallelize, or merge parallelism with subject level
+            for (input_fname, output_image, order), step in todo:
+                ants_apply_only_warp(
+                    template=reference,
+                    input_image=input_fname,
+                    input_warp=combined_warp,
+                    output_image=step.stage(output_image),
+                    switches='--use-NN' if order == 0 else '--use-BSpline',
+                    **exec_options
+                )
+        for job, step in todo:
+            step.commit()
+    finally:
+        for job, step in todo:
+            step.abort()
+        for fname in cropped:
+            if os.path.exists(fname):
+                os.remove(fname)
+    if 'packed' in output_labels:
+        # Resampling may drop the names from a prepared copy
+        names = label_names(os.path.join(rois, packed_name))
+        steps = dict((label, Step([output_labels[label]], [output_labels['packed']], (unpack_labels, names, label))) for label in labels)
+        missing = [label for label in labels if not steps[label].valid()]
+        try:
+            unpack_labels(output_labels['packed'], dict((label, steps[label].stage(output_labels[label])) for label in missing), names=names)
+            for label in missing:
+                steps[label].commit()
+        finally:
+            for label in missing:
+                steps[label].abort()
     return output_labels
 
 
-def conservative_mask(input_masks, output_path, dilation=0, fill=False):
-    """
-    Estimates a conservative maximum mask given a list of input masks.
-    - for dilation > 0 and fill=True, each side is padded by dilation instead
-    - fill will fill the bounding box of the mask producing a cube
-    """
-    # Maximum label fusion
-    # Taken from cv_registration_method.ants_label_fusions
-    # cmd = 'AverageImages 3 %s 0 %s' % (output_path, ' '.join(input_masks))
-    # cmd = 'ThresholdImage 3 %s %s 0.01 1000' % (output_path, output_path)
-    cmd = 'c3d %s -accum -max -endaccum -binarize -o %s' % (' '.join(input_masks), output_path)
-    # cmd = 'fslmaths %s -bin %s' % (' -add '.join(input_masks), output_path)
-    if sys.platform == 'linux2' or sys.platform == 'darwin':
-        parallel_command(cmd)
-    if fill:
-        # get bounding box
-        bbox = list(map(int, os.popen('fslstats %s -w' % output_path).read().strip().split()))
-        padding = (-dilation, 2 * dilation) * 3  # min index, size change for 3 spatial dimensions
-        if dilation > 0:
-            # edit bounding box
-            for i, inc in enumerate(padding):  # ignore time dimensions
-                bbox[i] += inc
-        roi = ' '.join(map(str, bbox))
-        # fill bounding box
-        cmd = 'fslmaths %s -add 1 -bin -roi %s %s' % (output_path, roi, output_path)
-    elif dilation > 0:
-        kernel = '%dx%dx%dvox' % (dilation, dilation, dilation)
-        cmd = 'c3d %s -dilate 1 %s -o %s' % (output_path, kernel, output_path)
-    if sys.platform == 'linux2' or sys.platform == 'darwin':
-        parallel_command(cmd)
-    return output_path
-
-
 def get_bounding_box(A):
     B = np.argwhere(A)
     start, stop = B.min(0), B.max(0) + 1
@@ -162,40 +202,46 @@ parser.add_argument('-w', '--warp', metavar='path', help='looks for {path}Invers
 parser.add_argument('-F', '--forcereg', action='store_true', help='force ANTS registration to WMnMPRAGE mean brain template. The --warp argument can be then used to specify the output path.')
 parser.add_argument('-p', '--processes', nargs='?', default=None, const=None, type=int, help='number of parallel processes to use.  If unspecified, automatically set to number of CPUs.')
 parser.add_argument('-v', '--verbose', action='store_true', help='verbose mode')
+parser.add_argument('--cpus', type=int, help='total cores for the ITK tools of all processes, given to a registration running alone and split between concurrent fusions.  Defaults to all cores for every tool, and is the default number of processes')
+parser.add_argument('--affinity', action='store_true', help='pin every task to its share of the first --cpus cores')
 parser.add_argument('-d', '--debug', action='store_true', help='debug mode, interactive prompts')
 parser.add_argument('-R', '--right', action='store_true', help='segment right thalamus')
+parser.add_argument('--bilateral', action='store_true', help='segment both thalami in one run sharing preprocessing, outputs go to left and right directories')
 parser.add_argument('-M', '--majorityvoting', action='store_true', help='use majority voting for joint fusion')
 parser.add_argument('-B', '--bigcrop', action='store_true', help='use bigger crop for handling large ventricles')
 parser.add_argument('--jointfusion', action='store_true', help='use older jointfusion instead of antsJointFusion')
+parser.add_argument('--groupfusion', action='store_true', help='run one multi-label antsJointFusion or jointfusion for each set of labels sharing PICSL parameters')
+parser.add_argument('--nativefusion', action='store_true', help='experimental: use the in-process joint label fusion that shares atlas weights between labels instead of antsJointFusion.  Not yet validated against antsJointFusion on real priors, see benchmark/compare_fusion.py')
+parser.add_argument('--prepared', action='store_true', help='warp priors already resampled to the template by prepare_atlas.py through the inverse registration only, instead of composing the transforms of every prior')
+parser.add_argument('--nativewarp', action='store_true', help='warp prior labels and images in-process instead of with WarpImageMultiTransform')
+parser.add_argument('--roiwarp', action='store_true', help='warp the prior thalami first and only resample the other labels and the images, and fuse, in the bounding box of the fusion mask around them')
+parser.add_argument('--cropprior', action='store_true', help='crop every prior to the region mapping into the cropped input before warping it, so only that region is decompressed and resampled')
+parser.add_argument('--topk', metavar='k', type=int, help='only warp and fuse the k priors whose WMnMPRAGEdeformed is most similar to the registered input, ranked in atlas_ranking.txt of the temporary directory')
+parser.add_argument('--profile', choices=sorted(profiles), default='default', help='antsRegistration settings for the registration to the template: fast, default, or accurate.  The profile and command are kept in the output directory as {input}Registration.txt')
 parser.add_argument('--tempdir', help='temporary directory to store registered atlases.  This will not be deleted as usual.')
 parser.add_argument('--mask', help='custom mask if 93x187x68 mask size is not wanted')
 parser.add_argument('--template', help='custom template if 93x187x68 size is not wanted')
 parser.add_argument('--output_path', help='specify a different output_path for the output file for single ROI or directory for multiple ROIs')
+parser.add_argument('--trace', metavar='prefix', help='record the time, CPU and memory of every command and task to {prefix}.jsonl and a Chrome trace {prefix}.json')
+parser.add_argument('--intermediate', choices=storage.policies, default='gz', help='how to store images in the temporary directory: gz, the default, or uncompressed nii to only spend time compressing the final outputs.  Batch mode sets it for all scans')
 # TODO handle single roi, single output file case
 # TODO fix verbose and debug
 # TODO go back to shell=False for command to suppress output and then fix sanitize labels
 
 
-def main(args, temp_path, pool):
-    input_image = orig_input_image = args.input_image
+def select_labels(args):
+    if roi['param_all'] in args.roi_names:
+        return list(roi['label_names'])
+    roi_dict = dict(list(zip(roi['param_names'], roi['label_names'])))
+    return [roi_dict[el] for el in args.roi_names]
+
 
+def select_template(args):
+    """
+    Returns the template and mask for the algorithm.
+    """
     # assigning default value of mask
     mask = mask_93
-
-    #setting up output path
-    if args.output_path:
-        output_path = args.output_path
-    else:
-        output_path = os.path.dirname(orig_input_image)
-
-    #setting up the ROIs
-    if roi['param_all'] in args.roi_names:
-        labels = list(roi['label_names'])
-    else:
-        roi_dict = dict(list(zip(roi['param_names'], roi['label_names'])))
-        labels = [roi_dict[el] for el in args.roi_names]
-
-    #setting up the template
     if args.algorithm == "v2":
         if args.template is not None and args.mask is not None:
             template = args.template
@@ -221,209 +267,705 @@ def main(args, temp_path, pool):
         print("Template is origtemplate.nii.gz")
     else:
         sys.exit("!!!!!!! Algorithm incorrectly specified !!!!!!!")
+    return template, mask
 
-    # print 'Template being used is'
-    # print os.path.abspath(template)
-
-
-    # TODO prevent both jointfusion and majority voting being set
-	# if args.jointfusion is None:
-		# print "args.jointfusion has been set (value is %s)" % args.jointfusion
-		# if args.majorityvoting is None:
-			# print "args.majorityvoting has been set (value is %s)" % args.majorityvoting
-			# sys.exit("!!!!!!! Only one label fusion can be selected at any time (default is antsJointFusion) !!!!!!!")
-	
-    if args.warp:
-        warp_path = args.warp
-    else:
-        # TODO remove this as the default behavior, instead do ANTS?
-        head, tail = os.path.split(input_image)
-        tail = tail.replace('.nii', '').replace('.gz', '') #split('.', 1)[0]
-        warp_path = os.path.join(temp_path, tail)
-
-    t = time.time()
 
-    if args.algorithm == "v2":
-        # Crop the input
+def crop_input(orig_input_image, mask, workspace):
+    """
+    Crops the input to the template mask brought over by a quick rigid registration.
+    The rigid transform, input space mask and crop are written to workspace so concurrent runs don't collide.
+    Returns the crop and the rigid transform.
+    """
+    if not os.path.exists(workspace):
+        os.makedirs(workspace)
+    rigid = os.path.join(workspace, 'rigid0GenericAffine.mat')
+    mask_input = storage.intermediate(os.path.join(workspace, 'mask_inp'))
+    file_name = os.path.basename(orig_input_image)
+    index_of_dot = file_name.index('.')
+    file_name_without_extension = file_name[:index_of_dot]
+    input_image = os.path.join(workspace, 'crop_'+file_name_without_extension+'.nii.gz')
+    sidecar = crop_sidecar(input_image)
+
+    def crop(stage):
         # Affine registering template to input
-        ants_rigid_registration(orig_input_image, orig_template)
+        ants_rigid_registration(orig_input_image, orig_template, output=stage(os.path.join(workspace, 'rigid')), **exec_options)
         print("Completed a quick rigid registration of input and full template")
-        mask_input = os.path.join(os.path.dirname(orig_input_image), 'mask_inp.nii.gz')
         # Transform mask from template space to input space
-        ants_ApplyTransforms(mask, orig_input_image, mask_input)
+        ants_ApplyTransforms(mask, orig_input_image, stage(mask_input), transform=stage(rigid), **exec_options)
         #ants_WarpImageMultiTransform(mask, mask_input, orig_input_image)
         print("Completed transforming the mask from template space to input space")
-        file_name = os.path.basename(orig_input_image)
-        index_of_dot = file_name.index('.')
-        file_name_without_extension = file_name[:index_of_dot]
-        input_image = os.path.join(os.path.dirname(orig_input_image), 'crop_'+file_name_without_extension+'.nii.gz')
         # Cropping input using this mask
-        parallel_command(crop_by_mask(orig_input_image, input_image, mask_input))
-        print('Completed cropping the input. Elapsed: %s' % timedelta(seconds=time.time()-t))
+        crop_by_mask_native(orig_input_image, stage(input_image), stage(mask_input))
+    run_step([rigid, mask_input, input_image, sidecar], crop, inputs=[orig_input_image, orig_template, mask],
+             parameters=(ants_rigid_registration, ants_ApplyTransforms, crop_by_mask_native))
+    return input_image, rigid
 
 
-    # FSL automatically converts .nii to .nii.gz
-    sanitized_image = os.path.join(temp_path, os.path.basename(input_image) + ('.gz' if input_image.endswith('.nii') else ''))
-    print('--- Reorienting image. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
-    if not os.path.exists(sanitized_image):
-        input_image = sanitize_input(input_image, sanitized_image, parallel_command)
-        if args.right:
-            print('--- Flipping along L-R. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
-            flip_lr(input_image, input_image, parallel_command)
-        print('--- Correcting bias. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
-        bias_correct(input_image, input_image, **exec_options)
-    else:
-        print('Skipped, using %s' % sanitized_image)
-        input_image = sanitized_image
+def publish(input_file, output_path):
+    """
+    Copies a workspace file to output_path, renaming into place so concurrent runs never see a partial file.
+    """
+    output_file = os.path.join(output_path, os.path.basename(input_file))
+    partial_file = output_file + '.%d.part' % os.getpid()
+    copyfile(input_file, partial_file)
+    os.rename(partial_file, output_file)
+    return output_file
 
 
-    print('--- Registering to mean brain template. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
-    if args.forcereg or not check_warps(warp_path):
-        if args.warp:
-            print('Saving output as %s' % warp_path)
-        else:
-            warp_path = os.path.join(temp_path, tail)
-            print('Saving output to temporary path.')
-        # ants_nonlinear_registration(template, input_image, warp_path, **exec_options)
-        print('temppath %s warppath %s input_image %s' % (temp_path, warp_path, input_image))
+def preprocess(input_image, temp_path, right=False):
+    """
+    Reorients, optionally flips, and bias corrects the input into temp_path.
+    """
+    sanitized_image = storage.intermediate(os.path.join(temp_path, os.path.basename(input_image)))
+
+    def correct(stage):
+        # Reoriented and flipped in-process into one uncompressed file for N4, or N4 reads the input if it's standard
+        reoriented = stage('reoriented.nii')
+        if right:
+            print('--- Flipping along L-R. ---')
+        output_image = reorient_native(input_image, reoriented, flip=right)
+        print('--- Correcting bias. ---')
+        bias_correct(output_image, stage(sanitized_image), **exec_options)
+        if os.path.exists(reoriented):
+            os.remove(reoriented)
+    return run_step([sanitized_image], correct, inputs=[input_image], parameters=(reorient_native, bias_correct, right))[0]
+
+
+def register(args, template, input_image, warp_path, temp_path, rigid=None):
+    """
+    Registers the input to the template unless cached warps from the same inputs exist and writes registered.nii.gz
+    to temp_path.
+    - rigid is the transform from crop_input that initializes the v2 registration
+    - the antsRegistration settings come from args.profile, which is written with the command to {warp_path}Registration.txt
+    """
+    if args.warp:
+        print('Saving output as %s' % warp_path)
+    else:
+        print('Saving output to temporary path.')
+    # ants_nonlinear_registration(template, input_image, warp_path, **exec_options)
+    print('temppath %s warppath %s input_image %s' % (temp_path, warp_path, input_image))
+    print('Registration profile is %s' % args.profile)
+    record = warp_path + 'Registration.txt'
 
+    def registration(stage):
         if args.algorithm == "v2":
-            ants_new_nonlinear_registration(template, input_image, warp_path, **exec_options)
+            cmd = ants_new_nonlinear_registration(template, input_image, stage(warp_path), initial=rigid, profile=args.profile, **exec_options)[-1]
         else:
-            ants_v0_nonlinear_registration(template, input_image, warp_path, **exec_options)
-
-    else:
-        print('Skipped, using %sInverseWarp.nii.gz and %sAffine.txt' % (warp_path, warp_path))
+            cmd = ants_v0_nonlinear_registration(template, input_image, stage(warp_path), profile=args.profile, **exec_options)[-1]
+        with open(stage(record), 'w') as f:
+            f.write('profile %s\n%s\n' % (args.profile, cmd))
+    warps = [warp_path + '0GenericAffine.mat', warp_path + '1Warp.nii.gz', warp_path + '1InverseWarp.nii.gz']
+    run_step(warps + [record], registration, inputs=[template, input_image, rigid],
+             parameters=(ants_new_nonlinear_registration if args.algorithm == "v2" else ants_v0_nonlinear_registration, profiles[args.profile]),
+             force=args.forcereg)
 
     # generating the warped output
-    registered = os.path.join(temp_path, 'registered.nii.gz')
-    cmd = 'WarpImageMultiTransform 3 %s %s -R %s %s1Warp.nii.gz %s0GenericAffine.mat' % (input_image, registered, template, warp_path, warp_path)
-    parallel_command(cmd)
+    registered = storage.intermediate(os.path.join(temp_path, 'registered'))
+    cmd = 'WarpImageMultiTransform 3 %s %s -R %s %s1Warp.nii.gz %s0GenericAffine.mat'
+    run_step([registered], lambda stage: parallel_command(cmd % (input_image, stage(registered), template, warp_path, warp_path)),
+             inputs=[input_image, template] + warps, parameters=(cmd,))
+    return warp_path
 
-    print('--- Warping prior labels and images. --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+
+def check_prepared(template):
+    """
+    Exits unless every prior was prepared for template by prepare_atlas.py.
+    """
+    if template not in prepared:
+        sys.exit("!!!!!!! --prepared only works with the v2 templates !!!!!!!")
+    missing = [subject for subject in subjects if not os.path.isdir(os.path.join(prior_path, subject, prepared[template]))]
+    if missing:
+        sys.exit("!!!!!!! %s not prepared for %s, run prepare_atlas.py !!!!!!!" % (', '.join(missing), os.path.basename(template)))
+
+
+def compose_target(input_image, warp_path, temp_path):
+    """
+    Composes the inverse transforms of the input's registration once into a warp shared by all prepared priors.
+    """
+    target_warp = storage.intermediate(os.path.join(temp_path, 'TemplateWarp'))
+    run_step([target_warp], lambda stage: ants_new_compose_inverse(input_image, warp_path, stage(target_warp), **exec_options),
+             inputs=[input_image, warp_path + '0GenericAffine.mat', warp_path + '1InverseWarp.nii.gz'],
+             parameters=(ants_new_compose_inverse,))
+    return target_warp
+
+
+def prior_similarity(registered, mask, priors=subjects, path=prior_path):
+    """
+    Normalized cross-correlation of the input registered to the template with every prior's WMnMPRAGEdeformed, the
+    prior in template space, over the voxels of registered within the template mask, all of them if it is empty.
+    """
+    nii = nibabel.load(registered)
+    shape = nii.shape[:3]
+    target = np.asanyarray(nii.dataobj).reshape(shape)
+    # The mask is sampled at the registered grid so either can be a crop of the other
+    mask_nii = nibabel.load(mask)
+    inside = resample(np.asanyarray(mask_nii.dataobj).reshape(mask_nii.shape[:3]),
+                      physical_to_index(grid_points(shape, nii.affine), mask_nii.affine), shape) != 0
+    if not inside.any():
+        inside[...] = True
+    index = np.nonzero(inside)
+    points = nii.affine[:3, :3].dot(np.array(index, dtype=np.float64)) + nii.affine[:3, 3:4]
+
+    def centered(values):
+        values = values.astype(np.float64)
+        values -= values.mean()
+        return values / (np.sqrt(np.dot(values, values)) or 1.)
+
+    target = centered(target[index])
+    scores = []
+    for subject in priors:
+        deformed = nibabel.load(os.path.join(path, subject, deformed_name))
+        data = np.asanyarray(deformed.dataobj).reshape(deformed.shape[:3])
+        # Trilinear, the ranking doesn't need the B-spline the warps use
+        scores.append(float(np.dot(target, centered(resample(data, physical_to_index(points, deformed.affine), (len(target),), order=1)))))
+    return scores
+
+
+def select_priors(topk, registered, mask, temp_path, priors=subjects):
+    """
+    Ranks priors by prior_similarity to the registered input into temp_path/atlas_ranking.txt, printing it, and
+    returns the topk most similar in the order of priors.
+    """
+    if topk < 1:
+        sys.exit("!!!!!!! --topk needs at least one prior !!!!!!!")
+    deformed = [os.path.join(prior_path, subject, deformed_name) for subject in priors]
+    missing = [subject for subject, fname in zip(priors, deformed) if not os.path.exists(fname)]
+    if missing:
+        sys.exit("!!!!!!! %s missing %s, needed to rank the priors for --topk !!!!!!!" % (', '.join(missing), deformed_name))
+    ranking = os.path.join(temp_path, 'atlas_ranking.txt')
+
+    def rank(stage):
+        scores = prior_similarity(registered, mask, priors)
+        with open(stage(ranking), 'w') as f:
+            for subject, score in sorted(zip(priors, scores), key=lambda pair: -pair[1]):
+                f.write('%s %.6f\n' % (subject, score))
+    run_step([ranking], rank, inputs=[registered, mask] + deformed, parameters=(prior_similarity,))
+    with open(ranking) as f:
+        ranked = [line.split() for line in f if line.strip()]
+    selected = set(subject for subject, score in ranked[:topk])
+    print('Priors ranked by similarity to %s, the top %d are fused:' % (registered, len(selected)))
+    for i, (subject, score) in enumerate(ranked):
+        print('%3d %s %s%s' % (i + 1, subject, score, ' *' if subject in selected else ''))
+    return [subject for subject in priors if subject in selected]
+
+
+def warp_tasks(args, labels, input_image, warp_path, temp_path, template=None, target_warp=None, reference=None, image=True, priors=subjects):
+    """
+    Calls of warp_atlas_subject for every one of priors.
+    - target_warp from compose_target warps the priors prepared for template
+    - reference from roi_crop only resamples the region of interest, image=False only the labels
+    """
     # TODO should probably use output from warp_atlas_subject instead of hard coding paths in create_atlas
-    # TODO make this more parallel
-    warped_labels = pool.map(partial(
-        warp_atlas_subject,
+    return [(warp_atlas_subject, (), dict(
+        subject=subject,
         path=prior_path,
         # TODO cleanup this hack to always have whole thalamus so can estimate mask
         labels=set(labels + ['1-THALAMUS']),
         input_image=input_image,
         input_transform_prefix=warp_path,
         output_path=temp_path,
+        native=args.nativewarp,
+        prepared=prepared[template] if target_warp else None,
+        target_warp=target_warp,
+        crop=args.cropprior,
+        reference=reference,
+        image=image,
         exec_options=exec_options,
-    ), subjects)
-    warped_labels = {label: {subj: d[label] for subj, d in zip(subjects, warped_labels)} for label in warped_labels[0]}
-    # # print '--- Forming subject-registered atlases. --- Elapsed: %s' % timedelta(seconds=time.time()-t)
-    # atlases = pool.map(partial(create_atlas, path=temp_path, subjects=subjects, target='', echo=exec_options['echo']),
-    # [{'label': label, 'output_atlas': os.path.join(temp_path, label+'_atlas.nii.gz')} for label in warped_labels])
-    # atlases = dict(zip(warped_labels, zip(*atlases)[0]))
-    # atlas_image = atlases['WMnMPRAGE_bias_corr']
-    atlas_images = list(warped_labels['WMnMPRAGE_bias_corr'].values())
+    )) for subject in priors]
 
-    print('--- Performing Label Fusion. --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+
+def collect_warps(warped_labels, priors=subjects):
+    """
+    Turns the outputs of warp_atlas_subject for each of priors into label -> {subject: filename}.
+    """
+    # Priors may mix packed and per-label storage, only keep what all of them have
+    return {label: {subj: d[label] for subj, d in zip(priors, warped_labels)} for label in warped_labels[0] if all(label in d for d in warped_labels)}
+
+
+def fusion_mask(warped_labels, temp_path):
+    """
+    Conservative thalamus mask from the warped priors to restrict label fusion to.
+    """
+    mask = storage.intermediate(os.path.join(temp_path, 'mask'))
+    check_run(
+        mask,
+        conservative_mask,
+        list(warped_labels['1-THALAMUS'].values()),
+        mask,
+        dilation=10,
+    )
+    return mask
+
+
+def roi_crop(mask, input_image, roi_path):
+    """
+    Crops input_image and the fusion mask to the bounding box of the mask, the region of interest --roiwarp resamples
+    the priors into and fuses in.
+    """
+    if not os.path.exists(roi_path):
+        os.makedirs(roi_path)
+    outputs = [storage.intermediate(os.path.join(roi_path, 'input')), storage.intermediate(os.path.join(roi_path, 'mask'))]
+
+    def crop(stage):
+        mask_nii = nibabel.load(mask)
+        data = load_mask(mask_nii.dataobj)
+        # An empty mask keeps the whole grid
+        box = bounding_box(data) or [(0, n) for n in data.shape]
+        region = tuple(slice(a, b) for a, b in box)
+        crop_image(nibabel.load(input_image), region).to_filename(stage(outputs[0]))
+        crop_image(mask_nii, region).to_filename(stage(outputs[1]))
+
+    return run_step(outputs, crop, inputs=[mask, input_image], parameters=(crop_image, bounding_box))
+
+
+def roi_uncrop(roi_label, input_image, output_label):
+    """
+    Pads a label fused in the region of interest back to the grid of input_image.
+    """
+    return run_step([output_label], lambda stage: save_like(uncrop_image(nibabel.load(roi_label), input_image), input_image, stage(output_label)),
+                    inputs=[roi_label, input_image], parameters=(uncrop_image,))[0]
+
+
+def roi_uncrop_tasks(labels, roi_path, input_image, temp_path):
+    """
+    Calls of roi_uncrop bringing the labels fused in roi_path back to temp_path, where fusion_tasks would have put them.
+    """
+    return [(roi_uncrop, (storage.intermediate(os.path.join(roi_path, label)), input_image, storage.intermediate(os.path.join(temp_path, label))), {})
+            for label in labels]
+
+
+def needs_mask(args):
+    """
+    Whether the selected label fusion is restricted to fusion_mask.
+    """
+    return not (args.jointfusion or args.majorityvoting)
+
+
+def fusion_tasks(args, labels, input_image, warped_labels, temp_path, mask=None, priors=subjects):
+    """
+    Returns the (function, args, kwargs) label fusion calls for the selected method, writing to temp_path/label.nii.gz,
+    or .nii, see storage.
+    - mask from fusion_mask when needs_mask(args)
+    - priors are the warped ones to fuse, by default all
+    Every call goes through check_run, so a fusion is redone only when its images or parameters change.
+    """
+    atlas_images = [warped_labels['WMnMPRAGE_bias_corr'][subj] for subj in priors]
     # FIXME use whole-brain template registration optimized parameters instead, these are from crop pipeline
     optimal_picsl = optimal['PICSL']
-    # for k, v in warped_labels.iteritems():
-    #     print k, v
-    # for label in labels:
-    #     print optimal_picsl[label]
-    if args.jointfusion:
-        pool.map(partial(label_fusion_picsl, input_image, atlas_images),
-                 [dict(
-                     atlas_labels=list(warped_labels[label].values()),
-                     output_label=os.path.join(temp_path, label + '.nii.gz'),
-                     rp=optimal_picsl[label]['rp'],
-                     rs=optimal_picsl[label]['rs'],
-                     beta=optimal_picsl[label]['beta'],
-                     **exec_options
-                 ) for label in labels])
+
+    def outputs(group):
+        return [storage.intermediate(os.path.join(temp_path, label)) for label in group]
+
+    if args.groupfusion and not (args.majorityvoting or args.nativefusion):
+        fusion = label_fusion_picsl if args.jointfusion else label_fusion_picsl_ants
+        # One multi-label fusion per distinct set of PICSL parameters, overlapping composites get their own
+        return [(check_run, (outputs(subset), label_fusion_grouped, fusion, input_image, atlas_images, warped_labels, priors), dict(
+                    labels=subset,
+                    output_path=temp_path,
+                    rp=rp,
+                    rs=rs,
+                    beta=beta,
+                    mask=mask,
+                    **exec_options
+                )) for (rp, rs, beta), group in group_labels(labels, optimal_picsl) for subset in partition_labels(group, roi['composites'])]
+    elif args.jointfusion:
+        return [(check_run, (outputs([label])[0], label_fusion_picsl, input_image, atlas_images), dict(
+                    atlas_labels=[warped_labels[label][subj] for subj in priors],
+                    output_label=outputs([label])[0],
+                    rp=optimal_picsl[label]['rp'],
+                    rs=optimal_picsl[label]['rs'],
+                    beta=optimal_picsl[label]['beta'],
+                    **exec_options
+                )) for label in labels]
     elif args.majorityvoting:
-        pool.map(partial(label_fusion_majority),
-                 [dict(
-                     atlas_labels=list(warped_labels[label].values()),
-                     output_label=os.path.join(temp_path, label + '.nii.gz'),
-                     **exec_options
-                 ) for label in labels])
-    else:
-        # Estimate mask to restrict computation
-        mask = os.path.join(temp_path, 'mask.nii.gz')
-        check_run(
-            mask,
-            conservative_mask,
-            list(warped_labels['1-THALAMUS'].values()),
-            mask,
-            dilation=10,
-        )
-        pool.map(partial(label_fusion_picsl_ants, input_image, atlas_images),
-                 [dict(
-                     atlas_labels=list(warped_labels[label].values()),
-                     output_label=os.path.join(temp_path, label + '.nii.gz'),
-                     rp=optimal_picsl[label]['rp'],
-                     rs=optimal_picsl[label]['rs'],
-                     beta=optimal_picsl[label]['beta'],
-                     mask=mask,
-                     **exec_options
-                 ) for label in labels])
-    # STEPS
-    # pool_small.map(partial(label_fusion, input_image=input_image, image_atlas=atlases['WMnMPRAGE_bias_corr'], echo=exec_options['echo']),
-    #     [{
-    #         'label_atlas': atlases[label],
-    #         'output_label': os.path.join(output_path, label+'.nii.gz'),
-    #         'sigma': optimal_steps[label]['steps_sigma'],
-    #         'X': optimal_steps[label]['steps_X'],
-    #         'mrf': optimal_steps[label]['steps_mrf'],
-    #     } for label in labels]
-    # )
-    # for label in labels:
-    #     print {
-    #         'label': label,
-    #         'sigma': optimal_steps[label]['steps_sigma'],
-    #         'X': optimal_steps[label]['steps_X'],
-    #         'mrf': optimal_steps[label]['steps_mrf'],
-    #     }
-    #     partial_fusion = partial(label_fusion, input_image=input_image, image_atlas=atlases['WMnMPRAGE_bias_corr'], echo=exec_options['echo'])
-    #     label_fusion_args = {
-    #         'label_atlas': atlases[label],
-    #         'output_label': os.path.join(output_path, label+'.nii.gz'),
-    #         'sigma': optimal_steps[label]['steps_sigma'],
-    #         'X': optimal_steps[label]['steps_X'],
-    #         'mrf': optimal_steps[label]['steps_mrf'],
-    #     } 
-    #     partial_fusion(**label_fusion_args)
-
-    files = [(os.path.join(temp_path, label + '.nii.gz'), os.path.join(output_path, label + '.nii.gz')) for label in labels]
-    if args.right:
-        pool.map(flip_lr, files)
-        files = [(os.path.join(output_path, label + '.nii.gz'), os.path.join(output_path, label + '.nii.gz')) for label in labels]
-    # Resort output to original ordering
-    pool.map(parallel_command,
-        ['%s %s %s %s' % (os.path.join(this_path, 'swapdimlike.py'), in_file, orig_input_image, out_file) for in_file, out_file in files])
-    
-    # get the vlp file path for splitting 
+        # All labels are voted in-process from one load of the warped atlases
+        return [(check_run, (outputs(labels), label_fusion_majority_native, input_image, warped_labels, priors, labels, temp_path), {})]
+    elif args.nativefusion:
+        # One weight computation per distinct set of PICSL parameters, shared by all its labels
+        return [(check_run, (outputs(group), label_fusion_native, input_image, atlas_images, warped_labels, priors), dict(
+                    labels=group,
+                    output_path=temp_path,
+                    rp=rp,
+                    rs=rs,
+                    beta=beta,
+                    mask=mask,
+                )) for (rp, rs, beta), group in group_labels(labels, optimal_picsl)]
+    return [(check_run, (outputs([label])[0], label_fusion_picsl_ants, input_image, atlas_images), dict(
+                atlas_labels=[warped_labels[label][subj] for subj in priors],
+                output_label=outputs([label])[0],
+                rp=optimal_picsl[label]['rp'],
+                rs=optimal_picsl[label]['rs'],
+                beta=optimal_picsl[label]['beta'],
+                mask=mask,
+                **exec_options
+            )) for label in labels]
+
+
+def split_vlp(output_path):
+    """
+    Splits 6-VLP of output_path into its ventral and dorsal parts 6_VLPv and 6_VLPd.
+    """
+    # get the vlp file path for splitting
     vlp_file = os.path.join(output_path, '6-VLP.nii.gz')
-                 
+    if not os.path.exists(vlp_file):
+        return
+
     # Re-orient to standard space - LR PA IS format
     san_vlp_file = os.path.join(output_path, 'san_6-VLP.nii.gz')
     input_image1 = sanitize_input(vlp_file, san_vlp_file, parallel_command)
-    
+
     # get the sanitized vlp for processing
     input_nii = nibabel.load(input_image1)
     data = input_nii.get_data()
     hdr = input_nii.get_header()
-    affine = input_nii.get_affine()    
-    
+    affine = input_nii.get_affine()
+
     # Coronal axis for RL PA IS orientation
     vlps = split_roi(data, None, 2)
     for fname, sub_vlp in zip(['6_VLPv.nii.gz', '6_VLPd.nii.gz'], vlps):
         output_nii = nibabel.Nifti1Image(sub_vlp, affine, hdr)
-        output_nii.to_filename(os.path.join(os.path.dirname(out_file), fname))
-       
+        output_nii.to_filename(os.path.join(output_path, fname))
+
+
+def output_stages(labels, temp_path, output_path, orig_input_image, right=False, flip=flip_lr):
+    """
+    Stages that flip back right hemisphere labels, reorder them like the original input and split 6-VLP.
+    """
+    files = [(storage.intermediate(os.path.join(temp_path, label)), os.path.join(output_path, label + '.nii.gz')) for label in labels]
+    if right:
+        yield 'flipping', [(flip, in_out, {}) for in_out in files]
+        files = [(os.path.join(output_path, label + '.nii.gz'), os.path.join(output_path, label + '.nii.gz')) for label in labels]
+    # Resort output to original ordering
+    yield 'reordering', [(parallel_command, ('%s %s %s %s' % (os.path.join(this_path, 'swapdimlike.py'), in_file, orig_input_image, out_file),), {})
+                         for in_file, out_file in files]
+    yield 'splitting', [(split_vlp, (output_path,), {})]
+
+
+def segment(args, temp_path):
+    """
+    The pipeline of one run, see parallel.run_pipeline.
+    """
+    input_image = orig_input_image = args.input_image
+
+    #setting up output path
+    if args.output_path:
+        output_path = args.output_path
+    else:
+        output_path = os.path.dirname(orig_input_image)
+
+    #setting up the ROIs
+    labels = select_labels(args)
+
+    #setting up the template
+    template, mask = select_template(args)
+    if args.prepared:
+        check_prepared(template)
+
+    # print 'Template being used is'
+    # print os.path.abspath(template)
+
+
+    # TODO prevent both jointfusion and majority voting being set
+	# if args.jointfusion is None:
+		# print "args.jointfusion has been set (value is %s)" % args.jointfusion
+		# if args.majorityvoting is None:
+			# print "args.majorityvoting has been set (value is %s)" % args.majorityvoting
+			# sys.exit("!!!!!!! Only one label fusion can be selected at any time (default is antsJointFusion) !!!!!!!")
+
+    if args.warp:
+        warp_path = args.warp
+    else:
+        # TODO remove this as the default behavior, instead do ANTS?
+        head, tail = os.path.split(input_image)
+        tail = tail.replace('.nii', '').replace('.gz', '') #split('.', 1)[0]
+        warp_path = os.path.join(temp_path, tail)
+
+    t = time.time()
+
+    rigid = None
+    crop_path = os.path.join(temp_path, 'crop')
+    if args.algorithm == "v2":
+        # Crop the input
+        [(input_image, rigid)] = yield 'cropping', [(crop_input, (orig_input_image, mask, crop_path), {})]
+        print('Completed cropping the input. Elapsed: %s' % timedelta(seconds=time.time()-t))
+
+    print('--- Reorienting image. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
+    [input_image] = yield 'preprocessing', [(preprocess, (input_image, temp_path, args.right), {})]
+
+    print('--- Registering to mean brain template. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
+    [warp_path] = yield 'registering', [(register, (args, template, input_image, warp_path, temp_path, rigid), {})]
+
+    priors = subjects
+    if args.topk:
+        print('--- Selecting the priors most similar to the input. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
+        [priors] = yield 'selecting', [(select_priors, (args.topk, storage.intermediate(os.path.join(temp_path, 'registered')), mask, temp_path), {})]
+
+    target_warp = None
+    if args.prepared:
+        [target_warp] = yield 'composing', [(compose_target, (input_image, warp_path, temp_path), {})]
+
+    fusion_input, fusion_path, fusion_masks = input_image, temp_path, [None]
+    reference = None
+    if args.roiwarp:
+        print('--- Warping prior thalami to find the region of interest. --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+        thalami = collect_warps((yield 'outlining', warp_tasks(args, ['1-THALAMUS'], input_image, warp_path, temp_path, template, target_warp, image=False, priors=priors)), priors)
+        fusion_masks = yield 'masking', [(fusion_mask, (thalami, temp_path), {})]
+        fusion_path = os.path.join(temp_path, 'roi')
+        [(reference, roi_mask)] = yield 'bounding', [(roi_crop, (fusion_masks[0], input_image, fusion_path), {})]
+        fusion_input, fusion_masks = reference, [roi_mask]
+
+    print('--- Warping prior labels and images. --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+    warped_labels = collect_warps((yield 'warping', warp_tasks(args, labels, input_image, warp_path, temp_path, template, target_warp, reference, priors=priors)), priors)
+
+    print('--- Performing Label Fusion. --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+    if needs_mask(args) and not args.roiwarp:
+        # Estimate mask to restrict computation
+        fusion_masks = yield 'masking', [(fusion_mask, (warped_labels, temp_path), {})]
+    yield 'fusing', fusion_tasks(args, labels, fusion_input, warped_labels, fusion_path, fusion_masks[0] if needs_mask(args) else None, priors)
+    if args.roiwarp:
+        yield 'uncropping', roi_uncrop_tasks(labels, fusion_path, input_image, temp_path)
+
+    for stage in output_stages(labels, temp_path, output_path, orig_input_image, args.right):
+        yield stage
+    # The csh wrappers pick up the crop, its mask and rigid transform beside the labels, with the registration settings
+    published = [warp_path + 'Registration.txt']
+    if args.algorithm == "v2":
+        published += glob(os.path.join(crop_path, '*'))
+    yield 'publishing', [(publish, (fname, output_path), {}) for fname in published]
+    # thomas.nii.gz, thomasfull.nii.gz and nucleiVols.txt, which the csh wrappers then take instead of running
+    # fuselabels and fslstats, as for --bilateral only v2 crops
+    yield 'summarizing', [(finish_hemisphere, (output_path, output_path if args.algorithm == "v2" else None, roi['label_names']), {})]
+
     print('--- Finished --- Elapsed: %s' % timedelta(seconds=time.time() - t))
 
 
+def flip_lr_native(input_image, output_image):
+    """
+    Flips the voxels of the first axis keeping the header, the same mirroring flip_lr does with fslswapdim -x y z.
+    """
+    nii = nibabel.load(input_image)
+    data = np.asanyarray(nii.dataobj)[::-1]
+    nibabel.Nifti1Image(data, nii.affine, nii.header).to_filename(output_image)
+    return output_image
+
+
+def mirror(input_image, output_image):
+    """
+    flip_lr_native as a cached step.
+    """
+    return run_step([output_image], lambda stage: flip_lr_native(input_image, stage(output_image)),
+                    inputs=[input_image], parameters=(flip_lr_native,))[0]
+
+
+def segment_bilateral(args, temp_path):
+    """
+    The pipeline segmenting both thalami sharing the crop, reorientation and bias correction, with both hemispheres'
+    registrations, warps and fusions in the same stages.  Outputs go to left/ and right/ of the output path.
+    """
+    orig_input_image = args.input_image
+    output_path = args.output_path if args.output_path else os.path.dirname(orig_input_image)
+    labels = select_labels(args)
+    template, mask = select_template(args)
+    if args.prepared:
+        check_prepared(template)
+    t = time.time()
+
+    input_image = orig_input_image
+    rigid = None
+    crop_path = os.path.join(temp_path, 'crop')
+    if args.algorithm == "v2":
+        [(input_image, rigid)] = yield 'cropping', [(crop_input, (orig_input_image, mask, crop_path), {})]
+        print('Completed cropping the input. Elapsed: %s' % timedelta(seconds=time.time()-t))
+
+    sides = ('left', 'right')
+    temps = dict((side, os.path.join(temp_path, side)) for side in sides)
+    outputs = dict((side, os.path.join(output_path, side)) for side in sides)
+    for path in list(temps.values()) + list(outputs.values()):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    print('--- Reorienting and correcting bias once. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
+    [left] = yield 'preprocessing', [(preprocess, (input_image, temps['left']), {})]
+    inputs = {'left': left, 'right': os.path.join(temps['right'], os.path.basename(left))}
+    yield 'flipping', [(mirror, (inputs['left'], inputs['right']), {})]
+
+    tail = os.path.basename(input_image).replace('.nii', '').replace('.gz', '')
+    print('--- Registering both hemispheres to mean brain template. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
+    warp_paths = dict(zip(sides, (yield 'registering', [
+        (register, (args, template, inputs[side], os.path.join(temps[side], tail), temps[side], rigid), {}) for side in sides])))
+
+    priors = dict((side, subjects) for side in sides)
+    if args.topk:
+        print('--- Selecting the priors most similar to each hemisphere. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
+        priors = dict(zip(sides, (yield 'selecting', [
+            (select_priors, (args.topk, storage.intermediate(os.path.join(temps[side], 'registered')), mask, temps[side]), {}) for side in sides])))
+
+    target_warps = dict((side, None) for side in sides)
+    if args.prepared:
+        target_warps = dict(zip(sides, (yield 'composing', [(compose_target, (inputs[side], warp_paths[side], temps[side]), {}) for side in sides])))
+
+    fusion_inputs, fusion_paths, fusion_masks = dict(inputs), dict(temps), dict((side, None) for side in sides)
+    references = dict((side, None) for side in sides)
+    if args.roiwarp:
+        print('--- Warping prior thalami to find the regions of interest. --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+        tasks = [warp_tasks(args, ['1-THALAMUS'], inputs[side], warp_paths[side], temps[side], template, target_warps[side], image=False, priors=priors[side])
+                 for side in sides]
+        warped = yield 'outlining', tasks[0] + tasks[1]
+        thalami = {'left': collect_warps(warped[:len(tasks[0])], priors['left']), 'right': collect_warps(warped[len(tasks[0]):], priors['right'])}
+        fusion_masks = dict(zip(sides, (yield 'masking', [(fusion_mask, (thalami[side], temps[side]), {}) for side in sides])))
+        fusion_paths = dict((side, os.path.join(temps[side], 'roi')) for side in sides)
+        cropped = dict(zip(sides, (yield 'bounding', [(roi_crop, (fusion_masks[side], inputs[side], fusion_paths[side]), {}) for side in sides])))
+        references = fusion_inputs = dict((side, cropped[side][0]) for side in sides)
+        fusion_masks = dict((side, cropped[side][1]) for side in sides)
+
+    print('--- Warping prior labels and images. --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+    tasks = [warp_tasks(args, labels, inputs[side], warp_paths[side], temps[side], template, target_warps[side], references[side], priors=priors[side])
+             for side in sides]
+    warped = yield 'warping', tasks[0] + tasks[1]
+    warped_labels = {'left': collect_warps(warped[:len(tasks[0])], priors['left']), 'right': collect_warps(warped[len(tasks[0]):], priors['right'])}
+
+    print('--- Performing Label Fusion. --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+    if needs_mask(args) and not args.roiwarp:
+        fusion_masks = dict(zip(sides, (yield 'masking', [(fusion_mask, (warped_labels[side], temps[side]), {}) for side in sides])))
+    yield 'fusing', [task for side in sides for task in fusion_tasks(args, labels, fusion_inputs[side], warped_labels[side], fusion_paths[side],
+                                                                     fusion_masks[side] if needs_mask(args) else None, priors[side])]
+    if args.roiwarp:
+        yield 'uncropping', [task for side in sides for task in roi_uncrop_tasks(labels, fusion_paths[side], inputs[side], temps[side])]
+
+    for side in sides:
+        for stage in output_stages(labels, temps[side], outputs[side], orig_input_image, side == 'right', flip=flip_lr_native):
+            yield stage
+    # Keep the crop, its mask and the registration with the results like the csh wrappers
+    yield 'publishing', [(publish, (fname, outputs[side]), {}) for side in sides
+                         for fname in glob(os.path.join(crop_path, '*')) + [storage.intermediate(os.path.join(temps[side], 'registered'))] + glob(warp_paths[side] + '*')
+                         if os.path.exists(fname)]
+    # Only v2 crops, a sidecar left in the output directory by an earlier v2 run must not uncrop a v0 one
+    yield 'summarizing', [(finish_hemisphere, (outputs[side], outputs[side] if args.algorithm == "v2" else None, roi['label_names'], 'r' if side == 'right' else ''), {})
+                          for side in sides]
+    if args.algorithm == "v2":
+        # Template brought to the crop to check the registration
+        yield 'checking', [(parallel_command, ('antsApplyTransforms -d 3 -i %s -r %s -o %s -t [%s0GenericAffine.mat, 1] -t %s1InverseWarp.nii.gz' % (
+            template, input_image, os.path.join(outputs[side], 'regn.nii.gz'), warp_paths[side], warp_paths[side]),), {}) for side in sides]
+    print('--- Finished --- Elapsed: %s' % timedelta(seconds=time.time() - t))
+
+
+def make_temp_path(args):
+    if args.tempdir:
+        temp_path = args.tempdir
+        if not os.path.exists(temp_path):
+            print('Making %s' % os.path.abspath(temp_path))
+            os.makedirs(temp_path)
+        return temp_path
+    return tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(args.output_path or args.input_image)))
+
+
+def remove_temp_path(args, temp_path):
+    # Clean up temp folders
+    if not args.debug and not args.tempdir:
+        try:
+            rmtree(temp_path)
+        except OSError as exc:
+            if exc.errno != 2:  # Code 2 - no such file or directory
+                raise
+
+
+def run(args):
+    """
+    The pipeline of a command line, including its temporary directory which is removed afterwards as usual.
+    """
+    if args.nativefusion:
+        print('!!!!!!! --nativefusion is experimental and not yet validated against antsJointFusion, see benchmark/compare_fusion.py !!!!!!!')
+    temp_path = make_temp_path(args)
+    try:
+        pipeline = segment_bilateral(args, temp_path) if args.bilateral else segment(args, temp_path)
+        results = None
+        while True:
+            try:
+                stage = pipeline.send(results)
+            except StopIteration:
+                break
+            results = yield stage
+    finally:
+        remove_temp_path(args, temp_path)
+
+
+batch_parser = argparse.ArgumentParser(prog='THOMAS.py batch', description='Segment every scan of a manifest with one scheduler overlapping the stages of different scans.')
+batch_parser.add_argument('manifest', help='text file with the arguments of one THOMAS.py run per line, e.g. "subj1/WMnMPRAGE.nii.gz ALL -a v2 --jointfusion".  Blank lines and lines starting with # are ignored.')
+batch_parser.add_argument('-p', '--processes', nargs='?', default=None, const=None, type=int, help='number of parallel processes to use for all scans.  If unspecified, automatically set to number of CPUs.')
+batch_parser.add_argument('-s', '--scans', type=int, help='maximum number of scans in progress at once, defaults to the number of processes')
+batch_parser.add_argument('--status', help='file kept up to date with the stage of every scan, defaults to the manifest with .status appended')
+batch_parser.add_argument('-v', '--verbose', action='store_true', help='verbose mode')
+batch_parser.add_argument('--cpus', type=int, help='total cores for the ITK tools of all processes, given to a registration running alone and split between the tasks of all scans running at once.  Defaults to all cores for every tool, and is the default number of processes')
+batch_parser.add_argument('--affinity', action='store_true', help='pin every task to its share of the first --cpus cores')
+batch_parser.add_argument('--trace', metavar='prefix', help='record the time, CPU and memory of every command and task to {prefix}.jsonl and a Chrome trace {prefix}.json')
+batch_parser.add_argument('--intermediate', choices=storage.policies, default='gz', help='how to store images in the temporary directories, see THOMAS.py -h')
+# Options of the whole process, set once for the pool of the batch rather than on manifest lines
+batch_options = ('processes', 'verbose', 'debug', 'cpus', 'affinity', 'trace', 'intermediate')
+
+
+def read_manifest(manifest):
+    """
+    Parses every run of a manifest up front so that a typo stops the batch before anything starts.  Lines setting
+    batch_options are rejected, as the batch would silently ignore them.
+    """
+    runs = []
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            run_args = parser.parse_args(shlex.split(line))
+            ignored = [dest for dest in batch_options if getattr(run_args, dest) != parser.get_default(dest)]
+            if ignored:
+                sys.exit("!!!!!!! %s sets %s, give %s to THOMAS.py batch instead !!!!!!!" % (
+                    line, ', '.join('--' + dest for dest in ignored), 'them' if len(ignored) > 1 else 'it'))
+            runs.append((line, run_args))
+    return runs
+
+
+def batch(batch_args, pool):
+    """
+    Runs every line of the manifest with parallel.run_pipelines, writing a tab separated status line per scan.
+    """
+    runs = read_manifest(batch_args.manifest)
+    status_file = batch_args.status or batch_args.manifest + '.status'
+    t = time.time()
+    status = dict((line, ['queued', t, '']) for line, _ in runs)
+
+    def update(line, stage, error):
+        if status[line][0] == 'queued':
+            # Time scans from when they start rather than from when the batch did
+            status[line][1] = time.time()
+        if error is not None:
+            status[line][0] = 'failed'
+            print('!!!!!!! Failed %s !!!!!!!\n%s' % (line, error))
+        else:
+            status[line][0] = stage if stage is not None else 'done'
+            print('--- %s: %s --- Elapsed: %s' % (line, status[line][0], timedelta(seconds=time.time() - t)))
+        if status[line][0] in ('done', 'failed'):
+            status[line][2] = timedelta(seconds=time.time() - status[line][1])
+        with open(status_file + '.part', 'w') as f:
+            for run_line, _ in runs:
+                f.write('%s\t%s\t%s\n' % (run_line, status[run_line][0], status[run_line][2]))
+        os.rename(status_file + '.part', status_file)
+
+    failed = parallel.run_pipelines(pool, [(line, run(run_args)) for line, run_args in runs], batch_args.scans, update)
+    print('--- Finished %d of %d scans --- Elapsed: %s' % (len(runs) - len(failed), len(runs), timedelta(seconds=time.time() - t)))
+    return failed
+
+
+# Defaults for when functions are used from other scripts, updated by the command-line options
+exec_options = {'echo': False, 'suppress': True}
+parallel_command = partial(parallel.command, **exec_options)
+
+
 if __name__ == '__main__':
-    args = parser.parse_args()
+    batch_mode = len(sys.argv) > 1 and sys.argv[1] == 'batch'
+    if batch_mode:
+        args = batch_parser.parse_args(sys.argv[2:])
+        args.debug = False
+    else:
+        args = parser.parse_args()
     # print args
     # exec_options.update({'debug': args.debug, 'verbose': args.verbose})
     exec_options = {'echo': False, 'suppress': True}
@@ -434,27 +976,31 @@ if __name__ == '__main__':
         # exec_options['echo'] = True
         args.processes = 1
     parallel_command = partial(parallel.command, **exec_options)
-    pool = parallel.BetterPool(args.processes)
+    if args.trace:
+        # Set before the pool starts so its workers and their commands inherit it
+        os.environ[tracing.trace_variable] = os.path.abspath(args.trace)
+        if os.path.exists(os.environ[tracing.trace_variable] + '.jsonl'):
+            os.remove(os.environ[tracing.trace_variable] + '.jsonl')
+    # Like the trace, set before the pool starts for its workers
+    os.environ[storage.policy_variable] = args.intermediate
+    pool = parallel.BetterPool(args.processes, cpus=args.cpus, affinity=args.affinity)
     print('Running with %d processes.' % pool._processes)
+    if args.cpus:
+        print('Sharing %d cores between their tools%s.' % (args.cpus, ', pinned' if args.affinity else ''))
     # TODO don't hard code this number of processors
     # pool_small = parallel.BetterPool(4)
     # TODO Add path of script to command()
     # os.environ['PATH'] += os.pathsep + os.path.abspath(os.path.dirname(sys.argv[0]))
-    if args.tempdir:
-        temp_path = args.tempdir
-        if not os.path.exists(temp_path):
-            print('Making %s' % os.path.abspath(temp_path))
-            os.makedirs(temp_path)
-    else:
-        temp_path = tempfile.mkdtemp(dir=os.path.dirname(args.output_path))
     try:
-        main(args, temp_path, pool)
+        if batch_mode:
+            failed = batch(args, pool)
+        else:
+            parallel.run_pipeline(pool, run(args))
     finally:
         pool.close()
-        # Clean up temp folders
-        if not args.debug and not args.tempdir:
-            try:
-                rmtree(temp_path)
-            except OSError as exc:
-                if exc.errno != 2:  # Code 2 - no such file or directory
-                    raise
+        if args.trace and os.path.exists(os.environ[tracing.trace_variable] + '.jsonl'):
+            trace = os.environ[tracing.trace_variable]
+            print('\n'.join(tracing.summarize(trace + '.jsonl')))
+            print('Trace written to %s' % tracing.export_chrome(trace + '.jsonl', trace + '.json'))
+    if batch_mode and failed:
+        sys.exit(1)
@@ -6,26 +6,36 @@ import shelve
 
 
 image_name = 'WMnMPRAGE_bias_corr.nii.gz'
+# All of a prior's sanitized_rois packed into one volume, see pack_priors.py
+packed_name = 'packed_rois.nii.gz'
+# A prior's image deformed into the space of origtemplate, which --topk ranks the priors by
+deformed_name = 'WMnMPRAGEdeformed.nii.gz'
 # Find path for priors
 this_path = os.path.dirname(os.path.realpath(__file__))
-orig_template = os.path.join(this_path, 'origtemplate.nii.gz')
+# Templates, priors and parameters can come from elsewhere, e.g. the synthetic data of benchmark/phantoms.py
+data_path = os.environ.get('THOMAS_DATA', this_path)
+orig_template = os.path.join(data_path, 'origtemplate.nii.gz')
 assert os.path.exists(orig_template)
-template_61 = os.path.join(this_path, 'templ_61x91x62.nii.gz')
+template_61 = os.path.join(data_path, 'templ_61x91x62.nii.gz')
 assert os.path.exists(template_61)
-template_93 = os.path.join(this_path, 'templ_93x187x68.nii.gz')
+template_93 = os.path.join(data_path, 'templ_93x187x68.nii.gz')
 assert os.path.exists(template_93)
-template_93b = os.path.join(this_path, 'p15_templ_93x187x68.nii.gz')
+template_93b = os.path.join(data_path, 'p15_templ_93x187x68.nii.gz')
 assert os.path.exists(template_93b)
-mask_61 = os.path.join(this_path, 'mask_templ_61x91x62.nii.gz')
+mask_61 = os.path.join(data_path, 'mask_templ_61x91x62.nii.gz')
 assert os.path.exists(mask_61)
-mask_93 = os.path.join(this_path, 'mask_templ_93x187x68.nii.gz')
+mask_93 = os.path.join(data_path, 'mask_templ_93x187x68.nii.gz')
 assert os.path.exists(mask_93)
-mask_93b = os.path.join(this_path, 'mask_templ_93x187x68_p15.nii.gz')
+mask_93b = os.path.join(data_path, 'mask_templ_93x187x68_p15.nii.gz')
 assert os.path.exists(mask_93b)
-prior_path = os.path.join(this_path, 'priors/')
+prior_path = os.path.join(data_path, 'priors/')
 assert os.path.exists(prior_path)
-subjects = [el for el in os.listdir(prior_path) if os.path.isdir(os.path.join(prior_path, el)) and not el.startswith('.')]
+# Priors to leave out, comma separated, e.g. the target of a leave-one-out run of crossvalidate.py
+excluded = os.environ.get('THOMAS_EXCLUDE', '').split(',')
+subjects = [el for el in os.listdir(prior_path) if os.path.isdir(os.path.join(prior_path, el)) and not el.startswith('.') and el not in excluded]
 assert len(subjects) > 0
+# Directory of every prior with its labels and image resampled to a crop template's grid, see prepare_atlas.py
+prepared = {template_93: 'prepared_93x187x68', template_93b: 'prepared_93x187x68_p15'}
 
 # Names for command-line options and label filenmaes
 roi = {
@@ -34,9 +44,14 @@ roi = {
     'label_names': ('1-THALAMUS', '2-AV', '4-VA', '5-VLa', '6-VLP', '7-VPL', '4567-VL', '8-Pul', '9-LGN', '10-MGN', '11-CM', '12-MD-Pf', '13-Hb', '14-MTT'),
     }
 roi_choices = (roi['param_all'],)+roi['param_names']
+# Labels that are the union of other labels and so overlap them
+roi['composites'] = {
+    '1-THALAMUS': roi['label_names'][1:],
+    '4567-VL': ('4-VA', '5-VLa', '6-VLP', '7-VPL'),
+    }
 
 # Optimized hyper-parameters for PICSL
-db = shelve.open(os.path.join(this_path, 'cv_optimal_picsl_parameters.shelve'), 'r')
+db = shelve.open(os.path.join(data_path, 'cv_optimal_picsl_parameters.shelve'), 'r')
 optimal = dict(db)
 db.close()
 
@@ -9,11 +9,15 @@ import argparse
 import tempfile
 import time
 import libraries.parallel as parallel
-from shutil import rmtree
+from glob import glob
+from shutil import rmtree, copyfile
 from functools import partial
 from datetime import timedelta
-from libraries.imgtools import check_run, check_warps, sanitize_input, flip_lr, label_fusion_picsl_ants, label_fusion_picsl, ants_compose_a_to_b , ants_new_compose_a_to_b, ants_apply_only_warp, ants_WarpImageMultiTransform, ants_ApplyTransforms, crop_by_mask, label_fusion_majority
-from libraries.ants_nonlinear import ants_mi_nonlinear_registration, ants_new_nonlinear_registration, ants_v0_nonlinear_registration, bias_correct, ants_linear_registration, ants_new_rigid_registration, ants_rigid_registration
+from libraries.imgtools import check_run, check_warps, sanitize_input, flip_lr, reorient_native, label_fusion_picsl_ants, label_fusion_picsl, ants_compose_a_to_b , ants_new_compose_a_to_b, ants_apply_only_warp, ants_WarpImageMultiTransform, ants_ApplyTransforms, crop_by_mask_native
+from libraries.fusion import label_fusion_majority_native
+from libraries.masks import conservative_mask
+from libraries.nuclei import finish_hemisphere
+from libraries.ants_nonlinear import profiles, ants_mi_nonlinear_registration, ants_new_nonlinear_registration, ants_v0_nonlinear_registration, bias_correct, ants_linear_registration, ants_new_rigid_registration, ants_rigid_registration
 from THOMAS_constants import image_name, orig_template, template_93, mask_93, template_93b, mask_93b, this_path, prior_path, subjects, roi, roi_choices, optimal
 import nibabel
 import numpy as np
@@ -75,39 +79,6 @@ def warp_atlas_subject(subject, path, labels, input_image, input_transform_prefi
     return output_labels
 
 
-def conservative_mask(input_masks, output_path, dilation=0, fill=False):
-    """
-    Estimates a conservative maximum mask given a list of input masks.
-    - for dilation > 0 and fill=True, each side is padded by dilation instead
-    - fill will fill the bounding box of the mask producing a cube
-    """
-    # Maximum label fusion
-    # Taken from cv_registration_method.ants_label_fusions
-    # cmd = 'AverageImages 3 %s 0 %s' % (output_path, ' '.join(input_masks))
-    # cmd = 'ThresholdImage 3 %s %s 0.01 1000' % (output_path, output_path)
-    cmd = 'c3d %s -accum -max -endaccum -binarize -o %s' % (' '.join(input_masks), output_path)
-    # cmd = 'fslmaths %s -bin %s' % (' -add '.join(input_masks), output_path)
-    if sys.platform == 'linux2' or sys.platform == 'darwin':
-        parallel_command(cmd)
-    if fill:
-        # get bounding box
-        bbox = list(map(int, os.popen('fslstats %s -w' % output_path).read().strip().split()))
-        padding = (-dilation, 2 * dilation) * 3  # min index, size change for 3 spatial dimensions
-        if dilation > 0:
-            # edit bounding box
-            for i, inc in enumerate(padding):  # ignore time dimensions
-                bbox[i] += inc
-        roi = ' '.join(map(str, bbox))
-        # fill bounding box
-        cmd = 'fslmaths %s -add 1 -bin -roi %s %s' % (output_path, roi, output_path)
-    elif dilation > 0:
-        kernel = '%dx%dx%dvox' % (dilation, dilation, dilation)
-        cmd = 'c3d %s -dilate 1 %s -o %s' % (output_path, kernel, output_path)
-    if sys.platform == 'linux2' or sys.platform == 'darwin':
-        parallel_command(cmd)
-    return output_path
-
-
 def get_bounding_box(A):
     B = np.argwhere(A)
     start, stop = B.min(0), B.max(0) + 1
@@ -163,11 +134,14 @@ parser.add_argument('-w', '--warp', metavar='path', help='looks for {path}Invers
 parser.add_argument('-F', '--forcereg', action='store_true', help='force ANTS registration to WMnMPRAGE mean brain template. The --warp argument can be then used to specify the output path.')
 parser.add_argument('-p', '--processes', nargs='?', default=None, const=None, type=int, help='number of parallel processes to use.  If unspecified, automatically set to number of CPUs.')
 parser.add_argument('-v', '--verbose', action='store_true', help='verbose mode')
+parser.add_argument('--cpus', type=int, help='total cores for the ITK tools of all processes, given to a registration running alone and split between concurrent fusions.  Defaults to all cores for every tool, and is the default number of processes')
+parser.add_argument('--affinity', action='store_true', help='pin every task to its share of the first --cpus cores')
 parser.add_argument('-d', '--debug', action='store_true', help='debug mode, interactive prompts')
 parser.add_argument('-R', '--right', action='store_true', help='segment right thalamus')
 parser.add_argument('-M', '--majorityvoting', action='store_true', help='use majority voting for joint fusion')
 parser.add_argument('-B', '--bigcrop', action='store_true', help='use big crop for mask and template')
 parser.add_argument('--jointfusion', action='store_true', help='use older jointfusion instead of antsJointFusion')
+parser.add_argument('--profile', choices=sorted(profiles), default='default', help='antsRegistration settings for the registration to the template: fast, default, or accurate.  The profile and command are kept in the output directory as {input}Registration.txt')
 parser.add_argument('--tempdir', help='temporary directory to store registered atlases.  This will not be deleted as usual.')
 parser.add_argument('--mask', help='custom mask if 93x187x68 mask size is not wanted')
 parser.add_argument('--template', help='custom template if 93x187x68 size is not wanted')
@@ -245,35 +219,42 @@ def main(args, temp_path, pool):
 
     t = time.time()
 
+    # The rigid transform, input space mask and crop stay in the workspace so concurrent runs don't collide
+    crop_path = os.path.join(temp_path, 'crop')
     if args.algorithm == "v2":
         # Crop the input
+        if not os.path.exists(crop_path):
+            os.makedirs(crop_path)
         # Affine registering template to input
-        ants_new_rigid_registration(orig_input_image, orig_template)
+        _, rigid, _ = ants_new_rigid_registration(orig_input_image, orig_template, output=os.path.join(crop_path, 'rigid'), **exec_options)
         print("Completed a quick rigid registration of input and full template")
-        mask_input = os.path.join(os.path.dirname(orig_input_image), 'mask_inp.nii.gz')
+        mask_input = os.path.join(crop_path, 'mask_inp.nii.gz')
         # Transform mask from template space to input space
-        ants_ApplyTransforms(mask, orig_input_image, mask_input)
+        ants_ApplyTransforms(mask, orig_input_image, mask_input, transform=rigid, **exec_options)
         #ants_WarpImageMultiTransform(mask, mask_input, orig_input_image)
         print("Completed transforming the mask from template space to input space")
         file_name = os.path.basename(orig_input_image)
         index_of_dot = file_name.index('.')
         file_name_without_extension = file_name[:index_of_dot]
-        input_image = os.path.join(os.path.dirname(orig_input_image), 'crop_'+file_name_without_extension+'.nii.gz')
+        input_image = os.path.join(crop_path, 'crop_'+file_name_without_extension+'.nii.gz')
         # Cropping input using this mask
-        parallel_command(crop_by_mask(orig_input_image, input_image, mask_input))
+        crop_by_mask_native(orig_input_image, input_image, mask_input)
         print('Completed cropping the input. Elapsed: %s' % timedelta(seconds=time.time()-t))
 
 
-    # FSL automatically converts .nii to .nii.gz
+    # Named like FSL, which automatically converts .nii to .nii.gz
     sanitized_image = os.path.join(temp_path, os.path.basename(input_image) + ('.gz' if input_image.endswith('.nii') else ''))
     print('--- Reorienting image. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
     if not os.path.exists(sanitized_image):
-        input_image = sanitize_input(input_image, sanitized_image, parallel_command)
+        reoriented = os.path.join(temp_path, 'reoriented.nii')
         if args.right:
             print('--- Flipping along L-R. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
-            flip_lr(input_image, input_image, parallel_command)
+        reoriented = reorient_native(input_image, reoriented, flip=args.right)
         print('--- Correcting bias. --- Elapsed: %s' % timedelta(seconds=time.time()-t))
-        bias_correct(input_image, input_image, **exec_options)
+        bias_correct(reoriented, sanitized_image, **exec_options)
+        if reoriented != input_image:
+            os.remove(reoriented)
+        input_image = sanitized_image
     else:
         print('Skipped, using %s' % sanitized_image)
         input_image = sanitized_image
@@ -288,11 +269,15 @@ def main(args, temp_path, pool):
             print('Saving output to temporary path.')
         # ants_nonlinear_registration(template, input_image, warp_path, **exec_options)
         print('temppath %s warppath %s input_image %s' % (temp_path, warp_path, input_image))
+        print('Registration profile is %s' % args.profile)
 
         if args.algorithm == "v2":
-            ants_mi_nonlinear_registration(template, input_image, warp_path, **exec_options)
+            _, _, cmd = ants_mi_nonlinear_registration(template, input_image, warp_path, initial=rigid, profile=args.profile, **exec_options)
         else:
-            ants_v0_nonlinear_registration(template, input_image, warp_path, **exec_options)
+            _, _, cmd = ants_v0_nonlinear_registration(template, input_image, warp_path, profile=args.profile, **exec_options)
+        # Kept with the outputs like the crop
+        with open(os.path.join(output_path, os.path.basename(warp_path) + 'Registration.txt'), 'w') as f:
+            f.write('profile %s\n%s\n' % (args.profile, cmd))
 
     else:
         print('Skipped, using %sInverseWarp.nii.gz and %sAffine.txt' % (warp_path, warp_path))
@@ -341,12 +326,8 @@ def main(args, temp_path, pool):
                      **exec_options
                  ) for label in labels])
     elif args.majorityvoting:
-        pool.map(partial(label_fusion_majority),
-                 [dict(
-                     atlas_labels=list(warped_labels[label].values()),
-                     output_label=os.path.join(temp_path, label + '.nii.gz'),
-                     **exec_options
-                 ) for label in labels])
+        # All labels are voted in-process from one load of the warped atlases
+        label_fusion_majority_native(input_image, warped_labels, subjects, labels, temp_path)
     else:
         # Estimate mask to restrict computation
         mask = os.path.join(temp_path, 'mask.nii.gz')
@@ -421,6 +402,16 @@ def main(args, temp_path, pool):
         output_nii = nibabel.Nifti1Image(sub_vlp, affine, hdr)
         output_nii.to_filename(os.path.join(os.path.dirname(out_file), fname))
        
+    if args.algorithm == "v2":
+        # The csh wrappers pick up the crop, its mask and rigid transform beside the labels
+        for fname in glob(os.path.join(crop_path, '*')):
+            output_file = os.path.join(output_path, os.path.basename(fname))
+            copyfile(fname, output_file + '.%d.part' % os.getpid())
+            os.rename(output_file + '.%d.part' % os.getpid(), output_file)
+    # thomas.nii.gz, thomasfull.nii.gz and nucleiVols.txt, which the csh wrappers then take instead of running
+    # fuselabels and fslstats
+    finish_hemisphere(output_path, output_path if args.algorithm == "v2" else None, roi['label_names'])
+
     print('--- Finished --- Elapsed: %s' % timedelta(seconds=time.time() - t))
 
 
@@ -436,8 +427,12 @@ if __name__ == '__main__':
         # exec_options['echo'] = True
         args.processes = 1
     parallel_command = partial(parallel.command, **exec_options)
-    pool = parallel.BetterPool(args.processes)
+    pool = parallel.BetterPool(args.processes, cpus=args.cpus, affinity=args.affinity)
     print('Running with %d processes.' % pool._processes)
+    if args.cpus:
+        print('Sharing %d cores between their tools%s.' % (args.cpus, ', pinned' if args.affinity else ''))
+        # The registrations run here alone
+        parallel.current['threads'] = args.cpus
     # TODO don't hard code this number of processors
     # pool_small = parallel.BetterPool(4)
     # TODO Add path of script to command()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Checks the in-process joint label fusion of --nativefusion against antsJointFusion on the same inputs.  THOMAS.py
+segments a scan once with antsJointFusion and once with --nativefusion sharing one --tempdir, so both fuse the
+same cached registration and warped priors, and the Dice of every label between the two is reported.  The exit
+status is 1 if any label is below the tolerance.
+
+    python benchmark/compare_fusion.py scan/WMnMPRAGE.nii.gz work --tolerance 0.95
+
+Run it where ANTs is installed: with the stand-ins of standin.py, antsJointFusion is only a majority vote.
+"""
+import os
+import sys
+import argparse
+import subprocess
+import numpy as np
+import nibabel
+
+
+this_path = os.path.dirname(os.path.realpath(__file__))
+repo_path = os.path.dirname(this_path)
+# Fusion methods compared, by output directory, and their THOMAS.py arguments
+methods = (('antsJointFusion', []), ('native', ['--nativefusion']))
+
+
+def dice(a, b):
+    """
+    Dice of the nonzero voxels of two images on the same grid, 1 if both are empty.
+    """
+    a = np.asanyarray(nibabel.load(a).dataobj) != 0
+    b = np.asanyarray(nibabel.load(b).dataobj) != 0
+    total = np.count_nonzero(a) + np.count_nonzero(b)
+    return 2. * np.count_nonzero(a & b) / total if total else 1.
+
+
+def segment(args, name, switches):
+    output_path = os.path.join(args.work, name)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    cmd = [args.python, os.path.join(repo_path, 'THOMAS.py'), os.path.abspath(args.input_image), 'ALL', '-a', 'v2',
+           '--tempdir', os.path.join(args.work, 'temp'), '--output_path', output_path] + switches
+    if args.processes:
+        cmd += ['-p', str(args.processes)]
+    with open(os.path.join(args.work, name + '.log'), 'w') as log:
+        if subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT):
+            sys.exit('!!!!!!! %s failed, see %s !!!!!!!' % (name, os.path.join(args.work, name + '.log')))
+    return output_path
+
+
+parser = argparse.ArgumentParser(description='Compare --nativefusion to antsJointFusion by the Dice of every label on the same scan.')
+parser.add_argument('input_image', help='input WMnMPRAGE to segment')
+parser.add_argument('work', help='directory for the shared temporary directory, the outputs and logs')
+parser.add_argument('--tolerance', type=float, default=0.95, help='lowest Dice accepted for every label')
+parser.add_argument('--python', default=sys.executable, help='interpreter for THOMAS.py')
+parser.add_argument('-p', '--processes', type=int, default=None, help='processes for THOMAS.py')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    reference, native = [segment(args, name, switches) for name, switches in methods]
+    below = []
+    print('%-12s %8s' % ('label', 'Dice'))
+    for fname in sorted(os.listdir(reference)):
+        if not fname[0].isdigit() or not fname.endswith('.nii.gz') or not os.path.exists(os.path.join(native, fname)):
+            continue
+        value = dice(os.path.join(reference, fname), os.path.join(native, fname))
+        label = fname[:-len('.nii.gz')]
+        print('%-12s %8.4f%s' % (label, value, '' if value >= args.tolerance else ' below %g' % args.tolerance))
+        if value < args.tolerance:
+            below.append(label)
+    if below:
+        print('!!!!!!! Below the tolerance: %s !!!!!!!' % ', '.join(below))
+        sys.exit(1)
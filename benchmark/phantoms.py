@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Writes a small synthetic data root for THOMAS: templates, masks, a priors/ tree, PICSL parameters and an input
+scan.  Point THOMAS_DATA at the root to run THOMAS.py on it, see run.py.
+
+The head is an ellipsoid with two darker thalami, the left one split into the nuclei.  Everything is in the
+LAS orientation fslreorient2std gives, every prior has identity transforms and its thalamus jittered by a voxel or
+two, so warped labels land where the input's thalamus is.  Odd priors lie on the crop template grid, even ones on
+the full head grid like the real priors, so their crop is smaller than their grid.
+"""
+import os
+import shelve
+import struct
+import argparse
+import numpy as np
+import nibabel
+
+
+# As in THOMAS_constants, which checks for the data on import so can't be used to write it
+image_name = 'WMnMPRAGE_bias_corr.nii.gz'
+# Nuclei in a 4 x 3 grid over the y and z extent of the left thalamus
+nuclei = ('2-AV', '4-VA', '5-VLa', '6-VLP', '7-VPL', '8-Pul', '9-LGN', '10-MGN', '11-CM', '12-MD-Pf', '13-Hb', '14-MTT')
+composites = {
+    '1-THALAMUS': nuclei,
+    '4567-VL': ('4-VA', '5-VLa', '6-VLP', '7-VPL'),
+    }
+
+
+def affine(shape, voxel):
+    """
+    LAS voxel to RAS world affine with the world origin in the middle of the grid.
+    """
+    a = np.diag([-voxel, voxel, voxel, 1.])
+    a[:3, 3] = -a[:3, :3].dot((np.array(shape) - 1) / 2.)
+    return a
+
+
+def world(shape, a):
+    """
+    RAS coordinates of every voxel, 3 x X x Y x Z.
+    """
+    ijk = np.indices(shape, dtype=np.float64)
+    return np.tensordot(a[:3, :3], ijk, axes=1) + a[:3, 3].reshape(3, 1, 1, 1)
+
+
+def ellipsoid(xyz, center, radii):
+    return sum(((xyz[i] - center[i]) / radii[i]) ** 2 for i in range(3)) <= 1
+
+
+def thalamus_center(side, shift=(0, 0, 0)):
+    return (-12. if side == 'left' else 12.) + shift[0], -12. + shift[1], 6. + shift[2]
+
+
+thalamus_radii = (7., 13., 8.)
+
+
+def head(shape, a, shift=(0, 0, 0), rng=None, noise=0.):
+    """
+    Synthetic white matter nulled image: bright tissue, dark thalami, darker outside.
+    """
+    xyz = world(shape, a)
+    data = np.where(ellipsoid(xyz, (0, 0, 0), np.array(shape) * abs(a[0, 0]) * 0.45), 800., 20.)
+    for side in ('left', 'right'):
+        data[ellipsoid(xyz, thalamus_center(side, shift), thalamus_radii)] = 400.
+    if rng is not None and noise:
+        data += rng.normal(0, noise, shape)
+    return data.astype(np.float32)
+
+
+def labels(shape, a, shift=(0, 0, 0)):
+    """
+    Masks of every label of the left thalamus, including the composites.
+    """
+    xyz = world(shape, a)
+    center = thalamus_center('left', shift)
+    thalamus = ellipsoid(xyz, center, thalamus_radii)
+    y = np.clip(((xyz[1] - center[1]) / thalamus_radii[1] + 1) / 2 * 4, 0, 3.999).astype(int)
+    z = np.clip(((xyz[2] - center[2]) / thalamus_radii[2] + 1) / 2 * 3, 0, 2.999).astype(int)
+    cell = y * 3 + z
+    masks = dict((name, thalamus & (cell == i)) for i, name in enumerate(nuclei))
+    for composite, parts in composites.items():
+        masks[composite] = np.any([masks[part] for part in parts], axis=0)
+    return masks
+
+
+def save(data, a, fname, dtype=None):
+    nii = nibabel.Nifti1Image(data, a)
+    nii.set_qform(a, code=1)
+    nii.set_sform(a, code=1)
+    if dtype is not None:
+        nii.set_data_dtype(dtype)
+    nii.to_filename(fname)
+    return fname
+
+
+def save_warp(shape, a, fname):
+    """
+    Zero ANTs displacement field, X x Y x Z x 1 x 3 vectors.
+    """
+    nii = nibabel.Nifti1Image(np.zeros(tuple(shape) + (1, 3), dtype=np.float32), a)
+    nii.header.set_intent('vector')
+    nii.to_filename(fname)
+    return fname
+
+
+def write_itk_text(fname, matrix=np.eye(3), translation=(0, 0, 0)):
+    """
+    ANTs Affine.txt, as written by the ANTS of the priors.
+    """
+    parameters = list(np.asarray(matrix).ravel()) + list(translation)
+    with open(fname, 'w') as f:
+        f.write('#Insight Transform File V1.0\n#Transform 0\nTransform: MatrixOffsetTransformBase_double_3_3\n')
+        f.write('Parameters: %s\nFixedParameters: 0 0 0\n' % ' '.join('%g' % p for p in parameters))
+    return fname
+
+
+def write_itk_mat(fname, matrix=np.eye(3), translation=(0, 0, 0)):
+    """
+    ANTs 0GenericAffine.mat, a MATLAB v4 file of the 12 affine parameters and the 3 fixed parameters.
+    """
+    variables = [('AffineTransform_double_3_3', list(np.asarray(matrix).ravel()) + list(translation)), ('fixed', [0., 0., 0.])]
+    with open(fname, 'wb') as f:
+        for name, values in variables:
+            name = name.encode('ascii') + b'\0'
+            # Type 0 is little endian doubles, then rows, columns, no imaginary part and the name length
+            f.write(struct.pack('<5i', 0, len(values), 1, 0, len(name)))
+            f.write(name)
+            f.write(struct.pack('<%dd' % len(values), *values))
+    return fname
+
+
+def crop_box(mask):
+    found = np.argwhere(mask)
+    return found.min(0), found.max(0) + 1
+
+
+def make(root, size=1., subjects=4, seed=0):
+    """
+    Writes the data root and returns the input scan.
+    - size scales the grids, 1 is a 2 mm 48 x 56 x 48 head
+    """
+    rng = np.random.RandomState(seed)
+    voxel = 2. / size
+    shape = tuple(int(round(n * size)) for n in (48, 56, 48))
+    full = affine(shape, voxel)
+    for path in (root, os.path.join(root, 'priors'), os.path.join(root, 'scan')):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    # Full template and the thalamus masks the crops are made from
+    template = head(shape, full)
+    save(template, full, os.path.join(root, 'origtemplate.nii.gz'))
+    xyz = world(shape, full)
+    crops = {}
+    for name, padding in (('93x187x68', 6.), ('93x187x68_p15', 10.), ('61x91x62', 4.)):
+        mask = np.zeros(shape, dtype=np.uint8)
+        for side in ('left', 'right'):
+            mask[ellipsoid(xyz, thalamus_center(side), np.array(thalamus_radii) + padding)] = 1
+        save(mask, full, os.path.join(root, 'mask_templ_%s.nii.gz' % name), np.uint8)
+        start, stop = crop_box(mask)
+        crop_affine = full.copy()
+        crop_affine[:3, 3] = full[:3, :3].dot(start) + full[:3, 3]
+        crops[name] = (tuple(stop - start), crop_affine, tuple(slice(a, b) for a, b in zip(start, stop)))
+        crop = template[crops[name][2]]
+        template_name = 'p15_templ_93x187x68' if name.endswith('_p15') else 'templ_' + name
+        save(crop, crop_affine, os.path.join(root, template_name + '.nii.gz'))
+
+    crop_shape, crop_affine, crop_region = crops['93x187x68']
+    for i in range(subjects):
+        path = os.path.join(root, 'priors', 'prior%d' % (i + 1))
+        if not os.path.exists(os.path.join(path, 'sanitized_rois')):
+            os.makedirs(os.path.join(path, 'sanitized_rois'))
+        shift = rng.uniform(-voxel, voxel, 3)
+        on_crop = i % 2 == 0
+        prior_shape, prior_affine = (crop_shape, crop_affine) if on_crop else (shape, full)
+        data = head(prior_shape, prior_affine, shift, rng, 20.)
+        save(data, prior_affine, os.path.join(path, image_name))
+        # The prior in template space for --topk, the same image with identity transforms
+        save(data if on_crop else data[crop_region], crop_affine, os.path.join(path, 'WMnMPRAGEdeformed.nii.gz'))
+        for label, mask in labels(prior_shape, prior_affine, shift).items():
+            save(mask.astype(np.uint8), prior_affine, os.path.join(path, 'sanitized_rois', label + '.nii.gz'), np.uint8)
+        write_itk_text(os.path.join(path, 'WMnMPRAGEAffine.txt'))
+        save_warp(prior_shape, prior_affine, os.path.join(path, 'WMnMPRAGEWarp.nii.gz'))
+        save_warp(prior_shape, prior_affine, os.path.join(path, 'WMnMPRAGEInverseWarp.nii.gz'))
+
+    # Two parameter sets so grouped fusion has more than one group
+    small = ('13-Hb', '14-MTT', '9-LGN', '10-MGN', '2-AV')
+    db = shelve.open(os.path.join(root, 'cv_optimal_picsl_parameters.shelve'), 'n')
+    db['PICSL'] = dict((label, {'rp': [1, 1, 1], 'rs': [2, 2, 2], 'beta': 1} if label in small else {'rp': [2, 2, 2], 'rs': [3, 3, 3], 'beta': 2})
+                       for label in list(nuclei) + list(composites))
+    db.close()
+
+    return save(head(shape, full, rng.uniform(-voxel, voxel, 3), rng, 20.), full, os.path.join(root, 'scan', 'WMnMPRAGE.nii.gz'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic THOMAS data root: templates, masks, priors, PICSL parameters and scan/WMnMPRAGE.nii.gz.')
+    parser.add_argument('root', help='directory to write to')
+    parser.add_argument('--size', type=float, default=1., help='scale of the grids, 1 is a 2 mm 48x56x48 head')
+    parser.add_argument('--subjects', type=int, default=4, help='number of priors')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(make(args.root, args.size, args.subjects, args.seed))
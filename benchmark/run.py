@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Times THOMAS.py on the synthetic data of phantoms.py with the stand-in tools of standin.py, so orchestration
+regressions and speedups can be measured on any machine without ANTs, FSL or real scans.
+
+Each scenario is timed end to end and per stage, from the trace THOMAS.py writes with --trace, alongside the
+overheads the pipeline pays per step: spawning a shell, starting a stand-in tool, starting Python and importing
+THOMAS, and gzip.  Results are compared against a baseline saved with --save, by default benchmark/baseline.json,
+and the exit status is 1 if any metric is slower than the baseline by more than the tolerance.  Timings depend on
+the machine, so no baseline is committed and the first run on a machine has to save one.
+
+    python benchmark/run.py --save            # on the reference checkout, once per machine
+    python benchmark/run.py                   # after a change
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from io import BytesIO
+
+
+this_path = os.path.dirname(os.path.realpath(__file__))
+repo_path = os.path.dirname(this_path)
+
+# Name: (THOMAS.py arguments after the input, whether to time a rerun on the same --tempdir)
+scenarios = {
+    'default': (['ALL', '-a', 'v2'], False),
+    'jointfusion': (['ALL', '-a', 'v2', '--jointfusion'], False),
+    'native': (['ALL', '-a', 'v2', '--nativewarp', '--nativefusion'], False),
+    'bilateral': (['ALL', '-a', 'v2', '--jointfusion', '--bilateral'], False),
+    'cached': (['ALL', '-a', 'v2'], True),
+    'uncompressed': (['ALL', '-a', 'v2', '--intermediate', 'nii'], False),
+    'prepared': (['ALL', '-a', 'v2', '--prepared'], False),
+    'roi': (['ALL', '-a', 'v2', '--roiwarp'], False),
+    'roigroup': (['ALL', '-a', 'v2', '--roiwarp', '--groupfusion'], False),
+    'topk': (['ALL', '-a', 'v2', '--topk', '2'], False),
+    'fast': (['ALL', '-a', 'v2', '--profile', 'fast'], False),
+}
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.
+
+
+def timed(func, repeat):
+    """
+    Median seconds of func() over repeat calls.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return median(times)
+
+
+def setup(args, work):
+    """
+    Writes the phantoms and the stand-in tools and returns the environment to run THOMAS.py in.
+    """
+    data = os.path.join(work, 'data')
+    subprocess.check_call([args.python, os.path.join(this_path, 'phantoms.py'), data, '--size', str(args.size), '--subjects', str(args.subjects)],
+                          stdout=open(os.devnull, 'w'))
+    subprocess.check_call([args.python, os.path.join(this_path, 'standin.py'), '--install', os.path.join(work, 'bin')],
+                          stdout=open(os.devnull, 'w'))
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(work, 'bin') + os.pathsep + env.get('PATH', '')
+    env['THOMAS_DATA'] = data
+    env['THOMAS_STANDIN_LATENCY'] = args.latency
+    env.pop('THOMAS_TRACE', None)
+    # For the prepared scenario
+    subprocess.check_call([args.python, os.path.join(repo_path, 'prepare_atlas.py'), '-p', str(args.processes)], env=env, cwd=repo_path,
+                          stdout=open(os.devnull, 'w'))
+    return env
+
+
+def load_trace(trace_file):
+    with open(trace_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def stage_metrics(trace_file):
+    """
+    Wall time from the first start to the last end of the tasks and commands of every stage, and the number of
+    commands and their total wall time.
+    """
+    stages = {}
+    for entry in load_trace(trace_file):
+        if 'stage' not in entry:
+            continue
+        stage = stages.setdefault(entry['stage'], {'start': entry['start'], 'end': 0., 'commands': 0, 'command_wall': 0.})
+        stage['start'] = min(stage['start'], entry['start'])
+        stage['end'] = max(stage['end'], entry['start'] + entry['wall'])
+        if entry['kind'] == 'command':
+            stage['commands'] += 1
+            stage['command_wall'] += entry['wall']
+    return dict((name, {'wall': s['end'] - s['start'], 'commands': s['commands'], 'command_wall': s['command_wall']})
+                for name, s in stages.items())
+
+
+def run_scenario(args, env, work, name):
+    """
+    Median end to end time of a scenario and the per stage metrics of its median run.
+    """
+    thomas_args, rerun = scenarios[name]
+    runs = []
+    for i in range(args.repeat):
+        path = os.path.join(work, '%s%d' % (name, i))
+        os.makedirs(path)
+        scan = os.path.join(path, 'WMnMPRAGE.nii.gz')
+        shutil.copyfile(os.path.join(env['THOMAS_DATA'], 'scan', 'WMnMPRAGE.nii.gz'), scan)
+        trace = os.path.join(path, 'trace')
+        cmd = [args.python, os.path.join(repo_path, 'THOMAS.py'), scan] + thomas_args + ['-p', str(args.processes), '--trace', trace]
+        if rerun:
+            cmd += ['--tempdir', os.path.join(path, 'temp')]
+        with open(os.path.join(path, 'log.txt'), 'w') as log:
+            if rerun:
+                subprocess.check_call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=path)
+            start = time.time()
+            returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=path)
+            total = time.time() - start
+        if returncode:
+            raise SystemExit('%s failed, see %s' % (name, os.path.join(path, 'log.txt')))
+        runs.append((total, stage_metrics(trace + '.jsonl')))
+    total, stages = sorted(runs, key=lambda run: run[0])[len(runs) // 2]
+    metrics = {'%s/total' % name: median([run[0] for run in runs])}
+    for stage, s in stages.items():
+        metrics['%s/%s' % (name, stage)] = s['wall']
+        # How much of the stage the tools themselves account for, the rest is THOMAS and waiting on the pool
+        metrics['%s/%s/commands' % (name, stage)] = s['command_wall']
+    # Python start up, imports and anything between stages
+    metrics['%s/outside stages' % name] = total - sum(s['wall'] for s in stages.values())
+    return metrics
+
+
+def overhead_metrics(args, env):
+    """
+    Per call costs paid by every step of the pipeline.
+    """
+    devnull = open(os.devnull, 'w')
+    scan = os.path.join(env['THOMAS_DATA'], 'scan', 'WMnMPRAGE.nii.gz')
+    n = args.overhead_repeat
+    metrics = {
+        'overhead/shell spawn': timed(lambda: subprocess.call('true', shell=True, env=env), n),
+        'overhead/stand-in tool': timed(lambda: subprocess.check_call(['fslhd', scan], stdout=devnull, env=env), n),
+        'overhead/python start': timed(lambda: subprocess.check_call([args.python, '-c', 'pass'], env=env), n),
+        'overhead/import THOMAS': timed(lambda: subprocess.check_call([args.python, '-c', 'import THOMAS'], cwd=repo_path, env=env), n),
+    }
+    with open(scan, 'rb') as f:
+        compressed = f.read()
+    raw = gzip.GzipFile(fileobj=BytesIO(compressed)).read()
+    megabytes = len(raw) / float(1 << 20)
+
+    def compress(level):
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level) as f:
+            f.write(raw)
+
+    # Per MB of uncompressed image so they don't depend on the phantom size
+    metrics['overhead/gunzip per MB'] = timed(lambda: gzip.GzipFile(fileobj=BytesIO(compressed)).read(), n) / megabytes
+    metrics['overhead/gzip -1 per MB'] = timed(lambda: compress(1), n) / megabytes
+    metrics['overhead/gzip -6 per MB'] = timed(lambda: compress(6), n) / megabytes
+    return metrics
+
+
+def settings(args):
+    return dict((key, getattr(args, key)) for key in ('size', 'subjects', 'latency', 'processes', 'repeat'))
+
+
+def compare(metrics, baseline, tolerance, min_delta):
+    """
+    Lines comparing metrics to the baseline and the names of those slower by more than tolerance and min_delta.
+    """
+    lines = ['%-40s %10s %10s %8s' % ('metric', 'baseline', 'now', 'change')]
+    regressions = []
+    for name in sorted(set(metrics) | set(baseline)):
+        now, before = metrics.get(name), baseline.get(name)
+        if now is None or before is None:
+            lines.append('%-40s %10s %10s' % (name, '-' if before is None else '%.4f' % before, '-' if now is None else '%.4f' % now))
+            continue
+        change = (now - before) / before if before else 0.
+        flag = ''
+        if now > before * (1 + tolerance) and now - before > min_delta:
+            regressions.append(name)
+            flag = ' slower'
+        lines.append('%-40s %10.4f %10.4f %+7.0f%%%s' % (name, before, now, 100 * change, flag))
+    return lines, regressions
+
+
+parser = argparse.ArgumentParser(description='Time THOMAS.py on synthetic data with stand-in tools and compare against a baseline.')
+parser.add_argument('scenarios', nargs='*', default=['default', 'jointfusion', 'native', 'cached', 'uncompressed', 'prepared', 'roi', 'roigroup', 'bilateral', 'topk', 'fast'],
+                    help='scenarios to run: %s' % ', '.join(sorted(scenarios)))
+parser.add_argument('--python', default=sys.executable, help='interpreter for THOMAS.py, the phantoms and the stand-ins, which needs numpy and nibabel')
+parser.add_argument('-p', '--processes', type=int, default=4, help='processes for THOMAS.py')
+parser.add_argument('--size', type=float, default=1., help='scale of the phantom grids, see phantoms.py')
+parser.add_argument('--subjects', type=int, default=4, help='number of synthetic priors')
+parser.add_argument('--latency', default='', help='stand-in delays, e.g. "antsRegistration=2,*=0.01", see standin.py')
+parser.add_argument('--repeat', type=int, default=3, help='runs of every scenario, the median is kept')
+parser.add_argument('--overhead-repeat', type=int, default=20, help='calls timed for every overhead')
+parser.add_argument('--baseline', default=os.path.join(this_path, 'baseline.json'), help='baseline to compare against or save to')
+parser.add_argument('--save', action='store_true', help='save the results as the baseline instead of comparing')
+parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown allowed before a metric counts as a regression')
+parser.add_argument('--min-delta', type=float, default=0.005, help='seconds a metric must slow down by to count as a regression')
+parser.add_argument('--work', help='directory for the data and runs, kept afterwards.  A temporary one is removed by default')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error('unknown scenario %s' % name)
+    work = args.work or tempfile.mkdtemp(prefix='thomas_benchmark_')
+    try:
+        env = setup(args, work)
+        metrics = overhead_metrics(args, env)
+        for name in args.scenarios:
+            print('--- Running %s ---' % name)
+            metrics.update(run_scenario(args, env, work, name))
+    finally:
+        if not args.work:
+            shutil.rmtree(work, ignore_errors=True)
+    results = {'settings': settings(args), 'machine': platform.platform(), 'python': platform.python_version(), 'metrics': metrics}
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print('\n'.join('%-40s %10.4f' % (name, metrics[name]) for name in sorted(metrics)))
+        print('Baseline written to %s' % args.baseline)
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print('\n'.join('%-40s %10.4f' % (name, metrics[name]) for name in sorted(metrics)))
+        print('!!!!!!! No baseline at %s, nothing was compared.  Run python benchmark/run.py --save on the reference checkout to write one !!!!!!!' % args.baseline)
+        sys.exit(0)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['settings'] != results['settings'] or baseline['machine'] != results['machine']:
+        print('!!!!!!! Baseline was made with %s on %s, comparing anyway !!!!!!!' % (baseline['settings'], baseline['machine']))
+    lines, regressions = compare(metrics, baseline['metrics'], args.tolerance, args.min_delta)
+    print('\n'.join(lines))
+    if regressions:
+        print('!!!!!!! Slower than the baseline: %s !!!!!!!' % ', '.join(regressions))
+        sys.exit(1)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Stand-ins for the ANTs, FSL, convert3d and PICSL tools THOMAS runs, so the pipeline can be timed without them.
+Each writes real outputs on the right grids, treating every transform as the identity (the phantoms of
+phantoms.py only have identity transforms), and label fusion is a majority vote.
+
+    standin.py tool [tool arguments]
+
+    standin.py --install bin_dir
+
+writes a wrapper named after every tool to bin_dir, for PATH, that runs it with this Python.
+THOMAS_STANDIN_LATENCY adds a delay in seconds to every call, e.g. "antsRegistration=2,antsJointFusion=0.5,*=0.01" where * is any other tool.
+"""
+import os
+import sys
+import time
+import numpy as np
+import nibabel
+from phantoms import write_itk_mat, write_itk_text
+
+
+latency_variable = 'THOMAS_STANDIN_LATENCY'
+
+
+def latency(tool):
+    delays = {}
+    for entry in os.environ.get(latency_variable, '').split(','):
+        if '=' in entry:
+            name, seconds = entry.split('=', 1)
+            delays[name.strip()] = float(seconds)
+    return delays.get(tool, delays.get('*', 0.))
+
+
+def fsl_name(fname):
+    """
+    FSL tools write .nii.gz when the output has no extension.
+    """
+    return fname if fname.endswith('.nii') or fname.endswith('.nii.gz') else fname + '.nii.gz'
+
+
+def save(data, like, fname, dtype=None):
+    nii = nibabel.Nifti1Image(data, like.affine, like.header)
+    nii.set_data_dtype(dtype if dtype is not None else data.dtype)
+    nii.to_filename(fname)
+    return fname
+
+
+def load_data(fname):
+    nii = nibabel.load(fname)
+    return nii, np.asanyarray(nii.dataobj)
+
+
+def resample(input_image, reference, output_image):
+    """
+    Nearest neighbour resampling of input_image onto the grid of reference through the world coordinates.
+    """
+    nii, data = load_data(input_image)
+    ref = nibabel.load(reference)
+    shape = ref.shape[:3]
+    ijk = np.indices(shape, dtype=np.float64).reshape(3, -1)
+    xyz = ref.affine[:3, :3].dot(ijk) + ref.affine[:3, 3:4]
+    inverse = np.linalg.inv(nii.affine)
+    index = np.rint(inverse[:3, :3].dot(xyz) + inverse[:3, 3:4]).astype(int)
+    inside = np.all((index >= 0) & (index < np.array(data.shape[:3])[:, None]), axis=0)
+    output = np.zeros(ijk.shape[1], dtype=data.dtype)
+    output[inside] = data[tuple(index[:, inside])]
+    return save(output.reshape(shape), ref, output_image)
+
+
+def zero_field(reference, output):
+    ref = nibabel.load(reference)
+    nii = nibabel.Nifti1Image(np.zeros(ref.shape[:3] + (1, 3), dtype=np.float32), ref.affine)
+    nii.header.set_intent('vector')
+    nii.to_filename(output)
+    return output
+
+
+def option_values(argv, flags):
+    """
+    Values following any of flags, up to the next option.
+    """
+    values = []
+    for i, arg in enumerate(argv):
+        if arg in flags:
+            for value in argv[i + 1:]:
+                if value.startswith('-') and not value[1:2].isdigit():
+                    break
+                values.append(value)
+    return values
+
+
+def ants_registration(argv):
+    output = option_values(argv, ('--output', '-o'))[0].strip('[]').split(',')[0]
+    metric = option_values(argv, ('--metric', '-m'))[0]
+    fixed = metric[metric.index('[') + 1:].split(',')[0]
+    write_itk_mat(output + '0GenericAffine.mat')
+    transforms = option_values(argv, ('-t', '--transform'))
+    if any(t.startswith('SyN') for t in transforms):
+        zero_field(fixed, output + '1Warp.nii.gz')
+        zero_field(fixed, output + '1InverseWarp.nii.gz')
+
+
+def ants(argv):
+    # ANTS 3 -m CC[fixed,moving,1,5] -o prefix -i iterations ..., which require.py needs to find on PATH
+    output = option_values(argv, ('-o', '--output-naming'))[0]
+    metric = option_values(argv, ('-m', '--image-metric'))[0]
+    fixed = metric[metric.index('[') + 1:].split(',')[0]
+    write_itk_text(output + 'Affine.txt')
+    if option_values(argv, ('-i', '--number-of-iterations')) != ['0']:
+        zero_field(fixed, output + 'Warp.nii.gz')
+        zero_field(fixed, output + 'InverseWarp.nii.gz')
+
+
+def ants_apply_transforms(argv):
+    resample(option_values(argv, ('-i', '--input'))[0], option_values(argv, ('-r', '--reference-image'))[0],
+             option_values(argv, ('-o', '--output'))[0])
+
+
+def warp_image_multi_transform(argv):
+    # WarpImageMultiTransform 3 input output transforms... -R reference
+    resample(argv[1], option_values(argv, ('-R',))[0], argv[2])
+
+
+def compose_multi_transform(argv):
+    # ComposeMultiTransform 3 output transforms... -R reference
+    zero_field(option_values(argv, ('-R',))[0], argv[1])
+
+
+def extract_region(argv):
+    # ExtractRegionFromImageByMask 3 input output mask label padding
+    nii, data = load_data(argv[1])
+    _, mask = load_data(argv[3])
+    label, padding = int(argv[4]) if len(argv) > 4 else 1, int(argv[5]) if len(argv) > 5 else 0
+    found = np.argwhere(mask == label)
+    start = np.maximum(found.min(0) - padding, 0)
+    stop = np.minimum(found.max(0) + 1 + padding, data.shape[:3])
+    crop = nii.slicer[tuple(slice(a, b) for a, b in zip(start, stop))]
+    crop.to_filename(argv[2])
+    print('final cropped region: ImageRegion\n  Dimension: 3\n  Index: [%s]\n  Size: [%s]' % (
+        ', '.join('%d' % i for i in start), ', '.join('%d' % i for i in stop - start)))
+
+
+def create_image(argv):
+    # CreateImage 3 reference output value
+    nii, data = load_data(argv[1])
+    save(np.full(data.shape, float(argv[3]), dtype=np.float32), nii, argv[2])
+
+
+def paste_image(argv):
+    # PasteImageIntoImage 3 canvas input output index
+    canvas, data = load_data(argv[1])
+    _, paste = load_data(argv[2])
+    start = [int(i) for i in argv[4].split('x')]
+    data = np.array(data, dtype=np.float32)
+    data[tuple(slice(a, a + n) for a, n in zip(start, paste.shape[:3]))] = paste
+    save(data, canvas, argv[3])
+
+
+def copy(input_image, output_image):
+    """
+    Rewrites input_image through nibabel so output_image is compressed or not by its extension, like the tools.
+    """
+    if os.path.abspath(input_image) != os.path.abspath(output_image):
+        nii = nibabel.load(input_image)
+        nibabel.Nifti1Image(np.asanyarray(nii.dataobj), nii.affine, nii.header).to_filename(output_image)
+
+
+def n4(argv):
+    copy(option_values(argv, ('-i',))[0], option_values(argv, ('-o',))[0])
+
+
+def fslreorient2std(argv):
+    # The phantoms are already LAS
+    copy(argv[0], fsl_name(argv[1]))
+
+
+# FSL axis labels and the direction nibabel names by where an axis points to
+anatomical = {'LR': 'R', 'RL': 'L', 'PA': 'A', 'AP': 'P', 'IS': 'S', 'SI': 'I'}
+orientation_names = {'R': 'Left-to-Right', 'L': 'Right-to-Left', 'A': 'Posterior-to-Anterior', 'P': 'Anterior-to-Posterior',
+                     'S': 'Inferior-to-Superior', 'I': 'Superior-to-Inferior'}
+
+
+def fslswapdim(argv):
+    nii, data = load_data(argv[0])
+    axes = argv[1:4]
+    if all(axis.lstrip('-') in 'xyz' for axis in axes):
+        # Reorders and flips the voxels, keeping the header
+        data = np.transpose(data, ['xyz'.index(axis.lstrip('-')) for axis in axes])
+        for i, axis in enumerate(axes):
+            if axis.startswith('-'):
+                data = np.flip(data, i)
+        save(np.ascontiguousarray(data), nii, fsl_name(argv[4]))
+        return
+    transform = nibabel.orientations.ornt_transform(nibabel.io_orientation(nii.affine),
+                                                    nibabel.orientations.axcodes2ornt([anatomical[axis] for axis in axes]))
+    nii.as_reoriented(transform).to_filename(fsl_name(argv[4]))
+
+
+def fslhd(argv):
+    nii = nibabel.load(argv[0])
+    for name in ('dim1', 'dim2', 'dim3'):
+        print('%s\t\t%d' % (name, nii.shape[int(name[-1]) - 1]))
+    for form in ('qform', 'sform'):
+        for axis, code in zip('xyz', nibabel.aff2axcodes(nii.affine)):
+            print('%s_%sorient\t%s' % (form, axis, orientation_names[code]))
+
+
+def fslstats(argv):
+    nii, data = load_data(argv[0])
+    data = data.reshape(data.shape[:3] + (-1,))
+    values = []
+    for option in argv[1:]:
+        if option == '-V':
+            count = int(np.count_nonzero(data))
+            values += ['%d' % count, '%f' % (count * np.prod(nii.header.get_zooms()[:3]))]
+        elif option == '-w':
+            found = np.argwhere(data)
+            start, stop = found.min(0), found.max(0) + 1
+            for a, b in zip(start, stop):
+                values += ['%d' % a, '%d' % (b - a)]
+    print(' '.join(values) + ' ')
+
+
+def fslmaths(argv):
+    nii, data = load_data(argv[0])
+    data = np.array(data, dtype=np.float32)
+    i = 1
+    while i < len(argv) - 1:
+        op = argv[i]
+        if op in ('-mul', '-add', '-sub', '-div'):
+            other = argv[i + 1]
+            value = float(other) if not os.path.exists(other) else np.asanyarray(nibabel.load(other).dataobj)
+            data = {'-mul': np.multiply, '-add': np.add, '-sub': np.subtract, '-div': np.divide}[op](data, value)
+            i += 2
+        elif op == '-bin':
+            data = (data > 0).astype(np.float32)
+            i += 1
+        elif op == '-roi':
+            box = [int(v) for v in argv[i + 1:i + 9]]
+            keep = np.zeros(data.shape, dtype=bool)
+            keep[tuple(slice(max(box[2 * d], 0), max(box[2 * d], 0) + box[2 * d + 1]) for d in range(3))] = True
+            data = np.where(keep, data, 0)
+            i += 9
+        else:
+            raise SystemExit('fslmaths stand-in: unsupported %s' % op)
+    save(data, nii, fsl_name(argv[-1]), np.float32)
+
+
+def majority(stack):
+    """
+    Most frequent value of every voxel across the first axis.
+    """
+    stack = np.rint(stack).astype(np.int64)
+    values = np.unique(stack)
+    counts = np.array([(stack == value).sum(0) for value in values])
+    return values[counts.argmax(0)]
+
+
+def load_labels(fnames):
+    nii = nibabel.load(fnames[0])
+    return nii, np.array([np.asanyarray(nibabel.load(f).dataobj).reshape(nii.shape[:3]) for f in fnames])
+
+
+def image_math(argv):
+    # ImageMath 3 output operation inputs...
+    output, operation, inputs = argv[1], argv[2], argv[3:]
+    if operation == 'MajorityVoting':
+        nii, stack = load_labels(inputs)
+        save(majority(stack).astype(np.int16), nii, output)
+    elif operation == 'overadd':
+        # Values of the first image replaced by those of the second where it is set
+        nii, a = load_data(inputs[0])
+        _, b = load_data(inputs[1])
+        save(np.where(b > 0, b, a).astype(np.float32), nii, output)
+    else:
+        raise SystemExit('ImageMath stand-in: unsupported %s' % operation)
+
+
+def ants_joint_fusion(argv):
+    nii, stack = load_labels(option_values(argv, ('-l', '--atlas-segmentation')))
+    fused = majority(stack)
+    mask = option_values(argv, ('-x', '--mask-image'))
+    if mask:
+        fused[np.asanyarray(nibabel.load(mask[0]).dataobj) == 0] = 0
+    save(fused.astype(np.int16), nii, option_values(argv, ('-o', '--output'))[0])
+
+
+def jointfusion(argv):
+    # jointfusion 3 1 -g ... -tg ... -l ... -m ... -rp ... -rs ... output
+    nii, stack = load_labels(option_values(argv, ('-l',)))
+    save(majority(stack).astype(np.int16), nii, argv[-1])
+
+
+def dilate(data, radius):
+    """
+    Box dilation by radius voxels along every axis.
+    """
+    for axis, r in enumerate(radius):
+        dilated = data.copy()
+        for shift in range(1, r + 1):
+            ahead = [slice(None)] * 3
+            behind = [slice(None)] * 3
+            ahead[axis], behind[axis] = slice(shift, None), slice(None, -shift)
+            dilated[tuple(ahead)] |= data[tuple(behind)]
+            dilated[tuple(behind)] |= data[tuple(ahead)]
+        data = dilated
+    return data
+
+
+def c3d(argv):
+    # The stack operations of conservative_mask: -accum -max -endaccum, -binarize, -dilate and -o
+    stack = []
+    like = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '-accum':
+            j = argv.index('-endaccum', i)
+            if argv[i + 1:j] != ['-max']:
+                raise SystemExit('c3d stand-in: unsupported accumulation %s' % ' '.join(argv[i + 1:j]))
+            stack = [np.max(stack, axis=0)]
+            i = j + 1
+        elif arg == '-binarize':
+            stack[-1] = (stack[-1] != 0).astype(np.float32)
+            i += 1
+        elif arg == '-dilate':
+            value, radius = float(argv[i + 1]), [int(r) for r in argv[i + 2].replace('vox', '').split('x')]
+            stack[-1] = np.where(dilate(stack[-1] == value, radius), value, stack[-1])
+            i += 3
+        elif arg == '-o':
+            save(stack[-1].astype(np.float32), like, argv[i + 1])
+            i += 2
+        elif arg.startswith('-'):
+            raise SystemExit('c3d stand-in: unsupported %s' % arg)
+        else:
+            like, data = load_data(arg)
+            stack.append(np.asarray(data, dtype=np.float32))
+            i += 1
+
+
+tools = {
+    'ANTS': ants,
+    'antsRegistration': ants_registration,
+    'antsApplyTransforms': ants_apply_transforms,
+    'WarpImageMultiTransform': warp_image_multi_transform,
+    'ComposeMultiTransform': compose_multi_transform,
+    'ExtractRegionFromImageByMask': extract_region,
+    'CreateImage': create_image,
+    'PasteImageIntoImage': paste_image,
+    'N4BiasFieldCorrection': n4,
+    'fslreorient2std': fslreorient2std,
+    'fslswapdim': fslswapdim,
+    'fslhd': fslhd,
+    'fslstats': fslstats,
+    'fslmaths': fslmaths,
+    'ImageMath': image_math,
+    'antsJointFusion': ants_joint_fusion,
+    'jointfusion': jointfusion,
+    'c3d': c3d,
+}
+
+
+def install(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for tool in tools:
+        wrapper = os.path.join(path, tool)
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, os.path.realpath(__file__), tool))
+        os.chmod(wrapper, 0o755)
+    return path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--install':
+        print(install(sys.argv[2]))
+        sys.exit(0)
+    if len(sys.argv) < 2 or sys.argv[1] not in tools:
+        print('%s tool [arguments] where tool is one of %s' % (sys.argv[0], ', '.join(sorted(tools))))
+        sys.exit(2)
+    tool = sys.argv[1]
+    time.sleep(latency(tool))
+    tools[tool](sys.argv[2:])
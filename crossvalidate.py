@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Leave-one-out cross-validation over the priors that measures accuracy and runtime together.  Every prior in turn is
+segmented by THOMAS.py from its WMnMPRAGE_bias_corr with the other priors, once for each mode, and scored by the
+Dice of every nucleus, uncropped to the grid of the prior, against its sanitized_rois, with the wall time of every
+stage from the trace.
+
+Every target keeps its temporary directories under the work directory.  The modes that only change the fusion or
+the priors selected share one, and every mode with the same registration settings shares the registration, so a
+sweep registers and warps each target once and a repeat sweep only re-runs what changed, e.g. fusion after new
+PICSL parameters.  --cold clears them before every run to time every mode from scratch.
+
+    python crossvalidate.py work --modes default nativewarp roiwarp
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from glob import glob
+from shutil import rmtree, copyfile
+import nibabel
+import numpy as np
+import libraries.tracing as tracing
+from libraries.imgtools import crop_sidecar, uncrop_by_sidecar
+from THOMAS_constants import image_name, prior_path, subjects, roi
+
+
+this_path = os.path.dirname(os.path.realpath(__file__))
+# Name: THOMAS.py arguments after the input and the ROIs, the first is the baseline the others are compared to
+modes = {
+    'default': [],
+    'jointfusion': ['--jointfusion'],
+    'majorityvoting': ['--majorityvoting'],
+    'groupfusion': ['--groupfusion'],
+    'nativewarp': ['--nativewarp'],
+    'cropprior': ['--cropprior'],
+    'roiwarp': ['--roiwarp'],
+    'prepared': ['--prepared'],
+    'topk': ['--topk', '10'],
+    'fast': ['--profile', 'fast'],
+    'accurate': ['--profile', 'accurate'],
+    'uncompressed': ['--intermediate', 'nii'],
+}
+# Modes that warp the same priors the same way as default, which share a temporary directory
+shared_modes = ('default', 'jointfusion', 'majorityvoting', 'groupfusion', 'topk')
+
+
+def dice(a, b):
+    """
+    Dice of the nonzero voxels of two images on the same grid, 1 if both are empty.
+    """
+    a = np.asanyarray(nibabel.load(a).dataobj) != 0
+    b = np.asanyarray(nibabel.load(b).dataobj) != 0
+    if a.shape != b.shape:
+        raise ValueError('Cannot compare images of shapes %s and %s' % (a.shape, b.shape))
+    total = np.count_nonzero(a) + np.count_nonzero(b)
+    return 2. * np.count_nonzero(a & b) / total if total else 1.
+
+
+def registration_name(mode):
+    """
+    The registration directory of a mode, named after its arguments that change the registration or its input.
+    """
+    args = modes[mode]
+    return '-'.join(['registration'] + [args[args.index(option) + 1] for option in ('--profile', '--intermediate') if option in args])
+
+
+def uncrop_labels(output_path, full_path):
+    """
+    Pastes the labels THOMAS.py wrote on the grid of its crop of the input back into the input grid in full_path,
+    with the crop sidecar published beside them.  Labels of a run that did not crop are only copied.
+    """
+    sidecars = glob(os.path.join(output_path, crop_sidecar('crop_*.nii.gz')))
+    if len(sidecars) > 1:
+        raise ValueError('More than one crop to uncrop %s with: %s' % (output_path, ', '.join(sidecars)))
+    if not os.path.exists(full_path):
+        os.makedirs(full_path)
+    for label in roi['label_names']:
+        fname = os.path.join(output_path, label + '.nii.gz')
+        if not os.path.exists(fname):
+            continue
+        if sidecars:
+            uncrop_by_sidecar(fname, os.path.join(full_path, label + '.nii.gz'), sidecars[0])
+        else:
+            copyfile(fname, os.path.join(full_path, label + '.nii.gz'))
+    return full_path
+
+
+def run_fold(target, mode, work, processes=None, cold=False, python=sys.executable):
+    """
+    Segments target with the other priors in a mode and writes and returns its result: the Dice of every label,
+    the wall time of every stage and the total.
+    """
+    path = os.path.join(work, target, mode)
+    temp_path = os.path.join(work, target, 'temp', 'shared' if mode in shared_modes else mode)
+    registration_path = os.path.join(work, target, registration_name(mode))
+    output_path = os.path.join(path, 'labels')
+    for directory in (temp_path, registration_path):
+        if cold and os.path.exists(directory):
+            rmtree(directory)
+    for directory in (temp_path, registration_path, output_path):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    trace = os.path.join(path, 'trace')
+    if os.path.exists(trace + '.jsonl'):
+        os.remove(trace + '.jsonl')
+    cmd = [python, os.path.join(this_path, 'THOMAS.py'), os.path.join(prior_path, target, image_name), roi['param_all'], '-a', 'v2']
+    cmd += modes[mode] + ['--tempdir', temp_path, '--warp', os.path.join(registration_path, 'WMnMPRAGE'), '--output_path', output_path, '--trace', trace]
+    if processes:
+        cmd += ['-p', str(processes)]
+    env = dict(os.environ)
+    env['THOMAS_EXCLUDE'] = target
+    print('--- %s %s ---' % (target, mode))
+    with open(os.path.join(path, 'log.txt'), 'w') as log:
+        start = time.time()
+        returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        total = time.time() - start
+    if returncode:
+        sys.exit('!!!!!!! %s %s failed, see %s !!!!!!!' % (target, mode, os.path.join(path, 'log.txt')))
+    truth = os.path.join(prior_path, target, 'sanitized_rois')
+    full_path = uncrop_labels(output_path, os.path.join(path, 'full'))
+    result = {
+        'dice': dict((label, dice(os.path.join(full_path, label + '.nii.gz'), os.path.join(truth, label + '.nii.gz')))
+                     for label in roi['label_names'] if os.path.exists(os.path.join(truth, label + '.nii.gz'))),
+        'stages': tracing.stage_times(trace + '.jsonl'),
+        'total': total,
+    }
+    with open(os.path.join(path, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+    return result
+
+
+def mean(values):
+    values = list(values)
+    return sum(values) / len(values) if values else float('nan')
+
+
+def report(results, mode_names):
+    """
+    Lines comparing every mode to the first: mean Dice of every label over the targets and its change, mean time of
+    every stage and in total, and the speedup.
+    """
+    baseline = mode_names[0]
+    labels = [label for label in roi['label_names'] if any(label in r['dice'] for r in results[baseline].values())]
+    stages = sorted(set(stage for runs in results.values() for r in runs.values() for stage in r['stages']))
+
+    def label_dice(mode, label):
+        return mean(r['dice'][label] for r in results[mode].values() if label in r['dice'])
+
+    def mean_time(mode, stage=None):
+        return mean(r['total'] if stage is None else r['stages'].get(stage, 0.) for r in results[mode].values())
+
+    lines = ['Dice, mean over %d targets, and change from %s' % (len(results[baseline]), baseline)]
+    lines.append('%-12s' % 'label' + ''.join('%18s' % mode for mode in mode_names))
+    for label in labels + ['mean']:
+        row = '%-12s' % label
+        for mode in mode_names:
+            value = mean(label_dice(mode, l) for l in labels) if label == 'mean' else label_dice(mode, label)
+            before = mean(label_dice(baseline, l) for l in labels) if label == 'mean' else label_dice(baseline, label)
+            row += '%18s' % ('%.4f' % value if mode == baseline else '%.4f %+.4f' % (value, value - before))
+        lines.append(row)
+    lines.append('')
+    lines.append('Wall seconds, mean over targets, and speedup over %s' % baseline)
+    lines.append('%-12s' % 'stage' + ''.join('%18s' % mode for mode in mode_names))
+    for stage in stages + [None]:
+        row = '%-12s' % (stage or 'total')
+        for mode in mode_names:
+            value, before = mean_time(mode, stage), mean_time(baseline, stage)
+            row += '%18s' % ('%.1f' % value if mode == baseline or not value or not before else '%.1f x%.2f' % (value, before / value))
+        lines.append(row)
+    return lines
+
+
+parser = argparse.ArgumentParser(description='Leave-one-out cross-validation of THOMAS.py modes over the priors, reporting accuracy and runtime together.')
+parser.add_argument('work', help='directory for the runs, kept so repeat sweeps reuse their cached registrations and warps')
+parser.add_argument('--modes', nargs='+', default=['default'], choices=sorted(modes), help='modes to run, the first is the baseline the others are compared to')
+parser.add_argument('--targets', nargs='+', default=None, help='priors to leave out in turn, defaults to all of them')
+parser.add_argument('-p', '--processes', type=int, default=None, help='processes for every THOMAS.py run')
+parser.add_argument('--cold', action='store_true', help='clear the cached steps of every run first so the times include everything')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    targets = args.targets or sorted(subjects)
+    if len(subjects) < 2:
+        sys.exit('!!!!!!! Leave-one-out needs at least two priors !!!!!!!')
+    results = dict((mode, {}) for mode in args.modes)
+    for target in targets:
+        for mode in args.modes:
+            results[mode][target] = run_fold(target, mode, args.work, args.processes, args.cold)
+    lines = report(results, args.modes)
+    with open(os.path.join(args.work, 'report.txt'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
@@ -8,25 +8,69 @@ import os
 import sys
 import re
 import shelve
-import tempfile
 from collections import OrderedDict
-from libraries.parallel import BetterPool, command
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import nibabel
 
 
-def overlap_c3d(im1, im2, label=1):
-    # Compute volumes and overlap
-    x = os.popen('c3d %s %s -overlap %s' % (im1, im2, label)).read()
-    return [float(el) for el in x.split(', ')[1:4]]
+def load_label_coordinates(labels):
+    """
+    Loads binary label images once into the flat indices of the voxels any of them covers, sorted, and a
+    voxels x labels boolean matrix of which labels cover each.  Overlaps and Dice scores only depend on those voxels.
+    """
+    masks = [np.flatnonzero(np.asanyarray(nibabel.load(label).dataobj) > 0) for label in labels]
+    voxels = np.unique(np.concatenate(masks)) if masks else np.array([], dtype=np.intp)
+    stack = np.zeros((len(voxels), len(labels)), dtype=bool)
+    for i, found in enumerate(masks):
+        stack[np.searchsorted(voxels, found), i] = True
+    return voxels, stack
 
 
-def dice_c3d(im1, im2, label=1):
-    # Compute Dice overlap
-    x = os.popen('c3d %s %s -overlap %s' % (im1, im2, label)).read()
-    try:
-        return float(x.split(', ')[-2])
-    except ValueError:
-        print x
-        raise
+def overlap_matrix(stack):
+    """
+    Volumes in voxels of the labels of a stack from load_label_coordinates and the voxels every pair shares, from
+    one matrix product, as c3d -overlap 1 of each pair.
+    """
+    # Exact in float64, which uses BLAS, while counts stay below 2**53
+    counts = stack.astype(np.float64)
+    intersection = counts.T.dot(counts)
+    return intersection.diagonal().copy(), intersection
+
+
+def atlas_dice(atlas, voxels, stack, numbers):
+    """
+    Dice of every label of a stack from load_label_coordinates against the voxels of atlas with the label's number,
+    as c3d -overlap of the binarized label times its number and the atlas.
+    """
+    data = np.asanyarray(nibabel.load(atlas).dataobj).ravel()
+    numbers = np.array([float(number) for number in numbers])
+    values, counts = np.unique(data, return_counts=True)
+    atlas_volumes = np.array([counts[values == number].sum() for number in numbers], dtype=np.float64)
+    intersections = (stack & (data[voxels][:, None] == numbers[None, :])).sum(0)
+    with np.errstate(invalid='ignore'):
+        return [float(dice) for dice in 2. * intersections / (stack.sum(0) + atlas_volumes)]
+
+
+def assemble_multiatlas(labels, numbers, output, voxels=None, stack=None):
+    """
+    Writes the integer multi-atlas where every voxel has the number of the last of labels covering it, the priority
+    of the fslmaths -bin -mul and ImageMath overadd chain it replaces, from one load of every label.
+    - numbers of labels, in the same order
+    - voxels and stack from load_label_coordinates of labels, loaded if not given
+    """
+    if stack is None:
+        voxels, stack = load_label_coordinates(labels)
+    reference = nibabel.load(labels[0])
+    numbers = [int(number) for number in numbers]
+    dtype = np.uint8 if max(numbers) <= np.iinfo(np.uint8).max else np.uint16
+    atlas = np.zeros(int(np.prod(reference.shape[:3])), dtype=dtype)
+    for i, number in enumerate(numbers):
+        atlas[voxels[stack[:, i]]] = number
+    nii = nibabel.Nifti1Image(atlas.reshape(reference.shape[:3]), reference.affine, reference.header)
+    nii.set_data_dtype(dtype)
+    nii.to_filename(output)
+    return output
 
 
 def split_multiatlas(atlas, output_prefix, pool=None):
@@ -35,12 +79,16 @@ def split_multiatlas(atlas, output_prefix, pool=None):
 
     output_prefix can be a container with integer index keys as in the atlas image
     and values the full output path.
+
+    The atlas is read once and the masks are written by pool, a thread pool so they share that read while the
+    compression runs in parallel.
     """
-    N = int(os.popen('MeasureMinMaxMean 3 %s' % atlas).read().split('[', 1)[-1].split(']', 1)[0])
-    if pool is None:
-        pool = BetterPool()
-    cmds = []
-    for idx in xrange(N):
+    nii = nibabel.load(atlas)
+    data = np.asanyarray(nii.dataobj)
+    values, inverse = np.unique(data, return_inverse=True)
+    inverse = inverse.reshape(data.shape)
+    outputs = []
+    for idx in xrange(int(values.max()) + 1):
         if isinstance(output_prefix, str):
             output = '%s-%s.nii.gz' % (output_prefix, idx)
         else:
@@ -49,27 +97,31 @@ def split_multiatlas(atlas, output_prefix, pool=None):
             except (IndexError, KeyError):
                 print 'Skipping %d' % idx
                 continue
-        cmds.append('ThresholdImage 3 %s %s %d %d' % (atlas, output, idx, idx))
-    pool.map(command, cmds)
+        outputs.append((idx, output))
+
+    def write_mask(idx, output):
+        found = np.flatnonzero(values == idx)
+        mask = (inverse == found[0]) if len(found) else np.zeros(data.shape, dtype=bool)
+        mask_nii = nibabel.Nifti1Image(mask.astype(np.uint8), nii.affine, nii.header)
+        mask_nii.set_data_dtype(np.uint8)
+        mask_nii.to_filename(output)
+        return output
+
+    if pool is None:
+        pool = ThreadPool()
+    return pool.map(lambda args: write_mask(*args), outputs)
 
 
 class CompareOverlap(object):
-    def __init__(self, labels, pool=None):
-        self.volume = {}
-        self.overlap = {}
-        if pool is None:
-            pool = BetterPool()
-        # TODO refactor using knowledge that it's a symmetric matrix of values
-        # Determine pairwise overlap
-        for label1 in labels:
-            overlap_params = []
-            for label2 in labels:
-                overlap_params.append((label1, label2))
-            datum = pool.map(overlap_c3d, overlap_params)
-            vol1, vol2, over = zip(*datum)
-            # This overwrites same value a lot, bit redundant
-            self.volume = dict(zip(labels, vol2))
-            self.overlap[label1] = dict(zip(labels, over))
+    def __init__(self, labels, stack=None):
+        """
+        - stack from load_label_coordinates of labels, loaded if not given
+        """
+        if stack is None:
+            _, stack = load_label_coordinates(labels)
+        volumes, intersection = overlap_matrix(stack)
+        self.volume = dict(zip(labels, map(float, volumes)))
+        self.overlap = dict((label1, dict(zip(labels, map(float, row)))) for label1, row in zip(labels, intersection))
 
     def __call__(self, label1, label2):
         overlap = self.overlap[label1][label2]
@@ -93,17 +145,18 @@ if __name__ == '__main__':
         print '%s <method: Numerical, Metric> <output_atlas> labels ...' % sys.argv[0]
         sys.exit(0)
 
-    pool = BetterPool()
     method = sys.argv[1]
     out = sys.argv[2]
     labels = sys.argv[3:]
+    # Every label is loaded once for both the ordering and the evaluation
+    voxels, stack = load_label_coordinates(labels)
     if method == 'Numerical':
         print 'Using the input order'
         method_labels = labels
     elif method == 'Metric':
         # Use overlap metric based comparison
         print 'Calculating overlap metric weighted by volume'
-        compare = CompareOverlap(labels, pool)
+        compare = CompareOverlap(labels, stack)
         method_labels = sorted(labels, cmp=compare)
     label_numbers = dict()
     for i, label in enumerate(labels):
@@ -121,43 +174,14 @@ if __name__ == '__main__':
         raise
 
     print 'Creating atlas'
-    try:
-        temp_file = tempfile.NamedTemporaryFile(suffix='.nii.gz', delete=True)
-        # CreateImage imageDimension referenceImage outputImage constant [random?]
-        os.system('CreateImage 3 %s %s 0' % (labels[0], out))
-        # overadd gives priority to labels later in list, addtozero gives priority to first or reversed(labels)
-        # TODO parallelize over fslmaths
-        for label in method_labels:
-            print label
-            # print label
-            # Remake ROI with the correct integer label
-            os.system('fslmaths %s -bin -mul %s %s' % (label, label_numbers[label], temp_file.name))
-            # ImageMath ImageDimension <OutputImage.ext> [operations and inputs] <Image1.ext> <Image2.ext>
-            #   addtozero        : add image-b to image-a only over points where image-a has zero values
-            #   overadd        : replace image-a pixel with image-b pixel if image-b pixel is non-zero
-            os.system('Imagemath 3 %s overadd %s %s' % (out, out, temp_file.name))
-    finally:
-        temp_file.close()
+    # Later labels take priority where they overlap, like ImageMath overadd
+    order = [labels.index(label) for label in method_labels]
+    print '\n'.join(method_labels)
+    assemble_multiatlas(method_labels, [label_numbers[label] for label in method_labels], out, voxels, stack[:, order])
 
     # Evaluate dice of combined atlas vs original independent ROIs
     print 'Evaluating atlas'
-    temp_files = []
-    cmds = []
-    dice_params = []
-    atlas = out
-    try:
-        for label, label_num in label_numbers.items():
-            temp_file = tempfile.NamedTemporaryFile(suffix='.nii.gz', delete=True)
-            temp_files.append(temp_file)
-            cmd = 'fslmaths %s -bin -mul %s %s' % (label, label_num, temp_file.name)
-            cmds.append(cmd)
-            dice_params.append((temp_file.name, atlas, label_num))
-        pool.map(os.system, cmds)
-        # TODO fully parallelize, don't join before collecting dice
-        dices = pool.map(dice_c3d, dice_params)
-    finally:
-        for temp_file in temp_files:
-            temp_file.close()
+    dices = atlas_dice(out, voxels, stack, [label_numbers[label] for label in labels])
 
     # Output to screen
     scores = OrderedDict(zip(labels, dices))
@@ -23,26 +23,72 @@ def ants_nonlinear_registration(template, input_image, output, switches='', line
     command(cmd, **exec_options)
     return output_warp, output_affine, cmd
 
-def ants_new_nonlinear_registration(template, input_image, output, switches='', **exec_options):
-    """Do nonlinear registration with antsRegistration"""
-    cmd = 'antsRegistration -v -d 3 --float 0 --output %s --use-histogram-matching 1 -t Rigid[0.1] --metric Mattes[%s,%s,1,32,None] --convergence [500x500x500x500x500,1e-6,10] -f 5x5x5x5x4 -s 1.685x1.4771x1.256x1.0402x0.82235mm -r [rigid0GenericAffine.mat,1] -t Affine[0.1] --metric Mattes[%s,%s,1,64, None] --convergence [450x150x50,1e-7,10] -f 3x2x1 -s 0.60056x0.3677x0mm -t SyN[0.4,3.0] --metric CC[%s,%s,1,5] --convergence [200x200x90x50,1e-10,10] -f 4x3x2x1 -s 0.82x0.6x0.3677x0.0mm' % (output, template, input_image, template, input_image, template, input_image)
+# antsRegistration settings by speed, 'default' gives the commands THOMAS was optimized with.  Every stage has its
+# convergence [iterations,threshold,window], shrink factors, smoothing sigmas, and metric sampling or CC radius.
+# Iterations of 0 skip the finest levels, where each iteration costs the most
+profiles = {
+    'fast': {
+        'float': 1,
+        'rigid': {'convergence': '250x250x100x50x0,1e-6,10', 'shrink': '5x5x5x5x4', 'smoothing': '1.685x1.4771x1.256x1.0402x0.82235mm', 'sampling': 'Regular,0.25'},
+        'affine': {'convergence': '250x100x0,1e-6,10', 'shrink': '3x2x1', 'smoothing': '0.60056x0.3677x0mm', 'sampling': 'Regular,0.25'},
+        'syn': {'convergence': '100x70x50x0,1e-6,10', 'shrink': '4x3x2x1', 'smoothing': '0.82x0.6x0.3677x0.0mm', 'radius': 4, 'sampling': 'Regular,0.25'},
+        'v0_affine': {'convergence': '1000x500x250x0,1e-6,10', 'shrink': '8x4x2x1', 'smoothing': '3x2x1x0vox', 'sampling': 'Regular,0.25'},
+        'v0_syn': {'convergence': '70x70x0,1e-6,10', 'shrink': '4x2x1', 'smoothing': '2x1x0vox', 'radius': 3},
+    },
+    'default': {
+        'float': 0,
+        'rigid': {'convergence': '500x500x500x500x500,1e-6,10', 'shrink': '5x5x5x5x4', 'smoothing': '1.685x1.4771x1.256x1.0402x0.82235mm', 'sampling': 'None'},
+        # The space has always been in the command, kept so it is unchanged
+        'affine': {'convergence': '450x150x50,1e-7,10', 'shrink': '3x2x1', 'smoothing': '0.60056x0.3677x0mm', 'sampling': ' None'},
+        'syn': {'convergence': '200x200x90x50,1e-10,10', 'shrink': '4x3x2x1', 'smoothing': '0.82x0.6x0.3677x0.0mm', 'radius': 5, 'sampling': 'None'},
+        'v0_affine': {'convergence': '1000x500x250x100,1e-6,10', 'shrink': '8x4x2x1', 'smoothing': '3x2x1x0vox', 'sampling': 'Regular,0.25'},
+        'v0_syn': {'convergence': '70x70x20,1e-6,10', 'shrink': '4x2x1', 'smoothing': '2x1x0vox', 'radius': 4},
+    },
+    'accurate': {
+        'float': 0,
+        'rigid': {'convergence': '500x500x500x500x500,1e-7,10', 'shrink': '5x5x5x5x4', 'smoothing': '1.685x1.4771x1.256x1.0402x0.82235mm', 'sampling': 'None'},
+        'affine': {'convergence': '450x150x100,1e-8,10', 'shrink': '3x2x1', 'smoothing': '0.60056x0.3677x0mm', 'sampling': 'None'},
+        'syn': {'convergence': '200x200x150x100,1e-10,15', 'shrink': '4x3x2x1', 'smoothing': '0.82x0.6x0.3677x0.0mm', 'radius': 5, 'sampling': 'None'},
+        'v0_affine': {'convergence': '1000x500x250x100,1e-7,10', 'shrink': '8x4x2x1', 'smoothing': '3x2x1x0vox', 'sampling': 'Regular,0.5'},
+        'v0_syn': {'convergence': '100x100x50,1e-7,10', 'shrink': '4x2x1', 'smoothing': '2x1x0vox', 'radius': 4},
+    },
+}
+
+
+def stage_options(stage):
+    return '--convergence [%(convergence)s] -f %(shrink)s -s %(smoothing)s' % stage
+
+
+def new_registration_command(template, input_image, output, initial, syn_metric, profile):
+    """The antsRegistration rigid, affine and SyN command of the v2 registrations with the settings of profile"""
+    settings = profiles[profile]
+    return 'antsRegistration -v -d 3 --float %d --output %s --use-histogram-matching 1 -t Rigid[0.1] --metric Mattes[%s,%s,1,32,%s] %s -r [%s,1] -t Affine[0.1] --metric Mattes[%s,%s,1,64,%s] %s -t SyN[0.4,3.0] --metric %s %s' % (
+        settings['float'], output, template, input_image, settings['rigid']['sampling'], stage_options(settings['rigid']), initial,
+        template, input_image, settings['affine']['sampling'], stage_options(settings['affine']), syn_metric, stage_options(settings['syn']))
+
+def ants_new_nonlinear_registration(template, input_image, output, switches='', initial='rigid0GenericAffine.mat', profile='default', **exec_options):
+    """Do nonlinear registration with antsRegistration initialized by the inverse of the rigid transform initial, with the settings of a profile"""
+    cmd = new_registration_command(template, input_image, output, initial, 'CC[%s,%s,1,%d]' % (template, input_image, profiles[profile]['syn']['radius']), profile)
     output_warp = output+'Warp.nii.gz'
     output_affine = output+'Affine.txt'
     command(cmd, **exec_options)
     return output_warp, output_affine, cmd
 
-def ants_mi_nonlinear_registration(template, input_image, output, switches='', **exec_options):
-    """Do nonlinear registration with antsRegistration MI syn """
-    cmd = 'antsRegistration -v -d 3 --float 0 --output %s --use-histogram-matching 1 -t Rigid[0.1] --metric Mattes[%s,%s,1,32,None] --convergence [500x500x500x500x500,1e-6,10] -f 5x5x5x5x4 -s 1.685x1.4771x1.256x1.0402x0.82235mm -r [rigid0GenericAffine.mat,1] -t Affine[0.1] --metric Mattes[%s,%s,1,64, None] --convergence [450x150x50,1e-7,10] -f 3x2x1 -s 0.60056x0.3677x0mm -t SyN[0.4,3.0] --metric MI[%s,%s,1,32,None] --convergence [200x200x90x50,1e-10,10] -f 4x3x2x1 -s 0.82x0.6x0.3677x0.0mm' % (output, template, input_image, template, input_image, template, input_image)
+def ants_mi_nonlinear_registration(template, input_image, output, switches='', initial='rigid0GenericAffine.mat', profile='default', **exec_options):
+    """Do nonlinear registration with antsRegistration MI syn initialized by the inverse of the rigid transform initial, with the settings of a profile"""
+    cmd = new_registration_command(template, input_image, output, initial, 'MI[%s,%s,1,32,%s]' % (template, input_image, profiles[profile]['syn']['sampling']), profile)
     output_warp = output+'Warp.nii.gz'
     output_affine = output+'Affine.txt'
     command(cmd, **exec_options)
     return output_warp, output_affine, cmd
 
 
-def ants_v0_nonlinear_registration(template, input_image, output, switches='', **exec_options):
-    """Do nonlinear registration with antsRegistration but no -r option """
-    cmd = 'antsRegistration -d 3 --float 0 --output %s -t Affine[0.1] --metric MI[%s,%s,1,32,Regular,0.25] --convergence [1000x500x250x100,1e-6,10] -f 8x4x2x1 -s 3x2x1x0vox -t SyN[0.1,3.0] --metric CC[%s,%s,1,4] --convergence [70x70x20,1e-6,10] -f 4x2x1 -s 2x1x0vox' % (output, template, input_image, template, input_image)
+def ants_v0_nonlinear_registration(template, input_image, output, switches='', profile='default', **exec_options):
+    """Do nonlinear registration with antsRegistration but no -r option, with the settings of a profile"""
+    settings = profiles[profile]
+    cmd = 'antsRegistration -d 3 --float %d --output %s -t Affine[0.1] --metric MI[%s,%s,1,32,%s] %s -t SyN[0.1,3.0] --metric CC[%s,%s,1,%d] %s' % (
+        settings['float'], output, template, input_image, settings['v0_affine']['sampling'], stage_options(settings['v0_affine']),
+        template, input_image, settings['v0_syn']['radius'], stage_options(settings['v0_syn']))
     output_warp = output+'Warp.nii.gz'
     output_affine = output+'Affine.txt'
     command(cmd, **exec_options)
@@ -50,33 +96,33 @@ def ants_v0_nonlinear_registration(template, input_image, output, switches='', *
 
 
 
-def ants_linear_registration(template, input_image, cost='CC', **exec_options):
-    cmd = 'ANTS 3 -m %s[%s,%s,1,5] -o linear -i 0 --use-Histogram-Matching --number-of-affine-iterations 10000x10000x10000x10000x10000 --MI-option 32x16000 --rigid-affine true' % (cost, template, input_image)
-    output_warp = 'linearWarp.nii.gz'
-    output_affine = 'linearAffine.txt'
+def ants_linear_registration(template, input_image, cost='CC', output='linear', **exec_options):
+    cmd = 'ANTS 3 -m %s[%s,%s,1,5] -o %s -i 0 --use-Histogram-Matching --number-of-affine-iterations 10000x10000x10000x10000x10000 --MI-option 32x16000 --rigid-affine true' % (cost, template, input_image, output)
+    output_warp = output+'Warp.nii.gz'
+    output_affine = output+'Affine.txt'
     command(cmd, **exec_options)
     return output_warp, output_affine, cmd
 
-def ants_oldrigid_registration(template, input_image, cost='CC', **exec_options):
-    cmd = 'ANTS 3 -m %s[%s,%s,1,5] -o linear -i 0 --use-Histogram-Matching --number-of-affine-iterations 10000x10000x10000x10000x10000 --MI-option 32x16000 --rigid-affine false' % (cost, template, input_image)
-    output_warp = 'linearWarp.nii.gz'
-    output_affine = 'linearAffine.txt'
+def ants_oldrigid_registration(template, input_image, cost='CC', output='linear', **exec_options):
+    cmd = 'ANTS 3 -m %s[%s,%s,1,5] -o %s -i 0 --use-Histogram-Matching --number-of-affine-iterations 10000x10000x10000x10000x10000 --MI-option 32x16000 --rigid-affine false' % (cost, template, input_image, output)
+    output_warp = output+'Warp.nii.gz'
+    output_affine = output+'Affine.txt'
     command(cmd, **exec_options)
     return output_warp, output_affine, cmd
 
 
-def ants_rigid_registration(fixed, moving, cost='MI', **exec_options):
-    cmd = 'antsRegistration -d 3 --float 0 --output rigid -t Rigid[0.1] -r [%s,%s,1]  --metric %s[%s,%s,1,32,Regular,0.25] --convergence [1000x500x250x100, 5e-7,10] -v -f 8x4x2x1 -s 3x2x1x0vox' % (fixed, moving, cost, fixed, moving)
-    output_warp = 'rigid.nii.gz'
-    output_rigid = 'rigidGeneric0Affine.txt'
+def ants_rigid_registration(fixed, moving, cost='MI', output='rigid', **exec_options):
+    cmd = 'antsRegistration -d 3 --float 0 --output %s -t Rigid[0.1] -r [%s,%s,1]  --metric %s[%s,%s,1,32,Regular,0.25] --convergence [1000x500x250x100, 5e-7,10] -v -f 8x4x2x1 -s 3x2x1x0vox' % (output, fixed, moving, cost, fixed, moving)
+    output_warp = output+'.nii.gz'
+    output_rigid = output+'0GenericAffine.mat'
     command(cmd, **exec_options)
     return output_warp, output_rigid, cmd
 
-def ants_new_rigid_registration(fixed, moving, cost='MI', **exec_options):
-    cmd = 'antsRegistration -d 3 --float 0 --output rigid -t Rigid[0.1] -r [%s,%s,1]  --metric MI[%s,%s,1,32,Regular,0.25] --convergence [1000x500x250x100, 5e-7,10] -v -f 8x4x2x1 -s 3x2x1x0vox -t Affine[0.1] --metric MI[%s,%s,1,32,Regular,0.25] --convergence [1000x500x250x100, 4e-7,10] -v -f 8x4x2x1 -s 3x2x1x0vox  ' % (fixed, moving, fixed, moving, fixed, moving)
+def ants_new_rigid_registration(fixed, moving, cost='MI', output='rigid', **exec_options):
+    cmd = 'antsRegistration -d 3 --float 0 --output %s -t Rigid[0.1] -r [%s,%s,1]  --metric MI[%s,%s,1,32,Regular,0.25] --convergence [1000x500x250x100, 5e-7,10] -v -f 8x4x2x1 -s 3x2x1x0vox -t Affine[0.1] --metric MI[%s,%s,1,32,Regular,0.25] --convergence [1000x500x250x100, 4e-7,10] -v -f 8x4x2x1 -s 3x2x1x0vox  ' % (output, fixed, moving, fixed, moving, fixed, moving)
     #cmd = 'antsRegistration -d 3 --float 0 --output rigid -t Rigid[0.1] -r [%s,%s,1]  --metric %s[%s,%s,1,32,None] --convergence [1000x500x250x100, 1e-6,10] -v -f 8x4x2x1 -s 3x2x1x0vox' % (fixed, moving, cost, fixed, moving)
-    output_warp = 'rigid.nii.gz'
-    output_rigid = 'rigidGeneric0Affine.txt'
+    output_warp = output+'.nii.gz'
+    output_rigid = output+'0GenericAffine.mat'
     command(cmd, **exec_options)
     return output_warp, output_rigid, cmd
 
@@ -0,0 +1,230 @@
+"""
+Step cache.  A step's outputs are reused only if a manifest, written after the step succeeded, records the same
+key and the outputs are unchanged since.  The key hashes the contents of the input files and the parameters,
+which include the source of the functions that build the command lines, so editing a command invalidates it.
+Outputs are written to a staging directory and renamed into place, and the manifests in a .steps directory
+beside the outputs are renamed into place after them, so a killed job never leaves a step that looks done.
+"""
+import os
+import json
+import hashlib
+import inspect
+import tempfile
+from shutil import rmtree
+from functools import partial
+
+
+steps_dir = '.steps'
+# Keyword arguments that change how a command is run but not what it writes
+exec_option_names = ('echo', 'verbose', 'debug', 'suppress')
+# Digests of files already hashed by this process keyed by path, size and modification time
+digests = {}
+
+
+def update(h, text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    h.update(text)
+
+
+def file_stat(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime]
+
+
+def manifest_path(output):
+    return os.path.join(os.path.dirname(os.path.abspath(output)), steps_dir, os.path.basename(output) + '.json')
+
+
+def load_manifest(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def recorded_digest(fname, stat):
+    """
+    Digest of a step output as recorded by its manifest, if it is unchanged since.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(fname)), steps_dir)
+    if not os.path.isdir(path):
+        return None
+    name = os.path.basename(fname)
+    for manifest in os.listdir(path):
+        if not manifest.endswith('.json'):
+            continue
+        recorded = load_manifest(os.path.join(path, manifest))
+        if recorded and name in recorded['outputs'] and recorded['outputs'][name][:2] == stat:
+            return recorded['outputs'][name][2]
+    return None
+
+
+def file_digest(fname):
+    """
+    SHA-1 of the contents of a file, None if it doesn't exist.
+    """
+    if not fname or not os.path.isfile(fname):
+        return None
+    stat = file_stat(fname)
+    memo = (os.path.abspath(fname),) + tuple(stat)
+    if memo not in digests:
+        digest = recorded_digest(fname, stat)
+        if digest is None:
+            h = hashlib.sha1()
+            with open(fname, 'rb') as f:
+                for block in iter(partial(f.read, 1 << 20), b''):
+                    h.update(block)
+            digest = h.hexdigest()
+        digests[memo] = digest
+    return digests[memo]
+
+
+def describe(value):
+    """
+    Text that changes whenever a parameter does, functions are described by their source.
+    """
+    if isinstance(value, partial):
+        return 'partial(%s, %s, %s)' % (describe(value.func), describe(value.args), describe(value.keywords or {}))
+    if inspect.isfunction(value) or inspect.ismethod(value):
+        try:
+            source = inspect.getsource(value)
+        except (IOError, TypeError):
+            source = ''
+        return '%s.%s:%s' % (value.__module__, value.__name__, hashlib.sha1(source.encode('utf-8')).hexdigest())
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%s: %s' % (describe(k), describe(value[k])) for k in sorted(value, key=describe))
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ', '.join(sorted(describe(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(describe(v) for v in value)
+    return repr(value)
+
+
+def step_key(inputs, parameters):
+    h = hashlib.sha1()
+    for fname in inputs:
+        update(h, '%s\n' % file_digest(fname))
+    update(h, describe(parameters))
+    return h.hexdigest()
+
+
+class Step(object):
+    """
+    One cached step writing outputs, which must all be in the same directory, from the contents of the input
+    files and the parameters.
+    - stage(path) gives where the step should write an output, or any file with a given prefix, before commit()
+    renames everything staged into place
+    """
+    def __init__(self, outputs, inputs=(), parameters=()):
+        self.outputs = list(outputs)
+        self.path = os.path.dirname(os.path.abspath(self.outputs[0]))
+        if any(os.path.dirname(os.path.abspath(output)) != self.path for output in self.outputs):
+            raise ValueError('Outputs of a step must share a directory: %s' % ', '.join(self.outputs))
+        self.manifest = manifest_path(self.outputs[0])
+        self.key = step_key(inputs, parameters)
+        self.staging = None
+
+    def valid(self):
+        recorded = load_manifest(self.manifest)
+        if not recorded or recorded['key'] != self.key:
+            return False
+        for output in self.outputs:
+            name = os.path.basename(output)
+            if name not in recorded['outputs'] or not os.path.exists(output) or file_stat(output) != recorded['outputs'][name][:2]:
+                return False
+        return True
+
+    def stage(self, path):
+        if self.staging is None:
+            steps = os.path.dirname(self.manifest)
+            try:
+                os.makedirs(steps)
+            except OSError:
+                # Exists
+                pass
+            self.staging = tempfile.mkdtemp(dir=steps, prefix=os.path.basename(self.outputs[0]) + '.')
+        return os.path.join(self.staging, os.path.basename(path))
+
+    def commit(self):
+        missing = [output for output in self.outputs if not os.path.exists(self.stage(output))]
+        if missing:
+            raise IOError('Step did not write %s' % ', '.join(missing))
+        self.invalidate()
+        for name in os.listdir(self.staging):
+            os.rename(os.path.join(self.staging, name), os.path.join(self.path, name))
+        self.abort()
+        return self.record()
+
+    def invalidate(self):
+        # Never leave a manifest vouching for a mix of old and new outputs
+        if os.path.exists(self.manifest):
+            os.remove(self.manifest)
+
+    def record(self):
+        """
+        Writes the manifest for outputs that are in place.
+        """
+        recorded = {'key': self.key, 'outputs': {}}
+        for output in self.outputs:
+            recorded['outputs'][os.path.basename(output)] = file_stat(output) + [file_digest(output)]
+        partial_manifest = self.manifest + '.%d.part' % os.getpid()
+        with open(partial_manifest, 'w') as f:
+            json.dump(recorded, f)
+        os.rename(partial_manifest, self.manifest)
+        return self.outputs
+
+    def abort(self):
+        if self.staging is not None:
+            rmtree(self.staging, ignore_errors=True)
+            self.staging = None
+
+
+def run_step(outputs, func, inputs=(), parameters=(), force=False):
+    """
+    Calls func(stage) unless outputs are valid for the inputs and parameters, see Step, and returns outputs.
+    func writes each output, or files with an output prefix, to stage(output).
+    """
+    step = Step(outputs, inputs, parameters)
+    if not force and step.valid():
+        print('Skipped, using %s' % ', '.join(outputs))
+        return outputs
+    try:
+        func(step.stage)
+        return step.commit()
+    finally:
+        step.abort()
+
+
+def input_files(values, outputs):
+    """
+    Existing files among values, and in their lists, tuples and dict values, other than outputs, each once.
+    """
+    files = []
+    for value in values:
+        if isinstance(value, dict):
+            value = input_files([value[k] for k in sorted(value)], outputs)
+        for value in (value if isinstance(value, (list, tuple)) else [value]):
+            if isinstance(value, str) and value not in outputs and value not in files and os.path.isfile(value):
+                files.append(value)
+    return files
+
+
+def cached_call(fname, func, *args, **kwargs):
+    """
+    Calls func, which writes fname, or every file of a list fname, unless they were already written by the same
+    call on the same input files.  Existing files among the arguments, or in list and dict arguments, are the inputs.
+    """
+    outputs = fname if isinstance(fname, list) else [fname]
+    parameters = (func, args, dict((k, v) for k, v in kwargs.items() if k not in exec_option_names))
+    inputs = input_files(list(args) + [kwargs[k] for k in sorted(kwargs)], outputs)
+    step = Step(outputs, inputs, parameters)
+    if step.valid():
+        print('Skipped, using %s' % ', '.join(outputs))
+        return fname
+    step.invalidate()
+    result = func(*args, **kwargs)
+    # func writes fname in place, so it only counts once the manifest is written after func succeeded
+    step.record()
+    return result
@@ -0,0 +1,313 @@
+"""
+In-process label fusion with NumPy.
+
+joint_label_fusion follows antsJointFusion (H Wang. Multi-Atlas Segmentation with Joint Label Fusion. 2013)
+with the Pearson correlation patch metric, but computes the atlas weights once for a set of labels that share
+patch radius, search radius and beta and then lets every label vote with the same weights.
+"""
+import os
+import numpy as np
+import nibabel
+from scipy import ndimage
+from labels import pack, load_label_stack
+from storage import intermediate
+
+
+def parameter_key(parameters):
+    """
+    Hashable (rp, rs, beta) from an entry of optimal['PICSL'].
+    """
+    return (tuple(int(el) for el in parameters['rp']), tuple(int(el) for el in parameters['rs']), float(parameters['beta']))
+
+
+def group_labels(labels, optimal_picsl):
+    """
+    Groups labels with identical PICSL parameters, returns a list of ((rp, rs, beta), labels).
+    """
+    groups = {}
+    order = []
+    for label in labels:
+        key = parameter_key(optimal_picsl[label])
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(label)
+    return [(key, groups[key]) for key in order]
+
+
+def partition_labels(labels, composites):
+    """
+    Splits labels into subsets that can share one integer segmentation, i.e. no composite label together with
+    one of its parts.
+    """
+    def overlaps(a, b):
+        return b in composites.get(a, ()) or a in composites.get(b, ())
+    subsets = []
+    for label in labels:
+        for subset in subsets:
+            if not any(overlaps(label, other) for other in subset):
+                subset.append(label)
+                break
+        else:
+            subsets.append([label])
+    return subsets
+
+
+def load_atlas_labels(labels, warped_labels, subjects):
+    """
+    Returns an N x X x Y x Z packed stack of the atlas labels and the bit for each label.
+    warped_labels is the label -> {subject: filename} dictionary from warp_atlas_subject, its packed volumes are
+    used directly when every prior had one.
+    """
+    if 'packed' in warped_labels:
+        return load_label_stack([warped_labels['packed'][subj] for subj in subjects], labels)
+    stack = []
+    for subj in subjects:
+        stack.append(pack([np.asanyarray(nibabel.load(warped_labels[label][subj]).dataobj).squeeze() for label in labels]))
+    return np.array(stack), dict((label, bit) for bit, label in enumerate(labels))
+
+
+def load_float(image):
+    return np.asanyarray(nibabel.load(image).dataobj).squeeze().astype(np.float32)
+
+
+def extract(data, start, stop):
+    """
+    Extracts data[start:stop] for a box that can extend past the edges of data, which are filled with 0.
+    """
+    start = np.asarray(start)
+    stop = np.asarray(stop)
+    shape = data.shape[-3:]
+    output = np.zeros(data.shape[:-3] + tuple(stop - start), dtype=data.dtype)
+    src = tuple(slice(max(a, 0), min(b, n)) for a, b, n in zip(start, stop, shape))
+    dst = tuple(slice(s.start - a, s.stop - a) for s, a in zip(src, start))
+    output[(Ellipsis,) + dst] = data[(Ellipsis,) + src]
+    return output
+
+
+def offsets(radius):
+    """
+    All integer offsets of a box neighbourhood with the given radius as a K x 3 array.
+    """
+    return np.array(np.meshgrid(*[np.arange(-r, r + 1) for r in radius], indexing='ij')).reshape(3, -1).T
+
+
+def patch_statistics(data, radius):
+    """
+    Local patch mean and sample standard deviation, a flat patch has a standard deviation of 1 so it normalizes to 0.
+    """
+    size = tuple(2 * r + 1 for r in radius)
+    n = float(np.prod(size))
+    mean = ndimage.uniform_filter(data, size, mode='constant')
+    var = (ndimage.uniform_filter(data * data, size, mode='constant') - mean * mean) * (n / (n - 1))
+    std = np.sqrt(np.maximum(var, 0))
+    std[std < 1e-6] = 1
+    return mean, std
+
+
+def joint_weights(target, atlases, voxels, rp, rs, beta, alpha=0.1, chunk=2048):
+    """
+    Joint label fusion weights for every voxel index (M x 3) of target, an array that is padded by rp+rs around them.
+    atlases is N x target.shape.  Returns the M x N weights and the best search offset of each atlas as flat deltas.
+    """
+    rp = np.asarray(rp)
+    rs = np.asarray(rs)
+    n_atlas = len(atlases)
+    size = tuple(2 * rp + 1)
+    n_patch = float(np.prod(size))
+    strides = np.array([target.shape[1] * target.shape[2], target.shape[2], 1])
+    centers = voxels.dot(strides)
+    target_mean, target_std = patch_statistics(target, rp)
+    atlas_stats = [patch_statistics(atlas, rp) for atlas in atlases]
+
+    # Search for the most correlated atlas patch within rs of each voxel
+    # The core is the region all target patches lie in, atlases are shifted against it by each search offset
+    lo = rs
+    hi = np.array(target.shape) - rs
+    core = tuple(slice(a, b) for a, b in zip(lo, hi))
+    core_voxels = tuple(voxels.T - rs[:, None])
+    t_mean = target_mean[tuple(voxels.T)]
+    t_std = target_std[tuple(voxels.T)]
+    search = offsets(rs)
+    best = np.empty((len(voxels), n_atlas), dtype=np.int64)
+    for i, atlas in enumerate(atlases):
+        a_mean, a_std = atlas_stats[i]
+        best_corr = np.full(len(voxels), -np.inf, dtype=np.float32)
+        best_offset = np.zeros(len(voxels), dtype=np.int64)
+        for offset in search:
+            shifted = tuple(slice(a + o, b + o) for a, b, o in zip(lo, hi, offset))
+            cross = ndimage.uniform_filter(target[core] * atlas[shifted], size, mode='constant')[core_voxels]
+            moved = tuple(voxels.T + offset[:, None])
+            corr = (cross - t_mean * a_mean[moved]) / (t_std * a_std[moved])
+            better = corr > best_corr
+            best_corr[better] = corr[better]
+            best_offset[better] = offset.dot(strides)
+        best[:, i] = best_offset
+
+    # Solve for the weights from the normalized patch differences at the best offsets
+    patch = offsets(rp).dot(strides)
+    flat_target = target.ravel()
+    flat_atlases = atlases.reshape(n_atlas, -1)
+    flat_means = np.array([stats[0].ravel() for stats in atlas_stats])
+    flat_stds = np.array([stats[1].ravel() for stats in atlas_stats])
+    weights = np.empty((len(voxels), n_atlas), dtype=np.float32)
+    atlas_index = np.arange(n_atlas)[None, :, None]
+    for start in range(0, len(voxels), chunk):
+        c = centers[start:start + chunk]
+        t = (flat_target[c[:, None] + patch[None, :]] - t_mean[start:start + chunk, None]) / t_std[start:start + chunk, None]
+        moved = c[:, None] + best[start:start + chunk]
+        a = flat_atlases[atlas_index, moved[:, :, None] + patch[None, None, :]]
+        a = (a - flat_means[atlas_index[..., 0], moved][..., None]) / flat_stds[atlas_index[..., 0], moved][..., None]
+        diff = np.abs(a - t[:, None, :])
+        mx = np.einsum('cip,cjp->cij', diff, diff) / (n_patch - 1)
+        mx = mx ** beta
+        mx[~np.isfinite(mx)] = 0
+        mx += alpha * np.eye(n_atlas, dtype=mx.dtype)
+        try:
+            w = np.linalg.solve(mx, np.ones(mx.shape[:2] + (1,), dtype=mx.dtype))[..., 0]
+        except np.linalg.LinAlgError:
+            w = np.einsum('cij,j->ci', np.linalg.pinv(mx), np.ones(n_atlas, dtype=mx.dtype))
+        weights[start:start + chunk] = w / w.sum(1)[:, None]
+    return weights, best
+
+
+def vote(labels, voxels, weights, best, rp, bits, chunk=2048):
+    """
+    Spreads each voxel's weighted atlas votes over its patch like antsJointFusion and returns the posterior for
+    each label bit, normalized by the number of votes every voxel received.
+    labels is the N x shape packed atlas stack on the same grid as the voxel indices.
+    """
+    shape = labels.shape[1:]
+    n_atlas = len(labels)
+    strides = np.array([shape[1] * shape[2], shape[2], 1])
+    centers = voxels.dot(strides)
+    flat_labels = labels.reshape(n_atlas, -1)
+    bit_index = np.array([bits[label] for label in sorted(bits)], dtype=flat_labels.dtype)
+    posterior = np.zeros((len(bit_index), int(np.prod(shape))), dtype=np.float32)
+    count = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    atlas_index = np.arange(n_atlas)[None, :]
+    for offset in offsets(rp).dot(strides):
+        for start in range(0, len(voxels), chunk):
+            neighbour = centers[start:start + chunk] + offset
+            votes = flat_labels[atlas_index, neighbour[:, None] + best[start:start + chunk]]
+            votes = (votes[:, :, None] >> bit_index[None, None, :]) & 1
+            # Neighbours are unique within a chunk for a fixed offset so fancy indexing accumulates correctly
+            posterior[:, neighbour] += np.einsum('ci,cib->bc', weights[start:start + chunk], votes.astype(np.float32))
+            count[neighbour] += 1
+    count[count == 0] = 1
+    return dict((label, (posterior[i] / count).reshape(shape)) for i, label in enumerate(sorted(bits)))
+
+
+def joint_label_fusion(input_image, atlas_images, atlas_labels, bits, output_labels, rp=[2, 2, 2], rs=[3, 3, 3], alpha=0.1, beta=2, mask=None):
+    """
+    Joint label fusion of all labels in bits with one set of weights, as antsJointFusion run for each label.
+    - atlas_images are the warped atlas intensity images, atlas_labels the packed N x X x Y x Z atlas stack
+    - bits maps label names to their bit in atlas_labels, output_labels maps label names to output filenames
+    - mask restricts fusion like antsJointFusion -x, otherwise the whole image is fused, an empty mask fuses nothing
+    and every label is written as background
+    """
+    rp = np.asarray(rp, dtype=int)
+    rs = np.asarray(rs, dtype=int)
+    target_nii = nibabel.load(input_image)
+    target = np.asanyarray(target_nii.dataobj).squeeze().astype(np.float32)
+    if mask is None:
+        region = np.ones(target.shape, dtype=bool)
+    else:
+        region = np.asanyarray(nibabel.load(mask).dataobj).squeeze() > 0
+    voxels = np.argwhere(region)
+    if len(voxels):
+        # Work in the bounding box of the mask padded so that patches, search and votes stay inside
+        pad = rp + rs
+        start = voxels.min(0) - pad
+        stop = voxels.max(0) + 1 + pad
+        atlases = np.array([extract(load_float(image), start, stop) for image in atlas_images])
+        labels = extract(atlas_labels, start, stop)
+        local = voxels - start
+        weights, best = joint_weights(extract(target, start, stop), atlases, local, rp, rs, beta, alpha)
+        posteriors = vote(labels, local, weights, best, rp, bits)
+        inside = tuple(local.T)
+    for label, output in output_labels.items():
+        fused = np.zeros(target.shape, dtype=np.uint8)
+        if len(voxels):
+            # Binary fusion picks the label over background only with a strict majority of the posterior
+            fused[tuple(voxels.T)] = posteriors[label][inside] > 0.5
+        nii = nibabel.Nifti1Image(fused, target_nii.affine, target_nii.header)
+        nii.set_data_dtype(np.uint8)
+        nii.to_filename(output)
+    return output_labels
+
+
+def label_fusion_native(input_image, atlas_images, warped_labels, subjects, labels, output_path, rp=[2, 2, 2], rs=[3, 3, 3], alpha=0.1, beta=2, mask=None):
+    """
+    Loads the atlas labels for one group of labels sharing parameters and fuses them to output_path/label.nii.gz.
+    atlas_images must be in the order of subjects.
+    """
+    atlas_labels, bits = load_atlas_labels(labels, warped_labels, subjects)
+    output_labels = dict((label, intermediate(os.path.join(output_path, label))) for label in labels)
+    return joint_label_fusion(input_image, atlas_images, atlas_labels, bits, output_labels, rp, rs, alpha, beta, mask)
+
+
+def label_fusion_grouped(fusion, input_image, atlas_images, warped_labels, subjects, labels, output_path, mask=None, **fusion_options):
+    """
+    Fuses labels that share parameters with one multi-label run of fusion, label_fusion_picsl_ants or label_fusion_picsl.
+    Every atlas gets an integer segmentation with value i+1 for labels[i], earlier labels winning where they
+    overlap, written beside the atlas's warped image, and the fused result is split back into output_path/label.nii.gz.
+    labels must not contain overlapping composites, see partition_labels.
+    """
+    atlas_labels, bits = load_atlas_labels(labels, warped_labels, subjects)
+    reference = nibabel.load(input_image)
+    name = intermediate('group_%s' % labels[0])
+    atlas_segmentations = []
+    for atlas_image, packed in zip(atlas_images, atlas_labels):
+        segmentation = np.zeros(packed.shape, dtype=np.uint8)
+        for value, label in reversed(list(enumerate(labels, 1))):
+            segmentation[(packed >> bits[label]) & 1 > 0] = value
+        # output_path/subject is not where the priors were warped to for --roiwarp
+        output = os.path.join(os.path.dirname(atlas_image), name)
+        nii = nibabel.Nifti1Image(segmentation, reference.affine, reference.header)
+        nii.set_data_dtype(np.uint8)
+        nii.to_filename(output)
+        atlas_segmentations.append(output)
+    fused = os.path.join(output_path, name)
+    if mask:
+        fusion_options['mask'] = mask
+    fusion(input_image, atlas_images, atlas_segmentations, fused, **fusion_options)
+    fused_nii = nibabel.load(fused)
+    data = np.rint(np.asanyarray(fused_nii.dataobj)).astype(np.int64).squeeze()
+    for value, label in enumerate(labels, 1):
+        nii = nibabel.Nifti1Image((data == value).astype(np.uint8), fused_nii.affine, fused_nii.header)
+        nii.set_data_dtype(np.uint8)
+        nii.to_filename(intermediate(os.path.join(output_path, label)))
+    return [intermediate(os.path.join(output_path, label)) for label in labels]
+
+
+def majority_voting(atlas_labels, bits, output_labels, reference):
+    """
+    Majority voting of every label in bits at once from the packed N x X x Y x Z atlas stack, as ImageMath
+    MajorityVoting run for each label: a voxel is labelled when more than half of the atlases agree, ties go to
+    background.  Only the bounding box of voxels that any atlas labels is counted.
+    """
+    reference = nibabel.load(reference) if isinstance(reference, str) else reference
+    n_atlas = len(atlas_labels)
+    labelled = np.argwhere((atlas_labels != 0).any(0))
+    box = (slice(None),)
+    if len(labelled):
+        box = tuple(slice(a, b + 1) for a, b in zip(labelled.min(0), labelled.max(0)))
+    stack = atlas_labels[(slice(None),) + box]
+    for label, output in output_labels.items():
+        votes = ((stack >> stack.dtype.type(bits[label])) & 1).sum(0, dtype=np.uint16)
+        fused = np.zeros(atlas_labels.shape[1:], dtype=np.uint8)
+        fused[box] = 2 * votes > n_atlas
+        nii = nibabel.Nifti1Image(fused, reference.affine, reference.header)
+        nii.set_data_dtype(np.uint8)
+        nii.to_filename(output)
+    return output_labels
+
+
+def label_fusion_majority_native(input_image, warped_labels, subjects, labels, output_path):
+    """
+    Loads the warped atlases once and majority votes all labels to output_path/label.nii.gz.
+    """
+    atlas_labels, bits = load_atlas_labels(labels, warped_labels, subjects)
+    output_labels = dict((label, intermediate(os.path.join(output_path, label))) for label in labels)
+    return majority_voting(atlas_labels, bits, output_labels, input_image)
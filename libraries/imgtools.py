@@ -1,18 +1,20 @@
 import os
 import sys
+import json
 import require
+import nibabel
+import numpy as np
 from parallel import command
+from cache import cached_call
+from storage import fsl_prefix, strip
 
 
 def check_run(fname, func, *args, **kwargs):
     """
-    Checks if fname exists first before execuring func.
+    Checks if fname was already made by the same call on the same input files before executing func, see
+    cache.cached_call.
     """
-    if os.path.exists(fname):
-        print 'Skipped, using %s' % fname
-        return fname
-    else:
-        return func(*args, **kwargs)
+    return cached_call(fname, func, *args, **kwargs)
 
 
 """
@@ -35,18 +37,41 @@ def sanitize_input(input_image, output_image, command=os.system):
     right thalamus.
     """
     if sys.platform == 'linux2' or sys.platform == 'darwin':
-        command('fslreorient2std %s %s' % (input_image, output_image))
+        command(fsl_prefix(output_image) + 'fslreorient2std %s %s' % (input_image, output_image))
     return output_image
 
 
 def flip_lr(input_image, output_image, command=os.system):
     if sys.platform == 'linux2' or sys.platform == 'darwin':
-        command('fslswapdim %s -x y z %s' % (input_image, output_image))
+        command(fsl_prefix(output_image) + 'fslswapdim %s -x y z %s' % (input_image, output_image))
     # else:
     #     command('fsl5.0-fslswapdim %s -x y z %s' % (input_image, output_image))
     return output_image
 
 
+# The LAS orientation of the MNI152 template that fslreorient2std brings images to
+standard_orientation = nibabel.orientations.axcodes2ornt(('L', 'A', 'S'))
+
+
+def reorient_native(input_image, output_image, flip=False):
+    """
+    sanitize_input followed by flip_lr when flip is set, in-process and written once.  Returns input_image without
+    writing anything if its header is already in the standard orientation and there is nothing to flip.
+    """
+    nii = nibabel.load(input_image)
+    transform = nibabel.orientations.ornt_transform(nibabel.io_orientation(nii.affine), standard_orientation)
+    reorient = not np.array_equal(transform, [[0, 1], [1, 1], [2, 1]])
+    if not reorient and not flip:
+        return input_image
+    if reorient:
+        nii = nii.as_reoriented(transform)
+    if flip:
+        # Like fslswapdim -x y z, mirror the voxels and keep the header
+        nii = nibabel.Nifti1Image(np.asanyarray(nii.dataobj)[::-1], nii.affine, nii.header)
+    nii.to_filename(output_image)
+    return output_image
+
+
 """
 warp_to_all_via_crop
 """
@@ -90,19 +115,29 @@ def ants_new_compose_a_to_b(a_transform_prefix, b_path, b_transform_prefix, outp
     return output, cmd
 
 
+def ants_new_compose_inverse(b_path, b_transform_prefix, output, **exec_options):
+    """
+    Compose the inverse of b's registration, bringing the template to b
+    """
+    b_affine = '-i '+b_transform_prefix+'0GenericAffine.mat'
+    b_warp = b_transform_prefix+'1InverseWarp.nii.gz'
+    cmd = 'ComposeMultiTransform 3 %s %s %s -R %s' % (output, b_affine, b_warp, b_path)
+    command(cmd, **exec_options)
+    return output, cmd
+
 
 def ants_apply_only_warp(template, input_image, input_warp, output_image, switches='', **exec_options):
     cmd = 'WarpImageMultiTransform 3 %s %s %s -R %s %s' % (input_image, output_image, input_warp, template, switches)
     command(cmd, **exec_options)
     return output_image, cmd
 
-def ants_WarpImageMultiTransform(input_image, output_image, template, **exec_options):
-    cmd = 'WarpImageMultiTransform 3 %s %s -R %s -i linearAffine.txt' % (input_image, output_image, template)
+def ants_WarpImageMultiTransform(input_image, output_image, template, transform='linearAffine.txt', **exec_options):
+    cmd = 'WarpImageMultiTransform 3 %s %s -R %s -i %s' % (input_image, output_image, template, transform)
     command(cmd, **exec_options)
     return output_image, cmd
 
-def ants_ApplyTransforms(input_image, reference, output_image, **exec_options):
-    cmd = 'antsApplyTransforms -d 3 -i %s -r %s -o %s -t rigid0GenericAffine.mat' % (input_image, reference, output_image)
+def ants_ApplyTransforms(input_image, reference, output_image, transform='rigid0GenericAffine.mat', **exec_options):
+    cmd = 'antsApplyTransforms -d 3 -i %s -r %s -o %s -t %s' % (input_image, reference, output_image, transform)
     command(cmd, **exec_options)
     return output_image, cmd
 
@@ -141,6 +176,59 @@ def crop_by_mask(input_image, output_image, mask, label=1, padding=0):
     return cmd
 
 
+def crop_sidecar(crop):
+    """
+    The geometry sidecar crop_by_mask_native writes beside a crop.
+    """
+    return strip(crop) + '.json'
+
+
+def crop_by_mask_native(input_image, output_image, mask, label=1, padding=0):
+    """
+    In-process crop_by_mask.  Crops input_image to the bounding box of the voxels of mask equal to label, after
+    truncating mask to integers like ExtractRegionFromImageByMask does, grown by padding and written as float.
+    The index and size of the box and the shape and affine of input_image go to crop_sidecar(output_image) for
+    uncrop_by_sidecar.
+    """
+    mask_data = np.asanyarray(nibabel.load(mask).dataobj)
+    found = np.argwhere(np.trunc(mask_data.reshape(mask_data.shape[:3])) == label)
+    if not len(found):
+        raise ValueError('No voxels of %s are %s' % (mask, label))
+    nii = nibabel.load(input_image)
+    shape = nii.shape[:3]
+    index = np.maximum(found.min(0) - padding, 0)
+    size = np.minimum(found.max(0) + 1 + padding, shape) - index
+    affine = nii.affine.copy()
+    affine[:3, 3] += affine[:3, :3].dot(index)
+    data = np.asanyarray(nii.dataobj[tuple(slice(a, a + n) for a, n in zip(index, size))]).astype(np.float32)
+    output = nibabel.Nifti1Image(data, affine, nii.header)
+    output.set_data_dtype(np.float32)
+    output.to_filename(output_image)
+    with open(crop_sidecar(output_image), 'w') as f:
+        json.dump({'index': index.tolist(), 'size': size.tolist(), 'shape': list(shape), 'affine': nii.affine.tolist()}, f)
+    return output_image
+
+
+def uncrop_by_sidecar(input_image, output_image, sidecar):
+    """
+    Pastes a crop, or an image on its grid, into a blank image of the grid it was cropped from, as recorded in the
+    sidecar of crop_by_mask_native.
+    """
+    with open(sidecar) as f:
+        geometry = json.load(f)
+    nii = nibabel.load(input_image)
+    data = np.asanyarray(nii.dataobj)
+    output = np.zeros(tuple(geometry['shape']) + data.shape[3:], dtype=data.dtype)
+    output[tuple(slice(a, a + n) for a, n in zip(geometry['index'], geometry['size']))] = data
+    affine = np.array(geometry['affine'])
+    output_nii = nibabel.Nifti1Image(output, affine, nii.header)
+    output_nii.set_qform(affine, code=1)
+    output_nii.set_sform(affine, code=1)
+    output_nii.set_data_dtype(data.dtype)
+    output_nii.to_filename(output_image)
+    return output_image
+
+
 def ants_label_fusions(output_prefix, labels, images=None):
     """
     Returns commands for various ANTS label fusion schemes.
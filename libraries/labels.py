@@ -0,0 +1,134 @@
+"""
+Packed multi-label volumes.  Every label is one bit of an unsigned integer voxel so that overlapping
+labels, like 4567-VL and its 4-VA, 5-VLa, 6-VLP and 7-VPL components, round-trip exactly.
+The label names in bit order are kept in a NIfTI comment extension.
+"""
+import numpy as np
+import nibabel
+
+
+names_tag = 'THOMAS packed labels:'
+
+
+def packed_dtype(n):
+    """
+    Smallest unsigned integer type with at least n bits.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError('Cannot pack %d labels' % n)
+
+
+def label_names(packed):
+    """
+    Returns the label names in bit order of a packed volume, or None if it has none recorded.
+    """
+    if isinstance(packed, str):
+        packed = nibabel.load(packed)
+    for extension in packed.header.extensions:
+        content = extension.get_content()
+        if not isinstance(content, str):
+            content = content.decode('ascii')
+        if content.startswith(names_tag):
+            return content[len(names_tag):].split()
+    return None
+
+
+def save_packed(data, names, reference, output):
+    """
+    Writes packed data with the geometry of reference and records the label names.
+    """
+    if isinstance(reference, str):
+        reference = nibabel.load(reference)
+    nii = nibabel.Nifti1Image(data, reference.affine)
+    nii.set_qform(*reference.get_qform(coded=True))
+    nii.set_sform(*reference.get_sform(coded=True))
+    nii.set_data_dtype(data.dtype)
+    content = (names_tag + ' ' + ' '.join(names)).encode('ascii')
+    nii.header.extensions.append(nibabel.nifti1.Nifti1Extension('comment', content))
+    nii.to_filename(output)
+    return output
+
+
+def pack(masks):
+    """
+    Packs a sequence of binary arrays into one integer array, the i-th mask in bit i.
+    """
+    dtype = packed_dtype(len(masks))
+    data = None
+    for bit, mask in enumerate(masks):
+        if data is None:
+            data = np.zeros(mask.shape, dtype=dtype)
+        data |= (mask > 0).astype(dtype) << dtype(bit)
+    return data
+
+
+def unpack(data, names, labels=None):
+    """
+    Returns a dictionary of boolean masks for labels, default all names, from packed data.
+    Works on packed data of any shape, e.g. a stack of warped atlases.
+    """
+    data = np.asarray(data)
+    if data.dtype.kind == 'f':
+        # Nearest neighbour warps by ITK tools come back as floats
+        data = np.rint(data).astype(packed_dtype(len(names)))
+    if labels is None:
+        labels = names
+    return dict((label, (data >> names.index(label)) & 1 > 0) for label in labels)
+
+
+def pack_labels(label_images, names, output):
+    """
+    Packs binary label images, in the order of names, into a single volume.
+    """
+    reference = nibabel.load(label_images[0])
+    masks = [np.asanyarray(nibabel.load(image).dataobj).reshape(reference.shape[:3]) for image in label_images]
+    return save_packed(pack(masks), names, reference, output)
+
+
+def load_packed(packed, names=None):
+    """
+    Loads a packed volume and its label names.  names is needed if they were not recorded in the file.
+    """
+    nii = nibabel.load(packed)
+    recorded = label_names(nii)
+    if recorded is not None:
+        names = recorded
+    if names is None:
+        raise ValueError('%s does not record its label names' % packed)
+    data = np.asanyarray(nii.dataobj).reshape(nii.shape[:3])
+    if data.dtype.kind == 'f':
+        data = np.rint(data).astype(packed_dtype(len(names)))
+    return data, names, nii
+
+
+def unpack_labels(packed, outputs, names=None):
+    """
+    Writes binary label images from a packed volume.
+    - outputs is a dictionary of label name to output filename
+    """
+    data, names, nii = load_packed(packed, names)
+    masks = unpack(data, names, list(outputs))
+    for label, output in outputs.items():
+        label_nii = nibabel.Nifti1Image(masks[label].astype(np.uint8), nii.affine, nii.header)
+        label_nii.header.extensions = type(nii.header.extensions)()
+        label_nii.set_data_dtype(np.uint8)
+        label_nii.to_filename(output)
+    return outputs
+
+
+def load_label_stack(packed_images, labels, names=None):
+    """
+    Loads the packed volumes of many atlases at once so fusion can work on them without splitting to files.
+    Returns the atlas stack as an N x X x Y x Z packed array and the bit for each label.
+    """
+    stack = []
+    for packed in packed_images:
+        data, packed_names, nii = load_packed(packed, names)
+        if names is None:
+            names = packed_names
+        elif packed_names != names:
+            raise ValueError('%s is packed with a different label order' % packed)
+        stack.append(data)
+    return np.array(stack), dict((label, names.index(label)) for label in labels)
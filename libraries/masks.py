@@ -0,0 +1,83 @@
+"""
+In-process versions of the mask operations THOMAS used to run with c3d, fslstats and fslmaths.
+"""
+import nibabel
+import numpy as np
+from scipy import ndimage
+
+
+def load_mask(mask):
+    """
+    Data of a mask given as an array or a filename.
+    """
+    if isinstance(mask, str):
+        mask = nibabel.load(mask).dataobj
+    data = np.asanyarray(mask)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3])
+    return data
+
+
+def bounding_box(mask):
+    """
+    (start, stop) voxel indices of every axis of the nonzero voxels of mask, None if there are none.
+    """
+    found = np.argwhere(mask)
+    if not len(found):
+        return None
+    return list(zip(found.min(0), found.max(0) + 1))
+
+
+def pad_box(box, padding, shape):
+    """
+    box with padding voxels added to each side, clipped to a grid of shape.
+    """
+    return [(max(start - padding, 0), min(stop + padding, n)) for (start, stop), n in zip(box, shape)]
+
+
+def box_slices(box):
+    return tuple(slice(start, stop) for start, stop in box)
+
+
+def dilate(mask, radius, box=None):
+    """
+    Binary dilation by a ball of radius voxels, as c3d -dilate 1 {radius}x{radius}x{radius}vox.  ITK's ball holds the
+    offsets within radius + 0.5 of its center, so a voxel is set if its nearest mask voxel is that close.
+    - box, the bounding box of mask, limits the distance transform to the part of the grid the ball can reach
+    """
+    if box is None:
+        box = bounding_box(mask)
+        if box is None:
+            return mask.copy()
+    region = box_slices(pad_box(box, radius + 1, mask.shape))
+    output = np.zeros_like(mask)
+    output[region] = ndimage.distance_transform_edt(mask[region] == 0) <= radius + 0.5
+    return output
+
+
+def conservative_mask(input_masks, output_path, dilation=0, fill=False, reference=None):
+    """
+    Estimates a conservative maximum mask given a list of input masks, arrays or filenames on the same grid.
+    - for dilation > 0 and fill=True, each side is padded by dilation instead
+    - fill will fill the bounding box of the mask producing a cube
+    - output_path is written as uint8 with the geometry of reference, by default the first filename of input_masks
+    """
+    # Maximum label fusion, as c3d -accum -max -endaccum -binarize
+    data = None
+    for mask in input_masks:
+        mask = load_mask(mask)
+        data = mask.copy() if data is None else np.maximum(data, mask)
+    data = (data != 0).astype(np.uint8)
+    box = bounding_box(data)
+    if box is not None and fill:
+        # As fslmaths -roi with the fslstats -w box grown by dilation on every side
+        box = pad_box(box, max(dilation, 0), data.shape)
+        data[box_slices(box)] = 1
+    elif box is not None and dilation > 0:
+        data = dilate(data, dilation, box)
+    if reference is None:
+        reference = [mask for mask in input_masks if isinstance(mask, str)][0]
+    reference = nibabel.load(reference)
+    nii = nibabel.Nifti1Image(data, reference.affine, reference.header)
+    nii.set_data_dtype(np.uint8)
+    nii.to_filename(output_path)
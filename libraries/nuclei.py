@@ -0,0 +1,97 @@
+"""
+In-process post-processing of a hemisphere's nuclei: the fused label image the fuselabels script makes and the
+nucleiVols.txt table the csh wrappers build with fslstats -V, from one load of every nucleus.
+"""
+import os
+from glob import glob
+from shutil import copyfile
+import numpy as np
+import nibabel
+from imgtools import crop_sidecar, uncrop_by_sidecar
+
+
+# Nucleus numbers in the order fuselabels adds them, a voxel keeps the number of the first nucleus claiming it
+fuse_order = (2, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14)
+
+
+def nucleus_file(path, number, suffix='-'):
+    """
+    The file of path fuselabels takes for a nucleus number, the last {number}{suffix}* match, None if none.
+    """
+    matches = sorted(glob(os.path.join(path, '%d%s*' % (number, suffix))))
+    return matches[-1] if matches else None
+
+
+def fuse_nuclei(nuclei, output):
+    """
+    Writes nuclei, (number, nibabel image) pairs in priority order, into one label image where every voxel has the
+    number of the first nucleus in it, as the fslmaths -mul and ImageMath overadd chain of fuselabels.
+    """
+    fused = None
+    for number, nii in nuclei:
+        data = np.asanyarray(nii.dataobj)
+        if fused is None:
+            fused = np.zeros(data.shape, dtype=np.uint8)
+            reference = nii
+        fused[(fused == 0) & (data != 0)] = number
+    if fused is None:
+        raise ValueError('No nuclei to fuse into %s' % output)
+    output_nii = nibabel.Nifti1Image(fused, reference.affine, reference.header)
+    output_nii.set_data_dtype(np.uint8)
+    output_nii.to_filename(output)
+    return output
+
+
+def volume(nii):
+    """
+    Volume in mm^3 of the nonzero voxels, the second number fslstats -V prints.
+    """
+    return np.count_nonzero(np.asanyarray(nii.dataobj)) * float(np.prod(np.abs(nii.header.get_zooms()[:3])))
+
+
+def summarize_nuclei(path, output, labels, table='nucleiVols.txt', suffix='-'):
+    """
+    Loads the nuclei in path once to write them fused into output, see fuse_nuclei, and the volume of each of labels
+    found in path into table, one "label volume" line each like the csh wrappers.
+    """
+    images = {}
+
+    def load(fname):
+        if fname not in images:
+            # Keep the data in memory so the fusion and the volumes don't decompress it twice
+            nii = nibabel.load(fname)
+            images[fname] = nibabel.Nifti1Image(np.asanyarray(nii.dataobj), nii.affine, nii.header)
+        return images[fname]
+
+    files = [(number, nucleus_file(path, number, suffix)) for number in fuse_order]
+    fuse_nuclei([(number, load(fname)) for number, fname in files if fname], output)
+    with open(os.path.join(path, table), 'w') as f:
+        for label in labels:
+            fname = os.path.join(path, label + '.nii.gz')
+            if os.path.exists(fname):
+                # %g prints like the C++ stream fslstats writes with
+                f.write('%s %g\n' % (label, volume(load(fname))))
+    return output
+
+
+def finish_hemisphere(output_path, crop_path, labels, suffix=''):
+    """
+    Fuses the nuclei into thomas.nii.gz, uncrops it into thomasfull.nii.gz and writes the nucleiVols.txt of labels
+    as the csh wrappers do.  The right hemisphere of --bilateral gets the r suffix: thomasr.nii.gz and
+    thomasrfull.nii.gz.  Without a crop sidecar in crop_path, or crop_path None for an uncropped run, the labels are
+    already on the input grid and thomasfull.nii.gz is a copy.  Nothing is written if no nuclei were segmented.
+    """
+    if not any(nucleus_file(output_path, number) for number in fuse_order):
+        print('No nuclei in %s to summarize' % output_path)
+        return
+    thomas = os.path.join(output_path, 'thomas%s.nii.gz' % suffix)
+    full = os.path.join(output_path, 'thomas%sfull.nii.gz' % suffix)
+    # 4567-VL is not part of the csh wrappers' nuclei list
+    summarize_nuclei(output_path, thomas, [label for label in labels if label != '4567-VL'])
+    sidecars = glob(os.path.join(crop_path, crop_sidecar('crop_*.nii.gz'))) if crop_path else []
+    if len(sidecars) > 1:
+        raise ValueError('More than one crop to uncrop %s with: %s' % (thomas, ', '.join(sidecars)))
+    if sidecars:
+        uncrop_by_sidecar(thomas, full, sidecars[0])
+    else:
+        copyfile(thomas, full)
@@ -1,6 +1,96 @@
+import os
 import subprocess
 import signal
+import traceback
+import heapq
+import multiprocessing
 import multiprocessing.pool
+import tracing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# ITK tools, e.g. antsRegistration, antsJointFusion and N4BiasFieldCorrection, use this many threads, all cores if unset
+thread_variable = 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'
+# Threads and cores given to the task running in this process, see budget_task, and in a pool worker with affinity
+# the number of tasks using each core of the budget, shared by all workers
+current = {'threads': None}
+shared = {'usage': None, 'cores': None}
+
+
+def available_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # Python 2
+        return list(range(multiprocessing.cpu_count()))
+
+
+def budget_threads(cpus, concurrent):
+    """
+    Threads for each of concurrent tasks sharing cpus cores, at least one.
+    """
+    return max(1, cpus // max(concurrent, 1))
+
+
+def set_affinity(cores):
+    """
+    Pins this process, and the commands it starts, to cores.
+    """
+    try:
+        os.sched_setaffinity(0, cores)
+    except AttributeError:
+        # Python 2
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['taskset', '-p', '-c', ','.join(str(core) for core in cores), str(os.getpid())], stdout=devnull)
+
+
+def claim_cores(threads):
+    """
+    Indices of the threads least used cores of the budget, counted as used until release_cores.
+    """
+    usage = shared['usage']
+    with usage.get_lock():
+        claimed = sorted(range(len(usage)), key=lambda i: (usage[i], i))[:threads]
+        for i in claimed:
+            usage[i] += 1
+    return claimed
+
+
+def release_cores(claimed):
+    usage = shared['usage']
+    with usage.get_lock():
+        for i in claimed:
+            usage[i] -= 1
+
+
+def budget_task(threads, func, args, kwargs):
+    """
+    Calls func(*args, **kwargs) with the ITK tools it runs limited to threads, see command, and in a pool pinning its
+    workers on the least used cores of the budget.  Both are added to the trace.
+    """
+    saved = dict(current)
+    current['threads'] = threads
+    claimed = claim_cores(threads) if shared['usage'] is not None else []
+    try:
+        cores = [shared['cores'][i] for i in claimed] or None
+        if cores:
+            set_affinity(cores)
+        with tracing.context(threads=threads, cores=cores):
+            return func(*args, **kwargs)
+    finally:
+        current.clear()
+        current.update(saved)
+        if claimed:
+            release_cores(claimed)
+
+
+def start_worker(usage, cores, initializer=None, initargs=()):
+    shared['usage'], shared['cores'] = usage, cores
+    if initializer is not None:
+        initializer(*initargs)
 
 
 class PoolWrapper(object):
@@ -9,10 +99,11 @@ class PoolWrapper(object):
     Graceful exit will finish the job first before quitting, may only work in Unix-like system.
     Supports unpacking of arguments from tuples or keywords from dictionaries.
     """
-    def __init__(self, func, graceful=False, unpack=True):
+    def __init__(self, func, graceful=False, unpack=True, threads=None):
         self.func = func
         self.graceful = graceful
         self.unpack = unpack
+        self.threads = threads
 
     def __call__(self, args):
         if self.graceful:
@@ -28,6 +119,11 @@ class PoolWrapper(object):
                 pass
 
     def _execute(self, args):
+        if self.threads:
+            return budget_task(self.threads, self._call, (args,), {})
+        return self._call(args)
+
+    def _call(self, args):
         if self.unpack:
             if isinstance(args, dict):
                 return self.func(**args)
@@ -40,14 +136,35 @@ class BetterPool(multiprocessing.pool.Pool):
     """
     A modification of multiprocessing.pool.Pool with map methods that properly receive keyboard
     interrupts.  By default, it will unpack tuple or dictionary arguments for the function call.
+    - cpus is the total number of cores the ITK tools of all workers may use, split between the tasks running at
+    once, e.g. all of them for a lone registration, see budget_task.  It is the default number of processes
+    - affinity pins every task to as many of the first cpus available cores as it has threads, the least used
     """
+    def __init__(self, processes=None, initializer=None, initargs=(), cpus=None, affinity=False, **kwargs):
+        self.cpus = cpus
+        if processes is None and cpus:
+            processes = cpus
+        if cpus and affinity:
+            cores = available_cores()[:cpus]
+            initializer, initargs = start_worker, (multiprocessing.Array('i', len(cores)), cores, initializer, initargs)
+        super(BetterPool, self).__init__(processes, initializer, initargs, **kwargs)
+
+    def threads(self, concurrent):
+        """
+        Threads for every task when concurrent run at once, None without a budget.
+        """
+        if not self.cpus:
+            return None
+        return budget_threads(self.cpus, min(concurrent, self._processes))
+
     def _wrap(self, func, iterable):
         if iterable:
             if not isinstance(func, PoolWrapper):
+                threads = self.threads(len(iterable))
                 if isinstance(iterable[0], tuple) or isinstance(iterable[0], dict):
-                    func = PoolWrapper(func, unpack=True)
+                    func = PoolWrapper(func, unpack=True, threads=threads)
                 else:
-                    func = PoolWrapper(func, unpack=False)
+                    func = PoolWrapper(func, unpack=False, threads=threads)
         return func
 
     def map_async(self, func, iterable, *args, **kwargs):
@@ -63,6 +180,125 @@ class BetterPool(multiprocessing.pool.Pool):
             raise
 
 
+def run_task(func, args, kwargs):
+    """
+    Lets a pool map over calls of different functions given as (func, args, kwargs).
+    """
+    return func(*args, **kwargs)
+
+
+def capture_task(func, args, kwargs):
+    """
+    Like run_task but returns (True, result) or (False, traceback) so a failure reaches the caller as a value.
+    """
+    try:
+        return True, func(*args, **kwargs)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def run_pipeline(pool, pipeline):
+    """
+    Runs a pipeline on pool.  A pipeline is a generator yielding (stage, tasks) where tasks is a list of
+    (func, args, kwargs) that can run in parallel, and it receives the list of their results back.
+    Tasks are traced with their stage, see tracing.  A pool with a core budget splits it between the tasks of a stage.
+    """
+    results = None
+    while True:
+        try:
+            stage, tasks = pipeline.send(results)
+        except StopIteration:
+            return
+        results = pool.map(tracing.run_task, [({'stage': stage},) + tuple(task) for task in tasks]) if tasks else []
+
+
+def run_pipelines(pool, pipelines, concurrency=None, callback=None):
+    """
+    Runs many pipelines, see run_pipeline, on one pool.  The tasks of a stage start as soon as the previous stage
+    of the same pipeline finishes, so the stages of different pipelines overlap instead of waiting on each other.
+    No more tasks than the pool has processes are handed over at once, those of earlier pipelines first, and at
+    most concurrency pipelines are in progress at once.
+    A pipeline with a failing task is closed and the others carry on.
+    Tasks are traced with their stage and pipeline name as scan, see tracing.
+    A pool with a core budget splits it between the tasks running at once, by what is outstanding and ready when
+    a task is handed over.
+    - pipelines is a list of (name, pipeline)
+    - callback(name, stage, error) is called when a pipeline starts a stage, when it finishes with stage None
+    and when it fails with the traceback as error
+    Returns the names of the pipelines that failed.
+    """
+    processes = pool._processes
+    threads_of = getattr(pool, 'threads', lambda concurrent: None)
+    if concurrency is None:
+        concurrency = processes
+    done = queue.Queue()
+    ready = []  # heap of (pipeline, task number, task)
+    waiting = list(range(len(pipelines)))[::-1]
+    active = {}  # pipeline -> [results, number of tasks left]
+    failed = []
+    state = {'outstanding': 0}
+
+    def report(i, stage, error=None):
+        if callback is not None:
+            callback(pipelines[i][0], stage, error)
+
+    def advance(i, results):
+        pipeline = pipelines[i][1]
+        while True:
+            try:
+                stage, tasks = pipeline.send(results)
+            except StopIteration:
+                report(i, None)
+                return
+            except (Exception, SystemExit):
+                failed.append(pipelines[i][0])
+                report(i, None, traceback.format_exc())
+                return
+            report(i, stage)
+            if tasks:
+                break
+            results = []
+        active[i] = [[None] * len(tasks), len(tasks), {'stage': stage, 'scan': pipelines[i][0]}]
+        for j, task in enumerate(tasks):
+            heapq.heappush(ready, (i, j, task))
+
+    def schedule():
+        while waiting and len(active) < concurrency:
+            advance(waiting.pop(), None)
+        while ready and state['outstanding'] < processes:
+            threads = threads_of(state['outstanding'] + len(ready))
+            i, j, task = heapq.heappop(ready)
+            if i not in active:
+                continue
+            call = (tracing.run_task, (active[i][2],) + tuple(task), {})
+            if threads:
+                call = (budget_task, (threads,) + call, {})
+            pool.apply_async(capture_task, call, callback=lambda result, i=i, j=j: done.put((i, j, result)))
+            state['outstanding'] += 1
+
+    schedule()
+    while state['outstanding']:
+        # A timeout keeps the wait interruptible
+        i, j, (success, value) = done.get(True, 0xFFFFFF)
+        state['outstanding'] -= 1
+        if i in active:
+            if success:
+                results = active[i]
+                results[0][j] = value
+                results[1] -= 1
+                if not results[1]:
+                    del active[i]
+                    advance(i, results[0])
+            else:
+                del active[i]
+                failed.append(pipelines[i][0])
+                # Lets the pipeline clean up after itself
+                pipelines[i][1].close()
+                report(i, None, value)
+        schedule()
+    return failed
+
+
 def command(cmd, echo=False, verbose=False, debug=False, suppress=False, env=None):
     # sp_cmd = cmd.split(' ')
     if echo:
@@ -79,6 +315,11 @@ def command(cmd, echo=False, verbose=False, debug=False, suppress=False, env=Non
         print 'About to run: %s' % cmd
         if input('  Type n to skip') == 'n':
             return
+    if current['threads']:
+        env = dict(os.environ if env is None else env)
+        env[thread_variable] = str(current['threads'])
+    if tracing.enabled():
+        return tracing.run_command(cmd, suppress, env)
     if suppress:
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, env=env)
         stdout, stderr = p.communicate()
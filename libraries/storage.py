@@ -0,0 +1,39 @@
+"""
+Storage of intermediate images, the ones in the temporary directory that are read back once or twice.
+- gz, the default, writes .nii.gz like the final outputs
+- nii writes uncompressed .nii so that only the final outputs are compressed, each by the pool task writing it
+THOMAS.py sets THOMAS_INTERMEDIATE before the pool starts so its workers follow the same policy.
+"""
+import os
+
+
+policy_variable = 'THOMAS_INTERMEDIATE'
+policies = ('gz', 'nii')
+
+
+def extension():
+    return '.nii' if os.environ.get(policy_variable) == 'nii' else '.nii.gz'
+
+
+def strip(fname):
+    """
+    fname without its NIfTI extension.
+    """
+    for ext in ('.nii.gz', '.nii'):
+        if fname.endswith(ext):
+            return fname[:-len(ext)]
+    return fname
+
+
+def intermediate(fname):
+    """
+    Name of an intermediate image, fname with or without an extension, under the current policy.
+    """
+    return strip(fname) + extension()
+
+
+def fsl_prefix(output):
+    """
+    Goes before an FSL command writing output so it keeps the extension, FSL otherwise picks it from FSLOUTPUTTYPE.
+    """
+    return 'FSLOUTPUTTYPE=NIFTI ' if output.endswith('.nii') else ''
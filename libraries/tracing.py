@@ -0,0 +1,174 @@
+"""
+Opt-in tracing of every external command and pipeline task.  Setting the THOMAS_TRACE environment variable to
+a path prefix, which pool workers and child processes inherit, appends one JSON line per command or task to
+{prefix}.jsonl with its stage, scan, prior subject and label, wall time, CPU time and peak RSS.
+export_chrome turns those into {prefix}.json for chrome://tracing or Perfetto.
+"""
+import os
+import json
+import time
+import resource
+import subprocess
+from storage import strip
+
+
+trace_variable = 'THOMAS_TRACE'
+# What the current process is working on, added to every record
+current = {}
+
+
+def enabled():
+    return bool(os.environ.get(trace_variable))
+
+
+class context(object):
+    """
+    Adds fields, e.g. stage, subject or label, to the records made within a with block.
+    """
+    def __init__(self, **fields):
+        self.fields = dict((k, v) for k, v in fields.items() if v is not None)
+
+    def __enter__(self):
+        self.saved = dict(current)
+        current.update(self.fields)
+        return self
+
+    def __exit__(self, *exc_info):
+        current.clear()
+        current.update(self.saved)
+
+
+def record(kind, name, start, wall, **fields):
+    entry = dict(current)
+    entry.update(fields)
+    entry.update(kind=kind, name=name, start=start, wall=wall, pid=os.getpid())
+    # One write per line so concurrent processes can append to the same file
+    with open(os.environ[trace_variable] + '.jsonl', 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def run_command(cmd, suppress=False, env=None):
+    """
+    subprocess.call(cmd, shell=True) that records the command's wall time and, from os.wait4, the CPU time and
+    peak RSS of the command and everything it waited for.
+    """
+    start = time.time()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE if suppress else None, shell=True, env=env)
+    if suppress:
+        p.stdout.read()
+        p.stdout.close()
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    record('command', cmd, start, time.time() - start, cpu_user=usage.ru_utime, cpu_system=usage.ru_stime,
+           max_rss_kb=usage.ru_maxrss, returncode=p.returncode)  # ru_maxrss is in kilobytes on Linux
+    return p.returncode
+
+
+def task_fields(kwargs):
+    """
+    The prior subject and labels of a task, from its keyword arguments.
+    """
+    fields = {'subject': kwargs.get('subject')}
+    if kwargs.get('labels'):
+        fields['label'] = ' '.join(sorted(kwargs['labels']))
+    elif kwargs.get('output_label'):
+        fields['label'] = strip(os.path.basename(kwargs['output_label']))
+    return fields
+
+
+def task_name(func, args):
+    """
+    Name of the function of a task, for a call cached by check_run the name of the function it caches.
+    """
+    if getattr(func, '__name__', None) in ('check_run', 'cached_call') and len(args) > 1:
+        func = args[1]
+    return getattr(func, '__name__', repr(func))
+
+
+def run_task(fields, func, args, kwargs):
+    """
+    Calls func(*args, **kwargs) with fields as context and records the task with the CPU time spent in-process,
+    commands it runs are recorded on their own.
+    """
+    if not enabled():
+        return func(*args, **kwargs)
+    fields = dict(fields, **task_fields(kwargs))
+    with context(**fields):
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            record('task', task_name(func, args), start, time.time() - start,
+                   cpu_user=after.ru_utime - before.ru_utime, cpu_system=after.ru_stime - before.ru_stime,
+                   max_rss_kb=after.ru_maxrss)
+
+
+def tool(cmd):
+    """
+    The program a command line runs, skipping variable assignments before it.
+    """
+    return [word for word in cmd.split() if '=' not in word][0]
+
+
+def load(trace_file):
+    with open(trace_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def export_chrome(trace_file, output):
+    """
+    Writes the records of a JSON lines trace as complete events of the Chrome trace event format.
+    """
+    entries = load(trace_file)
+    origin = min(entry['start'] for entry in entries) if entries else 0
+    events = []
+    for entry in entries:
+        args = dict((k, v) for k, v in entry.items() if k not in ('name', 'start', 'wall', 'pid'))
+        events.append({
+            'name': entry['name'] if entry['kind'] == 'task' else tool(entry['name']),
+            'cat': entry['kind'],
+            'ph': 'X',
+            'ts': (entry['start'] - origin) * 1e6,
+            'dur': entry['wall'] * 1e6,
+            'pid': 0,
+            'tid': entry['pid'],
+            'args': args,
+        })
+    with open(output, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return output
+
+
+def stage_times(trace_file):
+    """
+    Wall time of every stage, from the first start to the last end of its commands and tasks.
+    """
+    spans = {}
+    for entry in load(trace_file):
+        if 'stage' not in entry:
+            continue
+        start, end = spans.get(entry['stage'], (entry['start'], 0.))
+        spans[entry['stage']] = (min(start, entry['start']), max(end, entry['start'] + entry['wall']))
+    return dict((stage, end - start) for stage, (start, end) in spans.items())
+
+
+def summarize(trace_file):
+    """
+    Lines of total wall and CPU time and peak RSS of the commands of each stage and tool, largest first.
+    """
+    totals = {}
+    for entry in load(trace_file):
+        if entry['kind'] != 'command':
+            continue
+        key = (entry.get('stage', ''), tool(entry['name']))
+        total = totals.setdefault(key, [0, 0., 0., 0])
+        total[0] += 1
+        total[1] += entry['wall']
+        total[2] += entry['cpu_user'] + entry['cpu_system']
+        total[3] = max(total[3], entry['max_rss_kb'])
+    lines = ['%-14s %-32s %6s %10s %10s %10s' % ('stage', 'command', 'count', 'wall s', 'cpu s', 'peak MB')]
+    for (stage, name), (count, wall, cpu, rss) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        lines.append('%-14s %-32s %6d %10.1f %10.1f %10.1f' % (stage, os.path.basename(name), count, wall, cpu, rss / 1024.))
+    return lines
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Pack each prior's sanitized_rois into a single bitfield label volume that warp_atlas_subject warps in one go.
+"""
+import os
+import sys
+import numpy as np
+import nibabel
+from libraries.labels import pack_labels, load_packed, unpack
+from THOMAS_constants import prior_path, subjects, roi, packed_name
+
+
+def pack_prior(subject, path=prior_path, names=roi['label_names']):
+    """
+    Packs and verifies that every label of a prior round-trips exactly.
+    """
+    rois = os.path.join(path, subject, 'sanitized_rois')
+    label_images = [os.path.join(rois, label + '.nii.gz') for label in names]
+    output = os.path.join(rois, packed_name)
+    pack_labels(label_images, list(names), output)
+    data, names, nii = load_packed(output)
+    masks = unpack(data, names)
+    for label, image in zip(names, label_images):
+        original = np.asanyarray(nibabel.load(image).dataobj).reshape(data.shape) > 0
+        if not np.array_equal(original, masks[label]):
+            raise ValueError('%s does not round-trip in %s' % (label, output))
+    return output
+
+
+if __name__ == '__main__':
+    priors = sys.argv[1:] or subjects
+    for subject in priors:
+        print('Packed %s' % pack_prior(subject))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Resample each prior's labels and WMnMPRAGE_bias_corr into the grid of the crop templates once, so that
+THOMAS.py --prepared only brings them through the input's inverse registration instead of composing every prior's
+transforms with it on each run.  Run after pack_priors.py if the priors are packed.
+"""
+import os
+import argparse
+import libraries.parallel as parallel
+from libraries.cache import run_step
+from libraries.imgtools import ants_apply_only_warp
+from THOMAS_constants import image_name, packed_name, prior_path, subjects, prepared, roi
+
+
+def prepare_prior(subject, template, path=prior_path, names=roi['label_names']):
+    """
+    Warps a prior's labels, or its packed labels, and image to the template grid into its prepared directory.
+    """
+    source = os.path.join(path, subject)
+    output_path = os.path.join(source, prepared[template])
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    transforms = [os.path.join(source, 'WMnMPRAGEWarp.nii.gz'), os.path.join(source, 'WMnMPRAGEAffine.txt')]
+    rois = os.path.join(source, 'sanitized_rois')
+    packed = os.path.join(rois, packed_name)
+    labels = [packed] if os.path.exists(packed) else [os.path.join(rois, label + '.nii.gz') for label in names]
+    outputs = []
+    for input_image, switches in [(label, '--use-NN') for label in labels] + [(os.path.join(source, image_name), '--use-BSpline')]:
+        output = os.path.join(output_path, os.path.basename(input_image))
+        outputs += run_step(
+            [output],
+            lambda stage: ants_apply_only_warp(template, input_image, ' '.join(transforms), stage(output), switches=switches),
+            inputs=[input_image, template] + transforms,
+            parameters=(ants_apply_only_warp, switches),
+        )
+    return outputs
+
+
+parser = argparse.ArgumentParser(description='Resample the priors into the crop template grids for THOMAS.py --prepared.')
+parser.add_argument('subjects', nargs='*', help='priors to prepare, defaults to all of them')
+parser.add_argument('-p', '--processes', nargs='?', default=None, const=None, type=int, help='number of parallel processes to use.  If unspecified, automatically set to number of CPUs.')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    pool = parallel.BetterPool(args.processes)
+    try:
+        results = pool.map(prepare_prior, [dict(subject=subject, template=template) for subject in args.subjects or subjects for template in sorted(prepared)])
+    finally:
+        pool.close()
+    for outputs in results:
+        print('Prepared %s' % os.path.dirname(outputs[0]))
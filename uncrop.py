@@ -35,7 +35,7 @@ def uncrop_by_mask(input_image, output_image, full_mask, padding=0, canvas=None,
 
 if __name__ == '__main__':
     if len(sys.argv[1:]) < 3:
-        print '%s input_image output_image full_mask <padding> <canvas_image>' % sys.argv[0]
+        print '%s input_image output_image full_mask|crop_sidecar.json <padding> <canvas_image>' % sys.argv[0]
         sys.exit(0)
     input_image = sys.argv[1]
     output_image = sys.argv[2]
@@ -48,4 +48,9 @@ if __name__ == '__main__':
         canvas = sys.argv[5]
     except IndexError:
         canvas = None
-    uncrop_by_mask(input_image, output_image, full_mask, padding, canvas)
+    if full_mask.endswith('.json'):
+        # Sidecar of a crop made by THOMAS.py
+        from libraries.imgtools import uncrop_by_sidecar
+        uncrop_by_sidecar(input_image, output_image, full_mask)
+    else:
+        uncrop_by_mask(input_image, output_image, full_mask, padding, canvas)